@@ -0,0 +1,486 @@
+"""Module has a class that measures how fast models build, train and predict,
+so that speed regressions can be caught by diffing benchmark runs
+"""
+
+import sys
+import string
+import logging
+import json
+import time
+import resource
+import platform
+import multiprocessing
+
+import numpy as np
+import tensorflow as tf
+
+from .tf_ops import make_data_dict, available_cpus, slice_data, TextProcessor
+from .callbacks import Callback
+
+from .corral.linear_regression import LinearRegression
+from .corral.logistic_regression import LogisticRegression
+from .corral.dense_feedforward import DenseFeedforward
+from .corral.dense_autoencoder import DenseAutoencoder
+from .corral.convolutional_feedforward import ConvolutionalFeedforward
+from .corral.convolutional_autoencoder import ConvolutionalAutoencoder
+from .corral.convolutional_text_classification import ConvolutionalText
+from .corral.convolutional_siamese import ConvolutionalSiamese
+
+LOGGER = logging.getLogger(__name__)
+h = logging.StreamHandler(sys.stdout)
+h.setFormatter(
+    logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+)
+LOGGER.addHandler(h)
+LOGGER.setLevel(logging.DEBUG)
+
+CORRAL_MODELS = [
+    LinearRegression,
+    LogisticRegression,
+    DenseFeedforward,
+    DenseAutoencoder,
+    ConvolutionalFeedforward,
+    ConvolutionalAutoencoder,
+    ConvolutionalText,
+    ConvolutionalSiamese,
+]
+
+# characters for synthetic alphabets. good_chars are transliterated to ASCII,
+# so this is as big as an alphabet gets (the missing char is left out)
+ALPHABET_CHARS = ''.join(
+    char for char in string.ascii_letters + string.digits + string.punctuation
+    if char != TextProcessor.MISSING_CHAR
+)
+
+# for each metric, whether bigger numbers are better
+HIGHER_IS_BETTER = {
+    'graph_build_sec': False,
+    'first_batch_sec': False,
+    'train_samples_per_sec': True,
+    'predict_latency_sec': False,
+    'peak_rss_mb': False,
+}
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process so far, in MB"""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        # bytes on mac, kilobytes everywhere else
+        return peak / 1024.0 ** 2
+    return peak / 1024.0
+
+
+def _make_synthetic_input(layer, num_samples):
+    """Random data that fits an input layer"""
+
+    shape = [num_samples] + [i.value for i in layer.get_shape()[1:]]
+    if layer.dtype.is_integer:
+        return np.random.randint(0, 10, size=shape).astype(layer.dtype.as_numpy_dtype)
+    return np.random.randn(*shape)
+
+
+class ModelBenchmark(object):
+    """Measure the speed of a model on synthetic data:
+        - `graph_build_sec`: time to build the graph and initialize the weights
+        - `first_batch_sec`: time for the first training step
+        - `train_samples_per_sec`: steady-state training throughput
+        - `predict_latency_sec`: median predict time for each batch size
+        - `peak_rss_mb`: peak memory of the process
+
+    Peak memory covers the whole process, so benchmark each model in its own
+    process (like `run_benchmarks` does) to compare models with each other.
+    """
+
+    def __init__(self, mw_model_class, num_samples=2048, num_train_batches=50,
+                 predict_batch_sizes=(1, 32, 256), num_predict_runs=20, **model_kwargs):
+
+        self.model_class = mw_model_class
+        self.num_samples = num_samples
+        self.num_train_batches = num_train_batches
+        self.predict_batch_sizes = predict_batch_sizes
+        self.num_predict_runs = num_predict_runs
+        self.model_kwargs = model_kwargs
+
+    def make_data(self, model):
+        """Synthetic inputs and targets shaped for the model"""
+
+        if isinstance(model.tf_mod.input, list):
+            input_x = [
+                _make_synthetic_input(layer, self.num_samples)
+                for layer in model.tf_mod.input
+            ]
+        else:
+            input_x = _make_synthetic_input(model.tf_mod.input, self.num_samples)
+
+        target_shape = [i.value for i in model.tf_mod.target.get_shape()[1:]]
+        target_y = (np.random.rand(*([self.num_samples] + target_shape)) > 0.5).astype(float)
+
+        return input_x, target_y
+
+    def time_training(self, model, input_x, target_y):
+        """Time the first training step, then the steady-state throughput"""
+
+        dataset = model.tf_mod.DATA_CLASS(input_x, target_y, holdout_prop=0.0)
+
+        def _batches():
+            while True:
+                for batch in dataset.get_batches(batch_size=model.params.batch_size):
+                    yield batch
+
+        batches = _batches()
+
+        def _train_step(batch):
+            feed_dict = make_data_dict(model.tf_mod, batch[0], batch[1], is_training=True)
+            model.sess.run(model.tf_mod.train_step, feed_dict=feed_dict)
+            return batch[1].shape[0]
+
+        start_time = time.time()
+        _train_step(next(batches))
+        first_batch_sec = time.time() - start_time
+
+        nsamp = 0
+        start_time = time.time()
+        for _ in range(self.num_train_batches):
+            nsamp += _train_step(next(batches))
+        train_samples_per_sec = nsamp / (time.time() - start_time)
+
+        return first_batch_sec, train_samples_per_sec
+
+    def time_predict(self, model, input_x):
+        """Median predict time for each batch size"""
+
+        latencies = {}
+        for batch_size in self.predict_batch_sizes:
+            input_batch = slice_data(input_x, 0, batch_size)
+            model.predict(input_batch)
+
+            timings = []
+            for _ in range(self.num_predict_runs):
+                start_time = time.time()
+                model.predict(input_batch)
+                timings.append(time.time() - start_time)
+            latencies[str(batch_size)] = float(np.median(timings))
+
+        return latencies
+
+    def run(self):
+        """Run every benchmark and return a dict of results"""
+
+        start_time = time.time()
+        model = self.model_class(**self.model_kwargs)
+        graph_build_sec = time.time() - start_time
+
+        input_x, target_y = self.make_data(model)
+        first_batch_sec, train_samples_per_sec = self.time_training(model, input_x, target_y)
+        predict_latency_sec = self.time_predict(model, input_x)
+
+        results = {
+            'graph_build_sec': graph_build_sec,
+            'first_batch_sec': first_batch_sec,
+            'train_samples_per_sec': train_samples_per_sec,
+            'predict_latency_sec': predict_latency_sec,
+            'peak_rss_mb': _peak_rss_mb(),
+        }
+
+        LOGGER.info('%s: %s', self.model_class.__name__, json.dumps(results))
+        return results
+
+
+def _run_benchmark(mw_model_class, kwargs):
+    """Run a benchmark (in a fresh process, from `run_benchmarks`)"""
+
+    return ModelBenchmark(mw_model_class, **kwargs).run()
+
+
+def run_benchmarks(out_file, model_classes=None, **kwargs):
+    """Benchmark each model (default: every model in the corral) in its own
+    process and write the results to a JSON file. Extra kwargs go to
+    `ModelBenchmark`"""
+
+    if model_classes is None:
+        model_classes = CORRAL_MODELS
+
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'tensorflow': tf.__version__,
+            'numpy': np.__version__,
+            'python': platform.python_version(),
+            'cpus': available_cpus(),
+        },
+        'models': {},
+    }
+
+    ctx = multiprocessing.get_context('spawn')
+    for mw_model_class in model_classes:
+        proc_pool = ctx.Pool(1)
+        try:
+            results['models'][mw_model_class.__name__] = proc_pool.apply(
+                _run_benchmark,
+                (mw_model_class, kwargs)
+            )
+        finally:
+            proc_pool.close()
+            proc_pool.join()
+
+    with open(out_file, 'wt') as json_file:
+        json.dump(results, json_file, indent=4, sort_keys=True)
+
+    return results
+
+
+class _EpochThroughput(Callback):
+    """Collect training samples/sec for each epoch"""
+
+    def __init__(self):
+        super(_EpochThroughput, self).__init__()
+        self.samples_per_sec = []
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.samples_per_sec.append(logs['samples_per_sec'])
+
+
+def scaling_benchmark(mw_model_class, worker_counts=(1, 2, 4, 8), num_samples=100000,
+                      num_epochs=2, out_file=None, **model_kwargs):
+    """
+    Measure training throughput with different numbers of data-parallel
+    workers (the `train_workers` param). Reports the samples/sec of the last
+    epoch, so starting up the worker processes isn't counted. Returns a dict
+    mapping number of workers to samples/sec, and writes it to `out_file` if
+    it's given
+    """
+
+    results = {}
+    for num_workers in worker_counts:
+        model = mw_model_class(
+            train_workers=num_workers,
+            num_epochs=num_epochs,
+            **model_kwargs
+        )
+
+        input_x, target_y = ModelBenchmark(
+            mw_model_class, num_samples=num_samples
+        ).make_data(model)
+        dataset = model.tf_mod.DATA_CLASS(input_x, target_y, holdout_prop=0.0)
+
+        throughput = _EpochThroughput()
+        model.train(dataset, callbacks=[throughput])
+
+        results[str(num_workers)] = throughput.samples_per_sec[-1]
+        LOGGER.info(
+            '%s with %d workers: %0.1f samples/sec (%0.2fx)',
+            mw_model_class.__name__, num_workers, results[str(num_workers)],
+            results[str(num_workers)] / results[str(worker_counts[0])]
+        )
+
+    if out_file is not None:
+        with open(out_file, 'wt') as json_file:
+            json.dump(
+                {'model': mw_model_class.__name__, 'samples_per_sec': results},
+                json_file, indent=4, sort_keys=True
+            )
+
+    return results
+
+
+def _run_alphabet_benchmark(input_encoding, alphabet_size, num_samples, num_train_batches,
+                            model_kwargs):
+    """Time training a text model with one input encoding and alphabet size
+    (in a fresh process, from `alphabet_benchmark`)"""
+
+    good_chars = ALPHABET_CHARS[:alphabet_size]
+    num_ints = TextProcessor(good_chars=good_chars).num_chars + 2
+
+    start_time = time.time()
+    model = ConvolutionalText(
+        input_encoding=input_encoding,
+        good_chars=good_chars,
+        **model_kwargs
+    )
+    graph_build_sec = time.time() - start_time
+
+    input_x = np.random.randint(
+        0, num_ints,
+        size=(num_samples, model.params.in_size or model.params.pad_len)
+    ).astype(np.int32)
+    target_y = (np.random.rand(num_samples, model.params.out_size) > 0.5).astype(float)
+
+    first_batch_sec, train_samples_per_sec = ModelBenchmark(
+        ConvolutionalText, num_train_batches=num_train_batches
+    ).time_training(model, input_x, target_y)
+
+    return {
+        'graph_build_sec': graph_build_sec,
+        'first_batch_sec': first_batch_sec,
+        'train_samples_per_sec': train_samples_per_sec,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def alphabet_benchmark(alphabet_sizes=(16, 32, 64, 93),
+                       input_encodings=('onehot', 'gather', 'embedding'),
+                       num_samples=2048, num_train_batches=50, out_file=None,
+                       **model_kwargs):
+    """
+    Compare the `input_encoding` options of the text model across alphabet
+    sizes (the number of `good_chars`, at most `len(ALPHABET_CHARS)`). Each
+    run is in its own process so peak memory is comparable. Returns a dict mapping
+    `<input_encoding>_<alphabet_size>` to the same metrics as `ModelBenchmark`
+    (without predict latency), and writes it to `out_file` if it's given
+    """
+
+    if max(alphabet_sizes) > len(ALPHABET_CHARS):
+        raise ValueError(
+            'Alphabets can have at most {} characters,'.format(len(ALPHABET_CHARS)),
+            'but you have {}'.format(max(alphabet_sizes))
+        )
+
+    results = {}
+    ctx = multiprocessing.get_context('spawn')
+    for alphabet_size in alphabet_sizes:
+        for input_encoding in input_encodings:
+            proc_pool = ctx.Pool(1)
+            try:
+                result = proc_pool.apply(
+                    _run_alphabet_benchmark,
+                    (input_encoding, alphabet_size, num_samples, num_train_batches, model_kwargs)
+                )
+            finally:
+                proc_pool.close()
+                proc_pool.join()
+
+            results['{}_{}'.format(input_encoding, alphabet_size)] = result
+            LOGGER.info(
+                '%s encoding, %d characters: %0.1f samples/sec, %0.1f MB peak',
+                input_encoding, alphabet_size,
+                result['train_samples_per_sec'], result['peak_rss_mb']
+            )
+
+    if out_file is not None:
+        with open(out_file, 'wt') as json_file:
+            json.dump(
+                {'model': ConvolutionalText.__name__, 'models': results},
+                json_file, indent=4, sort_keys=True
+            )
+
+    return results
+
+
+def bucketing_benchmark(bucket_bounds=(32, 64, 128, 256), num_samples=20000,
+                        mean_length=40, num_epochs=2, out_file=None, **model_kwargs):
+    """
+    Compare text model training throughput with every sample padded to
+    `pad_len` and with length-bucketed batches (`bucket_bounds`), on synthetic
+    strings with skewed (log-normal) lengths around `mean_length`. Reports
+    samples/sec of the last epoch for each, and writes them to `out_file` if
+    it's given
+    """
+
+    pad_len = max(bucket_bounds)
+    lengths = np.clip(
+        np.random.lognormal(np.log(mean_length), 0.75, size=num_samples).astype(int),
+        1, pad_len
+    )
+
+    tp = TextProcessor()
+    input_x = np.full((num_samples, pad_len), tp.pad_char_idx, dtype=np.int32)
+    mask = np.arange(pad_len)[None, :] < lengths[:, None]
+    input_x[mask] = np.random.randint(0, tp.num_chars, size=mask.sum())
+    target_y = (np.random.rand(num_samples, 1) > 0.5).astype(float)
+
+    model_kwargs.setdefault('seq_pooling', 'max')
+
+    results = {}
+    for label, in_size, bounds in [('padded', pad_len, None), ('bucketed', None, bucket_bounds)]:
+        model = ConvolutionalText(
+            in_size=in_size,
+            pad_len=pad_len,
+            bucket_bounds=bounds,
+            num_epochs=num_epochs,
+            **model_kwargs
+        )
+        dataset = model.tf_mod.DATA_CLASS(
+            input_x, target_y,
+            pad_len=pad_len,
+            holdout_prop=0.0,
+            bucket_bounds=bounds
+        )
+
+        throughput = _EpochThroughput()
+        model.train(dataset, callbacks=[throughput])
+        results[label] = throughput.samples_per_sec[-1]
+
+    LOGGER.info(
+        'Padded: %0.1f samples/sec, bucketed: %0.1f samples/sec (%0.2fx), '
+        'padding wasted %0.1f%% of the padded input',
+        results['padded'], results['bucketed'], results['bucketed'] / results['padded'],
+        100.0 * (1.0 - lengths.mean() / pad_len)
+    )
+
+    if out_file is not None:
+        with open(out_file, 'wt') as json_file:
+            json.dump(
+                {'model': ConvolutionalText.__name__, 'samples_per_sec': results},
+                json_file, indent=4, sort_keys=True
+            )
+
+    return results
+
+
+def compare_benchmarks(old_file, new_file, tolerance=0.2):
+    """Compare two benchmark JSON files. Returns a list of
+    (model, metric, old value, new value) for every metric that got worse by
+    more than `tolerance` (as a fraction of the old value). Metrics that
+    aren't in `HIGHER_IS_BETTER` are skipped with a warning"""
+
+    with open(old_file, 'rt') as json_file:
+        old_results = json.load(json_file)['models']
+    with open(new_file, 'rt') as json_file:
+        new_results = json.load(json_file)['models']
+
+    def _flatten(results):
+        flat = {}
+        for metric, value in results.items():
+            if isinstance(value, dict):
+                for key, sub_value in value.items():
+                    flat[(metric, key)] = sub_value
+            else:
+                flat[(metric, None)] = value
+        return flat
+
+    regressions = []
+    for model_name in sorted(set(old_results) & set(new_results)):
+        old_flat = _flatten(old_results[model_name])
+        new_flat = _flatten(new_results[model_name])
+
+        for (metric, key) in sorted(set(old_flat) & set(new_flat), key=str):
+            old_value, new_value = old_flat[(metric, key)], new_flat[(metric, key)]
+            if not old_value:
+                continue
+
+            higher_is_better = HIGHER_IS_BETTER.get(metric)
+            if higher_is_better is None:
+                LOGGER.warning('%s %s is not a known metric, skipping it', model_name, metric)
+                continue
+
+            if higher_is_better:
+                change = (old_value - new_value) / old_value
+            else:
+                change = (new_value - old_value) / old_value
+
+            if change > tolerance:
+                label = metric if key is None else '{}[{}]'.format(metric, key)
+                regressions.append((model_name, label, old_value, new_value))
+                LOGGER.warning(
+                    '%s %s got worse: %0.4g -> %0.4g',
+                    model_name, label, old_value, new_value
+                )
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    run_benchmarks(sys.argv[1] if len(sys.argv) > 1 else 'benchmarks.json')
@@ -0,0 +1,337 @@
+"""Module has callbacks that hook into ModelWrangler.train"""
+
+import sys
+import os
+import logging
+from collections import defaultdict
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+LOGGER = logging.getLogger(__name__)
+h = logging.StreamHandler(sys.stdout)
+h.setFormatter(
+    logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+)
+LOGGER.addHandler(h)
+LOGGER.setLevel(logging.DEBUG)
+
+# the parts of a training step that get timed separately
+STEP_PHASES = ['fetch_sec', 'feed_sec', 'run_sec', 'log_sec']
+
+
+class Callback(object):
+    """
+    Base class for training callbacks. Subclasses should override whichever
+    hooks they need; `self.model` is the ModelWrangler being trained.
+
+    `on_batch_end` gets a `logs` dict with the batch size and how long each
+    part of the step took: `fetch_sec` (getting the batch from the dataset),
+    `feed_sec` (building the feed_dict), `run_sec` (`sess.run`) and `log_sec`
+    (scoring and logging). With the tf.data pipeline, fetching and feeding
+    happen inside `sess.run`. If the callback asked for trace options with
+    `run_options`, the step's `tf.RunMetadata` is in `logs['run_metadata']`.
+
+    `on_epoch_end` gets `samples_per_sec` and, if there's holdout data,
+    `holdout_score` (the model's loss on the holdout samples) in its logs.
+    Callbacks that save their own checkpoints should set `handles_checkpoints`
+    so the model doesn't also save every epoch
+    """
+
+    handles_checkpoints = False
+
+    def __init__(self):
+        self.model = None
+
+    def set_model(self, model):
+        """Attach the ModelWrangler that's being trained"""
+
+        self.model = model
+
+    def run_options(self, epoch, batch):
+        """Return a `tf.RunOptions` to use for this training step, or None"""
+
+        return None
+
+    def on_train_begin(self, logs=None):
+        """Called before the first epoch"""
+
+    def on_train_end(self, logs=None):
+        """Called after training finishes (or is interrupted)"""
+
+    def on_epoch_begin(self, epoch, logs=None):
+        """Called at the start of each epoch"""
+
+    def on_epoch_end(self, epoch, logs=None):
+        """Called at the end of each epoch"""
+
+    def on_batch_begin(self, batch, logs=None):
+        """Called before each training step"""
+
+    def on_batch_end(self, batch, logs=None):
+        """Called after each training step"""
+
+
+class CallbackList(object):
+    """Runs each hook on a list of callbacks"""
+
+    def __init__(self, callbacks=None, model=None):
+
+        self.callbacks = list(callbacks or [])
+        self.epoch = 0
+        for callback in self.callbacks:
+            callback.set_model(model)
+
+    @property
+    def handles_checkpoints(self):
+        """Whether any callback saves checkpoints itself"""
+
+        return any(callback.handles_checkpoints for callback in self.callbacks)
+
+    def run_kwargs(self, batch):
+        """Keyword args for `sess.run` on a training step: trace options and
+        a `tf.RunMetadata` to fill if any callback asked for them"""
+
+        options = None
+        for callback in self.callbacks:
+            options = callback.run_options(self.epoch, batch) or options
+
+        if options is None:
+            return {}
+        return {'options': options, 'run_metadata': tf.RunMetadata()}
+
+    def on_train_begin(self, logs=None):
+        for callback in self.callbacks:
+            callback.on_train_begin(logs)
+
+    def on_train_end(self, logs=None):
+        for callback in self.callbacks:
+            callback.on_train_end(logs)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        for callback in self.callbacks:
+            callback.on_epoch_begin(epoch, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        for callback in self.callbacks:
+            callback.on_epoch_end(epoch, logs)
+
+    def on_batch_begin(self, batch, logs=None):
+        for callback in self.callbacks:
+            callback.on_batch_begin(batch, logs)
+
+    def on_batch_end(self, batch, logs=None):
+        for callback in self.callbacks:
+            callback.on_batch_end(batch, logs)
+
+
+class StepTimer(Callback):
+    """
+    Add up how long each part of the training steps took and log a breakdown
+    at the end of each epoch, to see whether training is input-bound (most
+    time spent fetching and feeding batches) or compute-bound (most time
+    spent in `sess.run`). Totals for the last epoch are in `self.totals`
+    """
+
+    def __init__(self):
+        super(StepTimer, self).__init__()
+        self.totals = defaultdict(float)
+        self.num_batches = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.totals = defaultdict(float)
+        self.num_batches = 0
+
+    def on_batch_end(self, batch, logs=None):
+        for phase in STEP_PHASES:
+            self.totals[phase] += logs.get(phase, 0.0)
+        self.num_batches += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+
+        total_sec = sum(self.totals[phase] for phase in STEP_PHASES)
+        if not self.num_batches or not total_sec:
+            return
+
+        LOGGER.info(
+            'Epoch %d step time: %s (%0.2f ms per batch)',
+            epoch,
+            ', '.join(
+                '{} {:0.1f}%'.format(phase[:-4], 100.0 * self.totals[phase] / total_sec)
+                for phase in STEP_PHASES
+            ),
+            1000.0 * total_sec / self.num_batches
+        )
+
+        input_sec = self.totals['fetch_sec'] + self.totals['feed_sec']
+        if input_sec > self.totals['run_sec']:
+            LOGGER.info('Epoch %d looks input-bound', epoch)
+        else:
+            LOGGER.info('Epoch %d looks compute-bound', epoch)
+
+
+class TraceCallback(Callback):
+    """
+    Capture a full `tf.RunMetadata` trace for some training steps and write
+    it out as a Chrome trace timeline (open it at chrome://tracing).
+
+    `batches` are the batch numbers to trace in each epoch in `epochs` (all
+    epochs if None). Timelines go in `trace_dir` (default: `<model path>/traces`)
+    """
+
+    def __init__(self, trace_dir=None, batches=(10,), epochs=(0,)):
+        super(TraceCallback, self).__init__()
+        self.trace_dir = trace_dir
+        self.batches = set(batches)
+        self.epochs = None if epochs is None else set(epochs)
+        self.trace_files = []
+
+        self._epoch = 0
+
+    def on_train_begin(self, logs=None):
+        if self.trace_dir is None:
+            self.trace_dir = os.path.join(self.model.params.path, 'traces')
+        if not os.path.isdir(self.trace_dir):
+            os.makedirs(self.trace_dir)
+
+    def run_options(self, epoch, batch):
+        if batch not in self.batches:
+            return None
+        if self.epochs is not None and epoch not in self.epochs:
+            return None
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+
+        run_metadata = logs.get('run_metadata')
+        if run_metadata is None:
+            return
+
+        trace = timeline.Timeline(run_metadata.step_stats)
+        trace_file = os.path.join(
+            self.trace_dir,
+            'timeline-epoch{}-batch{}.json'.format(self._epoch, batch)
+        )
+        with open(trace_file, 'wt') as json_file:
+            json_file.write(trace.generate_chrome_trace_format())
+
+        self.trace_files.append(trace_file)
+        LOGGER.info('Wrote step trace %s', trace_file)
+
+
+class ScoreMonitor(Callback):
+    """
+    Base class for callbacks that watch a score from the epoch logs
+    (`monitor`, default: holdout loss) and act when it stops improving.
+    `mode` is 'min' if lower scores are better or 'max' if higher are better,
+    and a score has to beat the best one so far by `min_delta` to count
+    """
+
+    def __init__(self, monitor='holdout_score', mode='min', min_delta=0.0):
+        super(ScoreMonitor, self).__init__()
+
+        if mode not in ['min', 'max']:
+            raise ValueError(
+                'mode should be `min` or `max`,',
+                'but you have {}'.format(mode)
+            )
+
+        self.monitor = monitor
+        self.mode = mode
+        self.min_delta = min_delta
+
+        self.best = None
+        self.wait = 0
+
+    def on_train_begin(self, logs=None):
+        self.best = None
+        self.wait = 0
+
+    def _improved(self, logs):
+        """Update the best score and return whether this epoch improved on
+        it, or None if the score isn't in the logs"""
+
+        score = (logs or {}).get(self.monitor)
+        if score is None:
+            LOGGER.warning('%s is not available, skipping %s', self.monitor, self.__class__.__name__)
+            return None
+
+        if self.best is None:
+            improved = True
+        elif self.mode == 'min':
+            improved = score < self.best - self.min_delta
+        else:
+            improved = score > self.best + self.min_delta
+
+        if improved:
+            self.best = score
+            self.wait = 0
+        else:
+            self.wait += 1
+
+        return improved
+
+
+class EarlyStopping(ScoreMonitor):
+    """Stop training when the score hasn't improved for `patience` epochs"""
+
+    def __init__(self, patience=2, **kwargs):
+        super(EarlyStopping, self).__init__(**kwargs)
+        self.patience = patience
+
+    def on_epoch_end(self, epoch, logs=None):
+        improved = self._improved(logs)
+        if improved is False and self.wait >= self.patience:
+            LOGGER.info(
+                'Epoch %d: %s has not improved in %d epochs, stopping early',
+                epoch, self.monitor, self.wait
+            )
+            self.model.stop_training = True
+
+
+class ReduceLROnPlateau(ScoreMonitor):
+    """Multiply the learning rate by `factor` when the score hasn't improved
+    for `patience` epochs, down to `min_lr`"""
+
+    def __init__(self, factor=0.5, patience=1, min_lr=1.0e-6, **kwargs):
+        super(ReduceLROnPlateau, self).__init__(**kwargs)
+
+        if factor >= 1.0 or factor <= 0.0:
+            raise ValueError(
+                'factor should be in interval (0, 1.0),',
+                'but you have {}'.format(factor)
+            )
+
+        self.factor = factor
+        self.patience = patience
+        self.min_lr = min_lr
+
+    def on_epoch_end(self, epoch, logs=None):
+        improved = self._improved(logs)
+        if improved is False and self.wait >= self.patience:
+            old_lr = self.model.params.learning_rate
+            new_lr = max(old_lr * self.factor, self.min_lr)
+            if new_lr < old_lr:
+                LOGGER.info('Epoch %d: reducing learning rate to %g', epoch, new_lr)
+                self.model.set_learning_rate(new_lr)
+            self.wait = 0
+
+
+class BestCheckpoint(ScoreMonitor):
+    """Only save a checkpoint when the score improves, instead of every epoch.
+    The latest checkpoint (which `ModelWrangler.load` restores) is always the
+    best one"""
+
+    handles_checkpoints = True
+
+    def on_epoch_end(self, epoch, logs=None):
+        improved = self._improved(logs)
+        if improved is None:
+            self.model.save(epoch)
+        elif improved:
+            LOGGER.info('Epoch %d: %s improved to %0.6f', epoch, self.monitor, self.best)
+            self.model.save(epoch)
@@ -0,0 +1,137 @@
+"""Module has tools for writing model checkpoints in the background"""
+
+import sys
+import os
+import logging
+import threading
+import time
+
+import tensorflow as tf
+
+LOGGER = logging.getLogger(__name__)
+h = logging.StreamHandler(sys.stdout)
+h.setFormatter(
+    logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+)
+LOGGER.addHandler(h)
+LOGGER.setLevel(logging.DEBUG)
+
+
+class AsyncCheckpointer(object):
+    """
+    Write checkpoints for a ModelWrangler on a background thread.
+
+    `save` copies the model's variables into host memory, which is quick, and
+    then hands the slow part (writing the checkpoint, meta graph and params
+    JSON) off to a background thread. The checkpoint is written from a small
+    shadow graph that holds the copied values, so training can keep updating
+    the real variables in the meantime. At most one write is in flight: a new
+    `save` waits for the previous write to finish first.
+
+    The files written are the same as `ModelWrangler.save` writes.
+    """
+
+    def __init__(self, model):
+
+        self.model = model
+        self.last_write_seconds = None
+
+        self._thread = None
+        self._error = None
+
+        self._variables = model.tf_mod.graph.get_collection(
+            tf.GraphKeys.GLOBAL_VARIABLES
+        )
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            shadow_vars = {}
+            for var in self._variables:
+                shadow_vars[var.op.name] = tf.Variable(
+                    tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype),
+                    trainable=False
+                )
+
+            self._shadow_vars = [shadow_vars[var.op.name] for var in self._variables]
+            self._saver = tf.train.Saver(
+                var_list=shadow_vars,
+                pad_step_number=True,
+                max_to_keep=4
+            )
+
+        self._sess = tf.Session(
+            graph=self._graph,
+            config=tf.ConfigProto(
+                intra_op_parallelism_threads=1,
+                inter_op_parallelism_threads=1
+            )
+        )
+
+    def save(self, iteration):
+        """Snapshot the model's weights and write them out in the background"""
+
+        self.wait()
+
+        start_time = time.time()
+
+        save_path = os.path.join(self.model.params.path, self.model.params.name)
+        self.model.params.meta_filename = '{}-{}'.format(save_path, iteration)
+
+        values = self.model.sess.run(self._variables)
+        meta_graph = self.model.tf_mod.saver.export_meta_graph()
+        params_json = self.model.params.to_json()
+
+        LOGGER.info('Took %0.3f sec to snapshot weights', time.time() - start_time)
+
+        self._thread = threading.Thread(
+            target=self._write,
+            args=(values, save_path, iteration, meta_graph, params_json)
+        )
+        self._thread.start()
+
+    def _write(self, values, save_path, iteration, meta_graph, params_json):
+
+        start_time = time.time()
+
+        try:
+            for shadow_var, value in zip(self._shadow_vars, values):
+                shadow_var.load(value, self._sess)
+
+            LOGGER.info('Saving weights file in %s', self.model.params.path)
+            checkpoint = self._saver.save(
+                self._sess,
+                save_path=save_path,
+                global_step=iteration,
+                write_meta_graph=False
+            )
+
+            with open(checkpoint + '.meta', 'wb') as meta_file:
+                meta_file.write(meta_graph.SerializeToString())
+
+            self.model.params.save(params_json=params_json)
+
+        except Exception as err:  # pylint: disable=broad-except
+            self._error = err
+            return
+
+        self.last_write_seconds = time.time() - start_time
+        LOGGER.info('Took %0.3f sec to write checkpoint %s', self.last_write_seconds, checkpoint)
+
+    def wait(self):
+        """Block until the write in flight (if any) is done"""
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            err, self._error = self._error, None
+            raise err
+
+    def close(self):
+        """Finish writing and release the shadow session"""
+
+        try:
+            self.wait()
+        finally:
+            self._sess.close()
@@ -154,6 +154,13 @@ class ConvolutionalSiameseModel(BaseNetwork):
 
         return [input_0, input_1], out_siamese, target_layer, loss
 
+    def setup_data_iterator(self):
+        """Keep the embedding input pointing at the (rerouted) first input"""
+
+        iterator = super(ConvolutionalSiameseModel, self).setup_data_iterator()
+        self.embed_in = self.input[0]
+        return iterator
+
 
 class ConvolutionalSiamese(ModelWrangler):
     """Dense Autoencoder
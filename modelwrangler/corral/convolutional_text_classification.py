@@ -14,6 +14,54 @@ from modelwrangler.tf_models import (
 
 PAD_LENGTH = 256
 
+# how the character ints are fed to the first conv layer
+INPUT_ENCODINGS = ['onehot', 'gather', 'embedding']
+
+# how the conv layers are reduced for the dense layers; variable-length
+# input needs pooling over the sequence
+SEQ_POOLINGS = [None, 'max', 'mean']
+
+# subtracted from masked positions so they never win max pooling
+MASK_PENALTY = 1.0e9
+
+
+def _first(value):
+    """Size of a 1-D conv setting, which can be given as a list"""
+
+    if isinstance(value, (list, tuple)):
+        return value[0]
+    return value
+
+
+def _conv_pad_mask(pad_mask, layer_config):
+    """
+    Carry a mask of pad positions ([batch, length, 1], 1.0 for pads) through a
+    conv layer ('same' padding) and its max pooling (stride 1, 'valid'
+    padding). An output position is a pad if anything it depends on is a pad
+    char or past the end of the input, so the positions that aren't pads are
+    the same however far the input is padded
+    """
+
+    kernel_size = _first(layer_config.kernel)
+    strides = _first(layer_config.strides)
+
+    in_len = tf.shape(pad_mask)[1]
+    out_len = (in_len + strides - 1) // strides
+    pad_total = tf.maximum((out_len - 1) * strides + kernel_size - in_len, 0)
+    pad_left = pad_total // 2
+
+    # past the end of the input is where pad chars would be
+    pad_mask = tf.pad(pad_mask, [[0, 0], [pad_left, 0], [0, 0]])
+    pad_mask = tf.pad(pad_mask, [[0, 0], [0, pad_total - pad_left], [0, 0]], constant_values=1.0)
+    pad_mask = tf.layers.max_pooling1d(pad_mask, kernel_size, strides)
+
+    pool_size = _first(layer_config.pool_size)
+    if pool_size:
+        pad_mask = tf.layers.max_pooling1d(pad_mask, pool_size, 1)
+
+    return pad_mask
+
+
 class ConvolutionalTextParams(BaseNetworkParams):
     """Convolutional feedforward params
     """
@@ -26,13 +74,20 @@ class ConvolutionalTextParams(BaseNetworkParams):
 
     DATASET_MANAGER_PARAMS = {
         'pad_len': PAD_LENGTH,
-        'holdout_prop': 0.1
+        'holdout_prop': 0.1,
+        'encode_workers': 0,
+        'encode_cache': None,
+        'good_chars': None,
+        'bucket_bounds': None,
     }
 
     MODEL_SPECIFIC_ATTRIBUTES = {
         "name": "conv_text",
         "in_size": PAD_LENGTH,
         "out_size": 1,
+        "input_encoding": "onehot",
+        "embed_size": 16,
+        "seq_pooling": None,
         "conv_nodes": [5],
         "conv_params": {
             "dropout_rate": 0.1,
@@ -85,18 +140,83 @@ class ConvolutionalTextModel(BaseNetwork):
 
         in_layer = layer_stack[0]
 
-        good_chars = getattr(params, 'good_chars', tops.TextProcessor.DEFAULT_CHARS)
-        character_depth = len(good_chars) + 2
+        # good_chars are transliterated and deduplicated, so let the text
+        # processor count them (plus the missing and pad chars)
+        text_processor = tops.TextProcessor(good_chars=params.good_chars)
+        character_depth = text_processor.num_chars + 2
 
-        layer_stack.append(
-            self.make_onehot_encode_layer(
-                layer_stack[-1],
-                character_depth
+        if params.input_encoding not in INPUT_ENCODINGS:
+            raise ValueError(
+                'input_encoding should be one of {},'.format(INPUT_ENCODINGS),
+                'but you have {}'.format(params.input_encoding)
+            )
+
+        if params.seq_pooling not in SEQ_POOLINGS:
+            raise ValueError(
+                'seq_pooling should be one of {},'.format(SEQ_POOLINGS),
+                'but you have {}'.format(params.seq_pooling)
+            )
+
+        if params.in_size is None and params.seq_pooling is None:
+            raise ValueError(
+                'Variable-length input (in_size of None)',
+                'needs a seq_pooling of `max` or `mean`'
+            )
+
+        if params.bucket_bounds and params.in_size is not None:
+            raise ValueError(
+                'Length-bucketed batches have variable length,',
+                'so in_size should be None, but you have {}'.format(params.in_size)
+            )
+
+        conv_nodes = list(params.conv_nodes)
+
+        if params.bucket_bounds:
+            # shortest input that has any positions left after the conv layers
+            min_bound = 1
+            for _ in conv_nodes:
+                min_bound += (_first(params.conv_params.pool_size) or 1) - 1
+                min_bound = (min_bound - 1) * _first(params.conv_params.strides) + 1
+
+            if min(params.bucket_bounds) < min_bound:
+                raise ValueError(
+                    'bucket_bounds should be at least {} for these conv layers,'.format(min_bound),
+                    'but you have {}'.format(min(params.bucket_bounds))
+                )
+
+        if params.input_encoding == 'gather':
+            # same as one-hot + the first conv, without the one-hot tensor
+            layer_stack.append(
+                self.make_gather_conv_layer(
+                    layer_stack[-1],
+                    character_depth,
+                    conv_nodes[0],
+                    'conv_0',
+                    params.conv_params
+                )
+            )
+        elif params.input_encoding == 'embedding':
+            layer_stack.append(
+                self.make_embedding_layer(
+                    layer_stack[-1],
+                    character_depth,
+                    params.embed_size,
+                    'char_embedding'
+                )
+            )
+        else:
+            layer_stack.append(
+                self.make_onehot_encode_layer(
+                    layer_stack[-1],
+                    character_depth
+                )
             )
-        )
 
         # Add conv layers
-        for idx, num_nodes in enumerate(params.conv_nodes):
+        for idx, num_nodes in enumerate(conv_nodes):
+            if idx == 0 and params.input_encoding == 'gather':
+                continue
+
             layer_stack.append(
                 self.make_conv_layer(
                     layer_stack[-1],
@@ -106,12 +226,41 @@ class ConvolutionalTextModel(BaseNetwork):
                 )
             )
 
-        # Flatten convolutional layers
-        layer_stack.append(
-            tf.contrib.layers.flatten(
-                layer_stack[-1]
+        # Pool over the sequence (leaving out positions that depend on pad
+        # chars, so a sample pools the same in any length bucket, and samples
+        # too short to have any such positions pool to zeros) or flatten
+        # convolutional layers
+        if params.seq_pooling is not None:
+            pad_mask = tf.expand_dims(
+                tf.to_float(tf.equal(in_layer, text_processor.pad_char_idx)), -1
+            )
+            for _ in conv_nodes:
+                pad_mask = _conv_pad_mask(pad_mask, params.conv_params)
+            keep_mask = 1.0 - pad_mask
+            any_kept = tf.reduce_max(keep_mask, axis=1)
+
+        if params.seq_pooling == 'max':
+            layer_stack.append(
+                tf.multiply(
+                    tf.reduce_max(layer_stack[-1] - MASK_PENALTY * pad_mask, axis=1),
+                    any_kept,
+                    name='seq_pooling'
+                )
+            )
+        elif params.seq_pooling == 'mean':
+            layer_stack.append(
+                tf.divide(
+                    tf.reduce_sum(layer_stack[-1] * keep_mask, axis=1),
+                    tf.maximum(tf.reduce_sum(keep_mask, axis=1), 1.0),
+                    name='seq_pooling'
+                )
+            )
+        else:
+            layer_stack.append(
+                tf.contrib.layers.flatten(
+                    layer_stack[-1]
+                )
             )
-        )
 
         # Add dense layers
         for idx, num_nodes in enumerate(params.dense_nodes):
@@ -0,0 +1,317 @@
+"""Module implements data-parallel training across worker processes"""
+
+import sys
+import os
+import copy
+import json
+import logging
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+from queue import Empty
+
+import numpy as np
+import tensorflow as tf
+
+from .tf_ops import make_data_dict, available_cpus
+from .dataset_managers import ShardedDatasetManager, array_path
+
+LOGGER = logging.getLogger(__name__)
+h = logging.StreamHandler(sys.stdout)
+h.setFormatter(
+    logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+)
+LOGGER.addHandler(h)
+LOGGER.setLevel(logging.DEBUG)
+
+# dataset attributes that hold sample arrays
+DATA_ATTRIBUTES = ['X', 'y', 'X_1']
+
+# seconds between checks that the other processes are still alive
+POLL_SECONDS = 1.0
+
+
+def share_dataset(dataset, tmp_dir):
+    """
+    Make a copy of a dataset manager that's cheap to send to other processes.
+    Its sample arrays are swapped for `.npy` paths (arrays that are already
+    memory-mapped `.npy` files are used as is), which `open_shared_dataset`
+    memory-maps, so every worker reads one read-only copy of the data
+    """
+
+    shared = copy.copy(dataset)
+    for attr in DATA_ATTRIBUTES:
+        arr = getattr(dataset, attr, None)
+        if isinstance(arr, (list, tuple)):
+            paths = [
+                array_path(part, tmp_dir, '{}_{}'.format(attr, idx))
+                for idx, part in enumerate(arr)
+            ]
+        elif isinstance(arr, np.ndarray):
+            paths = array_path(arr, tmp_dir, attr)
+        else:
+            continue
+        setattr(shared, attr, paths)
+
+    return shared
+
+
+def open_shared_dataset(shared):
+    """Memory-map the sample arrays of a dataset from `share_dataset`"""
+
+    for attr in DATA_ATTRIBUTES:
+        paths = getattr(shared, attr, None)
+        if isinstance(paths, list):
+            setattr(shared, attr, [np.load(path, mmap_mode='r') for path in paths])
+        elif paths is not None:
+            setattr(shared, attr, np.load(paths, mmap_mode='r'))
+
+    return shared
+
+
+def _set_values(sess, variables, values):
+    """Load values into variables with a single `sess.run`"""
+
+    sess.run(
+        [var.initializer for var in variables],
+        feed_dict={
+            var.initializer.inputs[1]: value
+            for var, value in zip(variables, values)
+        }
+    )
+
+
+def _unflatten(flat, shapes, sizes):
+    """Split a flat vector into arrays with the given shapes"""
+
+    splits = np.split(flat, np.cumsum(sizes)[:-1])
+    return [part.reshape(shape) for part, shape in zip(splits, shapes)]
+
+
+def _worker(worker_id, num_workers, wrangler_class, params_json, checkpoint, dataset,
+            shared_rows, shared_mean, barrier, task_queue, result_queue, master_pid):
+    """
+    Training loop for one worker process. For each epoch it gets a learning
+    rate and a list of batch indices from `task_queue`, and every `sync_every`
+    steps (and at the end of the epoch) it averages its variables with the
+    other workers through shared memory:
+        1. write its variables to its row of `shared_rows`
+        2. average its slice of the columns into `shared_mean`
+        3. load the averaged variables from `shared_mean`
+    with a barrier between each step. A worker gives up (and reports an error)
+    if the others don't reach a barrier within `sync_timeout` seconds, and
+    exits if the master process (`master_pid`) goes away
+    """
+
+    try:
+        params = json.loads(params_json)
+        params['data_pipeline'] = 'feed_dict'
+        params['intra_op_threads'] = max(1, available_cpus() // num_workers)
+        params['inter_op_threads'] = 1
+        params['thread_pool'] = None
+
+        model = wrangler_class(restore_path=checkpoint, **params)
+        dataset = open_shared_dataset(dataset)
+
+        variables = model.tf_mod.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        shapes = [var.get_shape().as_list() for var in variables]
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        total_size = sum(sizes)
+
+        rows = np.frombuffer(shared_rows, dtype=np.float64).reshape(num_workers, total_size)
+        mean = np.frombuffer(shared_mean, dtype=np.float64)
+        col_start = worker_id * total_size // num_workers
+        col_stop = (worker_id + 1) * total_size // num_workers
+
+        sync_timeout = model.params.sync_timeout
+
+        def _sync():
+            values = model.sess.run(variables)
+            rows[worker_id, :] = np.concatenate([value.ravel() for value in values])
+            barrier.wait(sync_timeout)
+
+            mean[col_start:col_stop] = rows[:, col_start:col_stop].mean(axis=0)
+            barrier.wait(sync_timeout)
+
+            _set_values(
+                model.sess, variables,
+                [value.astype(var.dtype.base_dtype.as_numpy_dtype)
+                 for value, var in zip(_unflatten(mean.copy(), shapes, sizes), variables)]
+            )
+
+        sync_every = max(1, model.params.sync_every)
+
+        while True:
+            try:
+                task = task_queue.get(timeout=POLL_SECONDS)
+            except Empty:
+                # orphaned workers are re-parented, so the parent pid changes
+                if os.getppid() != master_pid:
+                    break
+                continue
+
+            if task is None:
+                break
+
+            learning_rate, batch_idx = task
+            model.tf_mod.learning_rate.load(learning_rate, model.sess)
+
+            nsamp = 0
+            for step, idx in enumerate(batch_idx):
+                X_batch, y_batch = dataset._return_idx(idx)  # pylint: disable=protected-access
+                model.sess.run(
+                    model.tf_mod.train_step,
+                    feed_dict=make_data_dict(model.tf_mod, X_batch, y_batch, is_training=True)
+                )
+                nsamp += idx.shape[0]
+
+                if (step + 1) % sync_every == 0 and step + 1 < len(batch_idx):
+                    _sync()
+
+            _sync()
+            result_queue.put(('done', worker_id, nsamp))
+
+    except Exception:  # pylint: disable=broad-except
+        barrier.abort()
+        result_queue.put(('error', worker_id, traceback.format_exc()))
+
+
+class DataParallelTrainer(object):
+    """
+    Train a ModelWrangler with `train_workers` processes.
+
+    Each epoch's batches are split evenly between the workers (a few leftover
+    batches may be dropped so every worker takes the same number of steps).
+    Workers train their own copy of the model on their batches and average
+    their variables through shared memory every `sync_every` steps. At the end
+    of each epoch the averaged variables are loaded into the master model.
+
+    The dataset's sample arrays are memory-mapped by the workers, so there's
+    only one copy of the data in memory. Step-level callbacks aren't called;
+    epoch-level callbacks work as usual.
+
+    If a worker dies (e.g., it's killed for running out of memory), the epoch
+    fails with a RuntimeError instead of waiting for it forever. Streamed
+    datasets (`ShardedDatasetManager`) can't be split between workers.
+    """
+
+    def __init__(self, model, dataset, pos_classes=None):
+
+        if isinstance(dataset, ShardedDatasetManager):
+            raise ValueError(
+                'Data-parallel training needs a dataset with random access',
+                'by index, but sharded datasets are streamed'
+            )
+
+        self.model = model
+        self.dataset = dataset
+        self.pos_classes = pos_classes
+        self.num_workers = model.params.train_workers
+
+        self.variables = model.tf_mod.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        self.shapes = [var.get_shape().as_list() for var in self.variables]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        total_size = sum(self.sizes)
+
+        ctx = multiprocessing.get_context('spawn')
+        self._shared_rows = ctx.RawArray('d', self.num_workers * total_size)
+        self._shared_mean = ctx.RawArray('d', total_size)
+        self._mean = np.frombuffer(self._shared_mean, dtype=np.float64)
+
+        self._barrier = ctx.Barrier(self.num_workers)
+        self._task_queues = [ctx.Queue() for _ in range(self.num_workers)]
+        self._result_queue = ctx.Queue()
+
+        self._tmp_dir = tempfile.mkdtemp()
+        checkpoint = model.tf_mod.saver.save(
+            model.sess,
+            os.path.join(self._tmp_dir, 'data_parallel')
+        )
+        shared_dataset = share_dataset(dataset, self._tmp_dir)
+
+        self._workers = [
+            ctx.Process(
+                target=_worker,
+                args=(
+                    worker_id, self.num_workers, model.__class__,
+                    model.params.to_json(), checkpoint, shared_dataset,
+                    self._shared_rows, self._shared_mean, self._barrier,
+                    self._task_queues[worker_id], self._result_queue, os.getpid()
+                )
+            )
+            for worker_id in range(self.num_workers)
+        ]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def run_epoch(self):
+        """Run an epoch of training, return the number of samples trained on"""
+
+        batch_idx = list(self.dataset.get_batch_idx(
+            pos_classes=self.pos_classes,
+            batch_size=self.model.params.batch_size
+        ))
+
+        steps = len(batch_idx) // self.num_workers
+        if not steps:
+            raise ValueError(
+                'Not enough batches for {} workers:'.format(self.num_workers),
+                'only {} batches per epoch'.format(len(batch_idx))
+            )
+
+        for worker_id, task_queue in enumerate(self._task_queues):
+            task_queue.put((
+                self.model.params.learning_rate,
+                batch_idx[worker_id::self.num_workers][:steps]
+            ))
+
+        nsamp = 0
+        errors = []
+        num_results = 0
+        while num_results < self.num_workers:
+            try:
+                status, worker_id, result = self._result_queue.get(timeout=POLL_SECONDS)
+            except Empty:
+                dead = [
+                    'Worker {} died with exit code {}'.format(worker_id, worker.exitcode)
+                    for worker_id, worker in enumerate(self._workers)
+                    if not worker.is_alive()
+                ]
+                if dead:
+                    # let the other workers out of any barrier they're stuck at
+                    self._barrier.abort()
+                    raise RuntimeError(
+                        'Data-parallel training failed.\n' + '\n'.join(errors + dead))
+                continue
+
+            num_results += 1
+            if status == 'error':
+                errors.append('Worker {}:\n{}'.format(worker_id, result))
+            else:
+                nsamp += result
+
+        if errors:
+            raise RuntimeError('Data-parallel training failed.\n' + '\n'.join(errors))
+
+        values = _unflatten(self._mean.copy(), self.shapes, self.sizes)
+        _set_values(
+            self.model.sess, self.variables,
+            [value.astype(var.dtype.base_dtype.as_numpy_dtype)
+             for value, var in zip(values, self.variables)]
+        )
+
+        return nsamp
+
+    def close(self):
+        """Stop the workers and clean up"""
+
+        for task_queue in self._task_queues:
+            task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=30)
+            if worker.is_alive():
+                worker.terminate()
+
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
@@ -4,19 +4,24 @@
 # pylint: disable=C0103
 
 import sys
+import os
+import glob
+import mmap
+import hashlib
 import logging
-import random
-from collections import Iterable
+import threading
+import multiprocessing
 
 if sys.version_info.major == 2:
-    from itertools import izip_longest as zip_longest
     from itertools import izip as zip
+    from Queue import Queue, Full
 elif sys.version_info.major == 3:
-    from itertools import zip_longest
+    from queue import Queue, Full
 else:
     raise ValueError('wtf?!?')
 
 import numpy as np
+import tensorflow as tf
 
 from .tf_ops import TextProcessor
 
@@ -29,48 +34,83 @@ LOGGER.addHandler(h)
 LOGGER.setLevel(logging.DEBUG)
 
 
-def random_chunk_generator(iterable, block_size):
-    """Collect data into fixed-length chunks or blocks
-    
-    grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
-    https://docs.python.org/3/library/itertools.html
+def random_chunk_generator(idx, block_size):
+    """Shuffle an array of indices and split it into chunks of `block_size`
+    indices. The last chunk can be shorter, so no padding values are needed
     """
-    random.shuffle(iterable)
-    args = [iter(iterable)] * block_size
-    return zip_longest(*args, fillvalue=None)
 
+    idx = np.random.permutation(idx)
 
-def pad_list(in_list, pad_size):
+    if block_size < 1:
+        return
+
+    for start in range(0, idx.shape[0], block_size):
+        yield idx[start:start + block_size]
+
+
+def pad_list(idx, pad_size):
     """
-    Make a list a little longer by appending a randomly sampled
-    items from itselt
+    Make an index array a little longer by appending randomly sampled
+    items from itself
     """
-    new_list = list(in_list)
-    pad_values = np.random.choice(in_list, pad_size, replace=True)
-    new_list.extend(pad_values)
-    return new_list
+    pad_values = np.random.choice(idx, pad_size, replace=True)
+    return np.concatenate([idx, pad_values])
+
+
+def _unique_rows(output_data):
+    """
+    Find the distinct rows in a 2d array. Returns the distinct rows and an array
+    that has the group number for every row, like
+    `np.unique(output_data, axis=0, return_inverse=True)` but without sorting rows
+    """
+
+    try:
+        # adding 0.0 makes -0.0 and 0.0 have the same bits
+        rows = np.ascontiguousarray(output_data, dtype=np.float64) + 0.0
+    except (TypeError, ValueError):
+        groups, group_ids = np.unique(output_data, axis=0, return_inverse=True)
+        return groups, group_ids.ravel()
+
+    # hash each row into one 64-bit key
+    keys = np.zeros((rows.shape[0],), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for col in rows.view(np.uint64).T:
+            keys = keys * np.uint64(1000003) + col
+
+    _, first_idx, group_ids = np.unique(keys, return_index=True, return_inverse=True)
+    group_ids = group_ids.ravel()
+
+    # hash collisions are really unlikely, but check anyway
+    if not np.array_equal(rows, rows[first_idx][group_ids]):
+        groups, group_ids = np.unique(output_data, axis=0, return_inverse=True)
+        return groups, group_ids.ravel()
+
+    return output_data[first_idx], group_ids
 
 
 def get_groups(output_data):
     """
     Given a dataset of output variables, figure out how many
     distinct groups/categories occur, and create a dict that maps
-    each category (as a tuple) to indices where it is found
+    each category (as a tuple) to an array of indices where it is found
     """
-    group_to_idx = {}
 
-    for idx in range(output_data.shape[0]):
-        group = tuple(output_data[idx, :])
+    groups, group_ids = _unique_rows(output_data)
 
-        if group in group_to_idx:
-            group_to_idx[group].append(idx)
-        else:
-            group_to_idx[group] = [idx]
-    return group_to_idx
+    # numpy's stable sort is a radix sort for small ints, so this is O(n)
+    # and keeps each group's indices in ascending order
+    if groups.shape[0] < np.iinfo(np.int16).max:
+        group_ids = group_ids.astype(np.int16)
 
+    sorted_idx = np.argsort(group_ids, kind='stable')
+    group_sizes = np.bincount(group_ids, minlength=groups.shape[0])
+    group_idx = np.split(sorted_idx, np.cumsum(group_sizes)[:-1])
 
-def random_split_list(in_list, split_proportion):
-    """Randomly divide list into two parts"""
+    return {tuple(grp): idx for grp, idx in zip(groups, group_idx)}
+
+
+def random_split_list(idx, split_proportion):
+    """Randomly divide an index array into two parts"""
 
     if split_proportion >= 1.0 or split_proportion < 0.0:
         raise ValueError(
@@ -78,25 +118,415 @@ def random_split_list(in_list, split_proportion):
             'but you have {}'.format(split_proportion)
             )
 
-    cutpoint = int(len(in_list) * split_proportion)
-    random.shuffle(list(in_list))
+    idx = np.random.permutation(idx)
+    cutpoint = int(idx.shape[0] * split_proportion)
+
+    idx_0 = idx[cutpoint:]
+    idx_1 = idx[:cutpoint]
+    return idx_0, idx_1
+
+
+def concat_idx(idx_arrays):
+    """Join a bunch of index arrays into a single index array"""
+
+    idx_arrays = [np.asarray(idx, dtype=np.intp) for idx in idx_arrays]
+    if not idx_arrays:
+        return np.zeros((0,), dtype=np.intp)
+    return np.concatenate(idx_arrays)
+
+
+def deal_batches(group_idx, batch_size):
+    """Shuffle each index array in `group_idx` and deal it out across enough
+    batches to hold all of them, so every batch gets a share of every group"""
+
+    nsamp = sum([idx.shape[0] for idx in group_idx])
+    num_batches = int(np.ceil(nsamp / (1.0*batch_size)))
+    if not num_batches:
+        return
+
+    group_chunks = [
+        np.array_split(np.random.permutation(idx), num_batches)
+        for idx in group_idx
+    ]
+
+    for batch_num in range(num_batches):
+        yield concat_idx([chunks[batch_num] for chunks in group_chunks])
+
+
+def text_lengths(X, pad_idx, chunk_size=100000):
+    """Length of each encoded string in an int matrix, not counting the
+    padding at the end (trailing spaces encode the same as padding)"""
+
+    lengths = np.zeros((X.shape[0],), dtype=np.int32)
+    for start in range(0, X.shape[0], chunk_size):
+        not_pad = np.asarray(X[start:start + chunk_size]) != pad_idx
+        lengths[start:start + chunk_size] = np.where(
+            not_pad.any(axis=1),
+            X.shape[1] - np.argmax(not_pad[:, ::-1], axis=1),
+            0
+        )
+    return lengths
+
+
+def array_path(arr, data_dir, name):
+    """Path of an `.npy` file that holds `arr`, writing `<data_dir>/<name>.npy`
+    if it isn't already a memory-mapped `.npy` file"""
+
+    filename = getattr(arr, 'filename', None)
+    if isinstance(arr, np.memmap) and filename and filename.endswith('.npy'):
+        return filename
+
+    path = os.path.join(data_dir, '{}.npy'.format(name))
+    np.save(path, arr)
+    return path
+
+
+def open_array(path, dtype=None, shape=None):
+    """
+    Memory-map an array on disk (or a list of arrays if `path` is a list). `.npy`
+    files carry their own dtype and shape; raw binary files need a `dtype`, and a
+    `shape` unless they're 1d. Use `None` for the first dimension of `shape` to
+    infer the number of samples from the file size. Arrays that are already open
+    are passed through.
+    """
+
+    if isinstance(path, (list, tuple)):
+        return [open_array(i, dtype=dtype, shape=shape) for i in path]
+
+    if isinstance(path, np.ndarray):
+        return path
+
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+
+    if dtype is None:
+        raise ValueError('Need a dtype to memory-map raw binary file {}'.format(path))
+
+    if shape is not None and shape[0] is None:
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape[1:]))
+        shape = (os.path.getsize(path) // row_bytes,) + tuple(shape[1:])
+
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+def is_memmap(arr):
+    """True if `arr` (or any array in a list of arrays) is memory-mapped"""
+
+    if isinstance(arr, (list, tuple)):
+        return any(is_memmap(i) for i in arr)
+    return isinstance(arr, np.memmap)
+
+
+def write_shards(X, y, shard_dir, shard_size=100000):
+    """Split `X` and `y` into `.npz` shards of `shard_size` samples each, in the
+    format that `ShardedDatasetManager` reads
+    """
+
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    num_shards = int(np.ceil(X.shape[0] / (1.0 * shard_size)))
+    for shard_num in range(num_shards):
+        start = shard_num * shard_size
+        np.savez(
+            os.path.join(shard_dir, 'shard-{:06d}.npz'.format(shard_num)),
+            X=X[start:start + shard_size],
+            y=y[start:start + shard_size]
+        )
+
+    return num_shards
+
+
+class TextCorpus(object):
+    """
+    Random access to the lines of a (possibly huge) text file through
+    `mmap`. The file is scanned for newlines once and only the byte offset
+    of each line is kept in memory. Lines are decoded as UTF-8, with a
+    trailing carriage return removed
+    """
+
+    def __init__(self, path, chunk_size=2**26):
+
+        self.path = path
+        self._file = None
+        self._mmap = None
+
+        size = os.path.getsize(path)
+        if not size:
+            raise ValueError('Corpus file {} is empty'.format(path))
+
+        mm = self._open()
+        starts = [np.zeros((1,), dtype=np.int64)]
+        for pos in range(0, size, chunk_size):
+            chunk = np.frombuffer(mm, dtype=np.uint8, count=min(chunk_size, size - pos), offset=pos)
+            starts.append(np.flatnonzero(chunk == ord('\n')).astype(np.int64) + pos + 1)
+            del chunk
+
+        # offsets[i] is where line i starts and offsets[i + 1] - 1 is where it
+        # ends, counting a newline past the end of the file if it's missing
+        offsets = np.concatenate(starts)
+        if offsets[-1] == size:
+            self.offsets = offsets
+        else:
+            self.offsets = np.append(offsets, size + 1)
+
+        LOGGER.info('Corpus %s has %d lines', path, len(self))
+
+    def _open(self):
+        if self._mmap is None:
+            self._file = open(self.path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    @property
+    def shape(self):
+        """Number of lines, shaped like an array's shape"""
+
+        return (len(self),)
+
+    def byte_lengths(self):
+        """Length of each line in bytes"""
 
-    list_0 = in_list[cutpoint:]
-    list_1 = in_list[:cutpoint]
-    return list_0, list_1
+        return np.diff(self.offsets) - 1
 
+    def get_lines(self, idx):
+        """Read and decode the lines at the indices in `idx`"""
 
-def flatten_lists(list_of_lists):
-    """Recursively flatten a list of lists"""
+        mm = self._open()
+        lines = []
+        for line_num in idx:
+            line = mm[self.offsets[line_num]:self.offsets[line_num + 1] - 1]
+            lines.append(line.decode('utf-8', 'replace').rstrip('\r'))
+        return lines
 
-    if not isinstance(list_of_lists, Iterable):
-        return [list_of_lists]
+    def close(self):
+        """Close the memory-mapped file"""
 
-    flat = []
-    for item in list_of_lists:
-        flat.extend(flatten_lists(item))
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
 
-    return flat
+    def __getstate__(self):
+        # the mmap is reopened after unpickling, e.g., in another process
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_mmap'] = None
+        return state
+
+
+# output array that text encoding workers write into
+_ENCODE_OUT = None
+
+
+def _init_encode_worker(out_buffer, out_shape):
+    """Attach a text encoding worker to the shared output, which is either a
+    shared memory buffer or the path of a `.npy` file"""
+
+    global _ENCODE_OUT  # pylint: disable=global-statement
+
+    if isinstance(out_buffer, str):
+        _ENCODE_OUT = np.load(out_buffer, mmap_mode='r+')
+    else:
+        _ENCODE_OUT = np.frombuffer(out_buffer, dtype=np.int32).reshape(out_shape)
+
+
+def _encode_chunk(args):
+    """Encode a chunk of strings into rows of the shared output"""
+
+    start, strings, pad_len, good_chars = args
+    TextProcessor(good_chars=good_chars).strings_to_ints(
+        strings, pad_len,
+        out=_ENCODE_OUT[start:start + len(strings)]
+    )
+    if isinstance(_ENCODE_OUT, np.memmap):
+        _ENCODE_OUT.flush()
+
+
+def corpus_key(strings, pad_len, good_chars=None):
+    """Hash of a list of strings and the settings used to encode them"""
+
+    sha = hashlib.sha1()
+    for in_string in strings:
+        sha.update(in_string.encode('utf-8'))
+        sha.update(b'\0')
+    sha.update(repr((pad_len, good_chars)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def encode_strings(strings, pad_len, good_chars=None, num_workers=0, cache_dir=None,
+                   chunk_size=10000):
+    """
+    Encode a list of strings into an (num strings, pad_len) int32 matrix with
+    `TextProcessor.strings_to_ints`.
+
+    With `num_workers` > 1, chunks of `chunk_size` strings are encoded by a
+    process pool that writes straight into one shared array, which is
+    returned without copying. With `cache_dir`, the matrix is written to a
+    `.npy` file named after the hash of the strings, `pad_len` and
+    `good_chars`, and later calls with the same corpus just memory-map it
+    """
+
+    shape = (len(strings), pad_len)
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(
+            cache_dir,
+            'text-{}.npy'.format(corpus_key(strings, pad_len, good_chars=good_chars))
+        )
+        if os.path.exists(cache_path):
+            LOGGER.info('Loading encoded text from %s', cache_path)
+            return np.load(cache_path, mmap_mode='r')
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    ctx = multiprocessing.get_context('spawn')
+
+    out = None
+    out_buffer = None
+    if cache_path is not None:
+        out_buffer = cache_path[:-len('.npy')] + '-partial.npy'
+        out = np.lib.format.open_memmap(out_buffer, mode='w+', dtype=np.int32, shape=shape)
+    elif num_workers > 1:
+        out_buffer = ctx.RawArray('i', shape[0] * shape[1])
+        out = np.frombuffer(out_buffer, dtype=np.int32).reshape(shape)
+
+    if num_workers > 1 and shape[0]:
+        LOGGER.info('Encoding %d strings with %d workers', shape[0], num_workers)
+        proc_pool = ctx.Pool(
+            num_workers,
+            initializer=_init_encode_worker,
+            initargs=(out_buffer, shape)
+        )
+        try:
+            chunks = (
+                (start, strings[start:start + chunk_size], pad_len, good_chars)
+                for start in range(0, shape[0], chunk_size)
+            )
+            for _ in proc_pool.imap_unordered(_encode_chunk, chunks):
+                pass
+        finally:
+            proc_pool.close()
+            proc_pool.join()
+    else:
+        out = TextProcessor(good_chars=good_chars).strings_to_ints(strings, pad_len, out=out)
+
+    if cache_path is not None:
+        out.flush()
+        del out
+        os.rename(out_buffer, cache_path)
+        LOGGER.info('Saved encoded text to %s', cache_path)
+        out = np.load(cache_path, mmap_mode='r')
+
+    return out
+
+
+class BatchPrefetcher(object):
+    """
+    Iterate over batches that background threads assemble ahead of time.
+
+    `batch_idx_iter` generates the sample indices for each batch and
+    `gather_func` turns those indices into a batch of data. `num_workers`
+    threads run `gather_func` and keep up to `max_batches` batches waiting in a
+    bounded queue, so the gathers happen off of the training step's critical
+    path. Batches can come out in a different order than their indices went in.
+
+    If `gather_func` is None, `batch_idx_iter` already yields batches of data and
+    a single thread just reads ahead.
+    """
+
+    _DONE = object()
+
+    def __init__(self, batch_idx_iter, gather_func=None, num_workers=1, max_batches=2):
+
+        if gather_func is None:
+            num_workers = 1
+
+        self._idx_iter = iter(batch_idx_iter)
+        self._idx_lock = threading.Lock()
+        self._gather_func = gather_func
+
+        self._queue = Queue(maxsize=max(max_batches, 1))
+        self._stop = threading.Event()
+        self._num_workers = max(num_workers, 1)
+        self._num_done = 0
+        self._error = None
+
+        self._threads = []
+        for _ in range(self._num_workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_idx(self):
+        # generators aren't thread-safe, so workers take turns pulling indices
+        with self._idx_lock:
+            return next(self._idx_iter)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _work(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    batch_idx = self._next_idx()
+                except StopIteration:
+                    break
+
+                if self._gather_func is None:
+                    self._put(batch_idx)
+                else:
+                    self._put(self._gather_func(batch_idx))
+
+        except Exception as err:  # pylint: disable=broad-except
+            self._error = err
+
+        finally:
+            self._put(self._DONE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self._num_done < self._num_workers:
+            item = self._queue.get()
+
+            if item is self._DONE:
+                self._num_done += 1
+                if self._error is not None:
+                    err, self._error = self._error, None
+                    self.close()
+                    raise err
+                continue
+
+            return item
+
+        raise StopIteration
+
+    next = __next__
+
+    def close(self):
+        """Stop the worker threads. Iterating afterwards stops right away"""
+
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+        # stopped workers may not have queued their done markers
+        self._num_done = self._num_workers
 
 
 class DatasetManager(object):
@@ -114,6 +544,10 @@ class DatasetManager(object):
 
     The training method will use `get_batches` to pull samples of data out of this
     manager, so you'll want to redefine that for new datasets types
+
+    `X` and `y` can be memory-mapped arrays (see `from_npy`) for datasets that
+    don't fit in memory. Only the index arrays are kept in memory, and each batch
+    reads its rows from disk in sorted order
     """
 
     def __init__(self, X, y, categorical=False, holdout_prop=0.0):
@@ -137,12 +571,13 @@ class DatasetManager(object):
 
         self.groups = {}
         self.groups_holdout = {}
+        self._holdout_subset = None
 
         if categorical:
             self.groups = get_groups(self.y)
             LOGGER.info('Input has %d groups', len(self.groups))
         else:
-            self.groups = {None: range(X.shape[0])}
+            self.groups = {None: np.arange(X.shape[0])}
 
         for grp in self.groups:
             idx_list = self.groups[grp]
@@ -150,39 +585,291 @@ class DatasetManager(object):
             self.groups[grp] = idx_list0
             self.groups_holdout[grp] = idx_list1
 
-        self.nsamp_train = sum([len(g) for g in self.groups.values()])
-        self.nsamp_holdout = sum([len(g) for g in self.groups_holdout.values()])
+        self.nsamp_train = sum([g.shape[0] for g in self.groups.values()])
+        self.nsamp_holdout = sum([g.shape[0] for g in self.groups_holdout.values()])
         LOGGER.info('Num training samples %d', self.nsamp_train)
         LOGGER.info('Num holdout samples %d', self.nsamp_holdout)
 
+    @classmethod
+    def from_npy(cls, X_path, y_path, **kwargs):
+        """
+        Make a dataset manager for data stored on disk. `X_path` and `y_path`
+        are memory-mapped with `open_array`, or can be arrays that were already
+        opened (e.g., raw binary files opened with `open_array`)
+        """
+
+        return cls(open_array(X_path), open_array(y_path), **kwargs)
+
+    def _read_order(self, idx):
+        """Sort indices for memory-mapped data so batches are read sequentially"""
+
+        if is_memmap(self.X):
+            return np.sort(idx)
+        return idx
+
+    def get_batch_idx(self, pos_classes=None, batch_size=256, **kwargs):
+        """
+        Generate the sample indices for each training batch. Subclasses that
+        change how samples are batch'd should redefine this
+        """
+        return self.random_batch_idx(batch_size=batch_size)
+
     def get_batches(self, pos_classes=None, batch_size=256, **kwargs):
         """
         This function looks at whether you've sepcifid positive classes to figure
         out if you want balanced or stratified categorical sampling
         """
-        return self.random_batches(batch_size=batch_size)
+        for batch_idx in self.get_batch_idx(
+                pos_classes=pos_classes, batch_size=batch_size, **kwargs):
+            yield self._return_idx(batch_idx)
+
+    def prefetch_batches(self, pos_classes=None, batch_size=256,
+                         num_workers=1, max_batches=2, **kwargs):
+        """
+        Same batches as `get_batches`, but gathered ahead of time by `num_workers`
+        background threads and buffered in a queue of at most `max_batches`
+        """
+
+        return BatchPrefetcher(
+            self.get_batch_idx(pos_classes=pos_classes, batch_size=batch_size, **kwargs),
+            gather_func=self._return_idx,
+            num_workers=num_workers,
+            max_batches=max_batches
+        )
 
     def _return_idx(self, idx):
-        idx = [i for i in idx if i is not None]
-        if idx:
-            subset_X = np.take(self.X, idx, axis=0)
-            subset_y = np.take(self.y, idx, axis=0)
-            return subset_X, subset_y
+        idx = self._read_order(idx)
+        subset_X = np.take(self.X, idx, axis=0)
+        subset_y = np.take(self.y, idx, axis=0)
+        return subset_X, subset_y
+
+    def get_holdout_samples(self, num_samples=None):
+        """Return the holdout data, or a fixed random subset of `num_samples`
+        holdout samples"""
 
-    def get_holdout_samples(self):
-        """Return the holdout data"""
+        all_idx = concat_idx(self.groups_holdout.values())
+
+        if num_samples is not None and num_samples < all_idx.shape[0]:
+            subset_idx = self._holdout_subset
+            if subset_idx is None or subset_idx.shape[0] != num_samples:
+                subset_idx = np.sort(np.random.choice(all_idx, num_samples, replace=False))
+                self._holdout_subset = subset_idx
+            all_idx = subset_idx
 
-        all_idx = flatten_lists(self.groups_holdout.values())
         return self._return_idx(all_idx)
 
-    def random_batches(self, batch_size=256):
-        """Generate random batches of size`batch_size`"""
+    def random_batch_idx(self, batch_size=256):
+        """Generate indices for random batches of size `batch_size`"""
 
-        all_idx = flatten_lists(self.groups.values())
+        all_idx = concat_idx(self.groups.values())
 
         for batch_idx in random_chunk_generator(all_idx, batch_size):
+            yield batch_idx
+
+    def random_batches(self, batch_size=256):
+        """Generate random batches of size`batch_size`"""
+
+        for batch_idx in self.random_batch_idx(batch_size=batch_size):
             yield self._return_idx(batch_idx)
 
+    def as_tf_dataset(self, output_dtypes, pos_classes=None, batch_size=256,
+                      num_parallel_calls=None, prefetch=1):
+        """
+        Expose the training batches as a `tf.data.Dataset`. Batch indices are
+        generated in python, but gathering the samples for each batch happens in
+        a parallel map (`num_parallel_calls`) and `prefetch` batches are buffered
+        ahead of the training step.
+
+        Each element is a flat tuple of the input array(s) followed by the
+        output array, cast to `output_dtypes`
+        """
+
+        def _idx_generator():
+            for batch_idx in self.get_batch_idx(
+                    pos_classes=pos_classes, batch_size=batch_size):
+                if batch_idx.shape[0]:
+                    yield batch_idx.astype(np.int64)
+
+        def _gather(batch_idx):
+            X_batch, y_batch = self._return_idx(batch_idx)
+            if not isinstance(X_batch, list):
+                X_batch = [X_batch]
+
+            return [
+                np.asarray(arr, dtype=dtype.as_numpy_dtype)
+                for arr, dtype in zip(X_batch + [y_batch], output_dtypes)
+            ]
+
+        dataset = tf.data.Dataset.from_generator(
+            _idx_generator,
+            tf.int64,
+            tf.TensorShape([None])
+        )
+
+        dataset = dataset.map(
+            lambda batch_idx: tuple(
+                tf.py_func(_gather, [batch_idx], list(output_dtypes))
+            ),
+            num_parallel_calls=num_parallel_calls
+        )
+
+        return dataset.prefetch(prefetch)
+
+
+class ShardedDatasetManager(DatasetManager):
+    """
+    Stream a dataset that's split across a directory of `.npz` shards, each
+    holding an `X` and a `y` array (see `write_shards`). Shards are read one at
+    a time in a random order, and samples are shuffled approximately by mixing
+    each shard with a fixed-size buffer of leftover samples, so the dataset
+    never has to fit in memory.
+
+    Initialize with `X` as the shard directory, which lets this be used as a
+    model's `DATA_CLASS`; `y` is ignored. Holdout is done by holding out whole
+    shards, and at most `shuffle_buffer` holdout samples are used for scoring.
+    Stratified and balanced sampling aren't available when streaming.
+    """
+
+    SHARD_PATTERN = '*.npz'
+
+    def __init__(self, X, y=None, holdout_prop=0.0, shuffle_buffer=10000, **kwargs):
+
+        self.shard_dir = X
+        self.shuffle_buffer = shuffle_buffer
+
+        shards = np.array(sorted(glob.glob(os.path.join(X, self.SHARD_PATTERN))))
+        if not shards.shape[0]:
+            raise ValueError('No shards found in {}'.format(X))
+
+        LOGGER.info('Input data has %d shards', shards.shape[0])
+
+        if not holdout_prop:
+            holdout_prop = 0.0
+
+        self.shards, self.shards_holdout = random_split_list(shards, holdout_prop)
+
+        # a small holdout proportion of a few shards rounds down to nothing
+        if holdout_prop > 0.0 and not self.shards_holdout.shape[0]:
+            if self.shards.shape[0] > 1:
+                self.shards_holdout = self.shards[:1]
+                self.shards = self.shards[1:]
+            else:
+                LOGGER.warning('Only one shard, so no samples are held out')
+
+        self.groups = {}
+        self.groups_holdout = {}
+
+        self.nsamp_train = sum([self._shard_size(i) for i in self.shards])
+        self.nsamp_holdout = sum([self._shard_size(i) for i in self.shards_holdout])
+        LOGGER.info('Num training samples %d', self.nsamp_train)
+        LOGGER.info('Num holdout samples %d', self.nsamp_holdout)
+
+    @staticmethod
+    def _shard_size(shard):
+        with np.load(shard) as shard_data:
+            return shard_data['y'].shape[0]
+
+    @staticmethod
+    def _load_shard(shard):
+        with np.load(shard) as shard_data:
+            X_shard = shard_data['X']
+            y_shard = shard_data['y']
+
+        if len(y_shard.shape) == 1:
+            y_shard = y_shard.reshape(-1, 1)
+
+        return X_shard, y_shard
+
+    def get_batch_idx(self, pos_classes=None, batch_size=256, **kwargs):
+        """Streamed shards don't have random access by index"""
+        raise ValueError(
+            'Sharded datasets are streamed, so they',
+            "don't have batch indices; use `get_batches` instead"
+        )
+
+    def get_batches(self, pos_classes=None, batch_size=256, **kwargs):
+        """Stream approximately shuffled batches out of the training shards"""
+
+        buffer_X = None
+        buffer_y = None
+
+        for shard in np.random.permutation(self.shards):
+            X_shard, y_shard = self._load_shard(shard)
+
+            if buffer_X is not None:
+                X_shard = np.concatenate([buffer_X, X_shard])
+                y_shard = np.concatenate([buffer_y, y_shard])
+
+            order = np.random.permutation(X_shard.shape[0])
+            num_out = max(X_shard.shape[0] - self.shuffle_buffer, 0)
+            num_out -= num_out % batch_size
+
+            for start in range(0, num_out, batch_size):
+                batch_idx = order[start:start + batch_size]
+                yield X_shard[batch_idx], y_shard[batch_idx]
+
+            buffer_X = X_shard[order[num_out:]]
+            buffer_y = y_shard[order[num_out:]]
+
+        if buffer_X is not None:
+            for batch_idx in random_chunk_generator(np.arange(buffer_X.shape[0]), batch_size):
+                yield buffer_X[batch_idx], buffer_y[batch_idx]
+
+    def prefetch_batches(self, pos_classes=None, batch_size=256,
+                         num_workers=1, max_batches=2, **kwargs):
+        """Read batches ahead of time on a background thread"""
+
+        return BatchPrefetcher(
+            self.get_batches(batch_size=batch_size),
+            max_batches=max_batches
+        )
+
+    def get_holdout_samples(self, num_samples=None):
+        """Return up to `num_samples` (at most `shuffle_buffer`) samples from the
+        holdout shards"""
+
+        if num_samples is None or num_samples > self.shuffle_buffer:
+            num_samples = self.shuffle_buffer
+
+        if not self.shards_holdout.shape[0]:
+            X_shard, y_shard = self._load_shard(self.shards[0])
+            return X_shard[:0], y_shard[:0]
+
+        holdout_X = []
+        holdout_y = []
+        nsamp = 0
+        for shard in self.shards_holdout:
+            X_shard, y_shard = self._load_shard(shard)
+            holdout_X.append(X_shard[:num_samples - nsamp])
+            holdout_y.append(y_shard[:num_samples - nsamp])
+            nsamp += holdout_X[-1].shape[0]
+
+            if nsamp >= num_samples:
+                break
+
+        return np.concatenate(holdout_X), np.concatenate(holdout_y)
+
+    def as_tf_dataset(self, output_dtypes, pos_classes=None, batch_size=256,
+                      num_parallel_calls=None, prefetch=1):
+        """
+        Expose the streamed training batches as a `tf.data.Dataset`, with
+        `prefetch` batches buffered ahead of the training step
+        """
+
+        def _batch_generator():
+            for X_batch, y_batch in self.get_batches(batch_size=batch_size):
+                yield tuple(
+                    np.asarray(arr, dtype=dtype.as_numpy_dtype)
+                    for arr, dtype in zip([X_batch, y_batch], output_dtypes)
+                )
+
+        dataset = tf.data.Dataset.from_generator(
+            _batch_generator,
+            tuple(output_dtypes)
+        )
+
+        return dataset.prefetch(prefetch)
+
 
 class CategoricalDataManager(DatasetManager):
     """Turn categorical data into batches"""
@@ -194,34 +881,32 @@ class CategoricalDataManager(DatasetManager):
             holdout_prop=holdout_prop
         )
 
-    def get_batches(self, pos_classes=None, batch_size=256, **kwargs):
+    def get_batch_idx(self, pos_classes=None, batch_size=256, **kwargs):
         """
         This function looks at whether you've sepcifid positive classes to figure
         out if you want balanced or stratified categorical sampling
         """
 
         if pos_classes:
-            return self.balanced_batches(pos_classes=pos_classes, batch_size=batch_size)
+            return self.balanced_batch_idx(pos_classes=pos_classes, batch_size=batch_size)
 
-        return self.stratified_batches(batch_size=batch_size)
+        return self.stratified_batch_idx(batch_size=batch_size)
 
-    def balanced_batches(self, pos_classes=None, batch_size=256):
+    def balanced_batch_idx(self, pos_classes=None, batch_size=256):
         """
-        Generate batches where the groups listed in `pos_classes` occur with the
-        same frequency as all other classes combined. Useful in the case of 
+        Generate batch indices where the groups listed in `pos_classes` occur with
+        the same frequency as all other classes combined. Useful in the case of
         class imbalances.
         """
 
-        pos_samples = []
-        neg_samples = []
-
-        for g in self.groups:
-            if g in pos_classes:
-                pos_samples.extend(self.groups[g])
-            else:
-                neg_samples.extend(self.groups[g])
+        pos_samples = concat_idx([
+            self.groups[g] for g in self.groups if g in pos_classes
+        ])
+        neg_samples = concat_idx([
+            self.groups[g] for g in self.groups if g not in pos_classes
+        ])
 
-        size_diff = len(pos_samples) - len(neg_samples)
+        size_diff = pos_samples.shape[0] - neg_samples.shape[0]
         if size_diff > 0:
             neg_samples = pad_list(neg_samples, size_diff)
         elif size_diff < 0:
@@ -233,23 +918,28 @@ class CategoricalDataManager(DatasetManager):
             )
 
         for batch_idx_pair in sample_iterator:
-            batch_idx = flatten_lists(batch_idx_pair)
+            yield concat_idx(batch_idx_pair)
+
+    def balanced_batches(self, pos_classes=None, batch_size=256):
+        """
+        Generate batches where the groups listed in `pos_classes` occur with the
+        same frequency as all other classes combined. Useful in the case of 
+        class imbalances.
+        """
+
+        for batch_idx in self.balanced_batch_idx(
+                pos_classes=pos_classes, batch_size=batch_size):
             yield self._return_idx(batch_idx)
 
-    def stratified_batches(self, batch_size=256):
-        """Generate batches with stratified sampling of groups"""
+    def stratified_batch_idx(self, batch_size=256):
+        """Generate batch indices with stratified sampling of groups"""
 
-        num_batches = int(np.ceil(self.nsamp_train / (1.0*batch_size)))
+        return deal_batches(list(self.groups.values()), batch_size)
 
-        group_iters = {}
-        for grp in self.groups:
-            group_iters[grp] = random_chunk_generator(
-                self.groups[grp],
-                len(self.groups[grp]) // num_batches
-            )
+    def stratified_batches(self, batch_size=256):
+        """Generate batches with stratified sampling of groups"""
 
-        for _ in range(num_batches):
-            batch_idx = flatten_lists(map(next, group_iters.values()))
+        for batch_idx in self.stratified_batch_idx(batch_size=batch_size):
             yield self._return_idx(batch_idx)
 
 
@@ -270,22 +960,35 @@ class SiameseDataManager(CategoricalDataManager):
 
         self.X_1 = X_paired[1]
 
+    def _read_order(self, idx):
+        if is_memmap(self.X) or is_memmap(self.X_1):
+            return np.sort(idx)
+        return idx
+
     def _return_idx(self, idx):
-        idx = [i for i in idx if i is not None]
-        if idx:
-            subset_X = np.take(self.X, idx, axis=0)
-            subset_X_1 = np.take(self.X_1, idx, axis=0)
-            subset_y = np.take(self.y, idx, axis=0)
-            return [subset_X, subset_X_1], subset_y
+        idx = self._read_order(idx)
+        subset_X = np.take(self.X, idx, axis=0)
+        subset_X_1 = np.take(self.X_1, idx, axis=0)
+        subset_y = np.take(self.y, idx, axis=0)
+        return [subset_X, subset_X_1], subset_y
 
 
 class TextDataManager(CategoricalDataManager):
     """Class for handling text samples"""
 
-    def __init__(self, X, y, pad_len=128, holdout_prop=None, good_chars=None):
+    def __init__(self, X, y, pad_len=128, holdout_prop=None, good_chars=None,
+                 encode_workers=0, encode_cache=None, bucket_bounds=None):
         """Initialize this with X as a list of strings and y as a list of outputs
         can be initialized with X as a list of strings and y as a list of outputs
         or arrays like normal
+
+        Strings are encoded by `encode_strings`, with `encode_workers` processes
+        and cached in the `encode_cache` directory if it's set
+
+        With `bucket_bounds` (a list of lengths, e.g., [32, 64, 128]), samples
+        are grouped into buckets by the length of their string and each batch
+        comes from one bucket, cut down to that bucket's bound instead of the
+        full `pad_len`. The model has to take variable-length input
         """
 
         self.tp = TextProcessor(good_chars=good_chars)
@@ -294,10 +997,12 @@ class TextDataManager(CategoricalDataManager):
         string_input = both_inputs_are_lists and isinstance(X[0], str)
 
         if string_input:
-            X_in = np.vstack([
-                self.tp.string_to_ints(x, pad_len=pad_len)
-                for x in X
-            ])
+            X_in = encode_strings(
+                X, pad_len,
+                good_chars=good_chars,
+                num_workers=encode_workers,
+                cache_dir=encode_cache
+            )
             y = np.vstack(y)
 
         else:
@@ -308,6 +1013,123 @@ class TextDataManager(CategoricalDataManager):
             holdout_prop=holdout_prop
         )
 
+        self.bucket_bounds = None
+        self.buckets = None
+        if bucket_bounds:
+            self._set_buckets(
+                bucket_bounds, self.X.shape[1],
+                lambda: text_lengths(self.X, self.tp.pad_char_idx)
+            )
+
+    def _set_buckets(self, bucket_bounds, width, length_func):
+        """Put every sample in the length bucket of the smallest bound that
+        fits it (`width` is the largest bound)"""
+
+        self.bucket_bounds = np.unique(
+            [bound for bound in bucket_bounds if 0 < bound < width] + [width]
+        )
+
+        lengths = np.minimum(length_func(), width)
+        self.buckets = np.searchsorted(self.bucket_bounds, lengths).astype(np.int16)
+        LOGGER.info(
+            'Samples per length bucket: %s',
+            dict(zip(self.bucket_bounds.tolist(), np.bincount(
+                self.buckets, minlength=self.bucket_bounds.shape[0]).tolist()))
+        )
+
+    def get_batch_idx(self, pos_classes=None, batch_size=256, **kwargs):
+        """
+        Batches from one length bucket at a time if there are buckets (and no
+        `pos_classes`), stratified within each bucket
+        """
+
+        if self.bucket_bounds is None or pos_classes:
+            return super(TextDataManager, self).get_batch_idx(
+                pos_classes=pos_classes, batch_size=batch_size, **kwargs)
+
+        return self.bucketed_batch_idx(batch_size=batch_size)
+
+    def bucketed_batch_idx(self, batch_size=256):
+        """Generate batch indices where every batch is from one length bucket,
+        in a random order of buckets"""
+
+        batches = []
+        for bucket in range(self.bucket_bounds.shape[0]):
+            batches.extend(deal_batches(
+                [idx[self.buckets[idx] == bucket] for idx in self.groups.values()],
+                batch_size
+            ))
+
+        for batch_num in np.random.permutation(len(batches)):
+            yield batches[batch_num]
+
+    def _return_idx(self, idx):
+        subset_X, subset_y = super(TextDataManager, self)._return_idx(idx)
+
+        # cut off the padding past the longest sample's bucket bound
+        if self.bucket_bounds is not None and idx.shape[0]:
+            subset_X = subset_X[:, :self.bucket_bounds[self.buckets[idx].max()]]
+
+        return subset_X, subset_y
+
+
+class StreamingTextDataManager(TextDataManager):
+    """
+    Text samples read from a line-delimited corpus file instead of a list
+    of strings in memory.
+
+    Initialize with `X` as the path of the corpus (or a `TextCorpus`), one
+    sample per line, and `y` as the outputs for each line (an array, a list
+    of outputs, or the path of an `.npy` file). Only `y` and the byte offset
+    of each line are kept in memory. Each batch's lines are read through
+    `mmap` and encoded when the batch is made.
+
+    Length buckets (`bucket_bounds`) are assigned from each line's length in
+    bytes, which can differ a bit from its encoded length. Batches are still
+    cut to the bound that fits their longest encoded sample
+    """
+
+    def __init__(self, X, y, pad_len=128, holdout_prop=None, good_chars=None,
+                 bucket_bounds=None, **kwargs):
+
+        self.tp = TextProcessor(good_chars=good_chars)
+        self.pad_len = pad_len
+
+        corpus = X if isinstance(X, TextCorpus) else TextCorpus(X)
+
+        if isinstance(y, list):
+            y = np.vstack(y)
+        else:
+            y = open_array(y)
+
+        # skip TextDataManager's encoding of the whole input
+        super(TextDataManager, self).__init__(  # pylint: disable=bad-super-call
+            corpus, y,
+            holdout_prop=holdout_prop
+        )
+
+        self.bucket_bounds = None
+        self.buckets = None
+        if bucket_bounds:
+            self._set_buckets(bucket_bounds, pad_len, corpus.byte_lengths)
+
+    def _read_order(self, idx):
+        """Read lines in file order"""
+
+        return np.sort(idx)
+
+    def _return_idx(self, idx):
+        idx = self._read_order(idx)
+        subset_X = self.tp.strings_to_ints(self.X.get_lines(idx), self.pad_len)
+        subset_y = np.take(self.y, idx, axis=0)
+
+        if self.bucket_bounds is not None and idx.shape[0]:
+            max_len = text_lengths(subset_X, self.tp.pad_char_idx).max()
+            subset_X = subset_X[:, :self.bucket_bounds[
+                np.searchsorted(self.bucket_bounds, max_len)]]
+
+        return subset_X, subset_y
+
 
 class TimeseriesDataManager(DatasetManager):
     """Class for handling timeseries data"""
@@ -0,0 +1,66 @@
+"""Module has a lightweight loader for frozen inference graphs"""
+
+import os
+import json
+
+import numpy as np
+import tensorflow as tf
+
+from .tf_ops import iter_slices, num_samples
+
+
+class InferenceModel(object):
+    """
+    Load a frozen graph written by `ModelWrangler.export_inference` and run
+    predictions with it. This only needs the GraphDef file and the JSON file
+    next to it, not the model's code, params or checkpoints.
+    """
+
+    def __del__(self):
+        try:
+            self.sess.close()
+        except AttributeError:
+            pass
+
+    def __init__(self, graph_file, session_params=None):
+
+        graph_def = tf.GraphDef()
+        with open(graph_file, 'rb') as pb_file:
+            graph_def.ParseFromString(pb_file.read())
+
+        with open(os.path.splitext(graph_file)[0] + '.json', 'rt') as json_file:
+            io_names = json.load(json_file)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.input = [self.graph.get_tensor_by_name(name) for name in io_names['inputs']]
+        if len(self.input) == 1:
+            self.input = self.input[0]
+        self.output = self.graph.get_tensor_by_name(io_names['output'])
+
+        self.sess = tf.Session(graph=self.graph, config=session_params)
+
+    def _predict_batch(self, input_x):
+
+        if isinstance(self.input, list):
+            data_dict = dict(zip(self.input, input_x))
+        else:
+            data_dict = {self.input: input_x}
+
+        return self.sess.run(self.output, feed_dict=data_dict)
+
+    def predict(self, input_x, batch_size=None):
+        """Get model activations given an input matrix, input_x, pushing at most
+        `batch_size` samples through the graph at a time
+        """
+
+        # there are no batches to concatenate, so run the empty input as-is
+        if not num_samples(input_x):
+            return self._predict_batch(input_x)
+
+        return np.concatenate([
+            self._predict_batch(batch)
+            for batch in iter_slices(input_x, batch_size)
+        ])
@@ -0,0 +1,207 @@
+"""Module implements dynamic micro-batching for online predictions"""
+
+import sys
+import logging
+import asyncio
+import time
+from collections import deque
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+h = logging.StreamHandler(sys.stdout)
+h.setFormatter(
+    logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+)
+LOGGER.addHandler(h)
+LOGGER.setLevel(logging.DEBUG)
+
+
+def stack_samples(samples):
+    """Stack single samples into a batch. Samples for models with several
+    inputs are lists with one array per input"""
+
+    if isinstance(samples[0], (list, tuple)):
+        return [np.stack(parts) for parts in zip(*samples)]
+    return np.stack(samples)
+
+
+class MicroBatcher(object):
+    """
+    Coalesce concurrent single-sample predictions into batches.
+
+    Each call to `predict` queues one sample and waits for its result. A
+    collector task takes queued samples until it has `max_batch_size` of them
+    or `max_wait` seconds have passed since the first one arrived, runs
+    `predict_func` (e.g., `ModelWrangler.predict`) once on the whole batch in an
+    executor thread, and hands each caller back its own row of the output.
+    Samples that arrive while a batch is running go into the next batch.
+
+    Usage:
+        batcher = MicroBatcher(model.predict, max_batch_size=64, max_wait=0.002)
+        await batcher.start()
+        y = await batcher.predict(x)
+        ...
+        await batcher.stop()
+    """
+
+    def __init__(self, predict_func, max_batch_size=64, max_wait=0.002,
+                 executor=None, stats_window=10000):
+
+        self.predict_func = predict_func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = executor
+
+        self._queue = None
+        self._collector = None
+
+        self._latencies = deque(maxlen=stats_window)
+        self._batch_sizes = deque(maxlen=stats_window)
+        self._num_done = 0
+        self._start_time = None
+
+    async def start(self):
+        """Start the collector task on the running event loop"""
+
+        self._queue = asyncio.Queue()
+        self._start_time = time.time()
+        self._collector = asyncio.ensure_future(self._collect())
+
+    async def stop(self):
+        """Finish the queued predictions, then stop the collector task. New
+        predictions are refused, and any request that still ends up queued
+        behind the stop gets an error instead of waiting forever"""
+
+        collector, self._collector = self._collector, None
+        if collector is not None:
+            await self._queue.put(None)
+            await collector
+
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None and not item[1].done():
+                item[1].set_exception(RuntimeError('MicroBatcher was stopped'))
+
+    async def predict(self, input_x):
+        """Get model activations for a single sample"""
+
+        if self._collector is None:
+            raise ValueError('MicroBatcher is not running, call `start` first')
+
+        result = asyncio.get_event_loop().create_future()
+        await self._queue.put((input_x, result, time.time()))
+        return await result
+
+    async def _next_batch(self):
+        """Wait for a batch of queued requests. Returns the batch and whether
+        the batcher has been stopped"""
+
+        loop = asyncio.get_event_loop()
+
+        first = await self._queue.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if self._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self._queue.get_nowait()
+
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    async def _collect(self):
+
+        loop = asyncio.get_event_loop()
+
+        stopped = False
+        while not stopped:
+            batch, stopped = await self._next_batch()
+            if not batch:
+                continue
+
+            samples, results, start_times = zip(*batch)
+            try:
+                outputs = await loop.run_in_executor(
+                    self.executor,
+                    self.predict_func,
+                    stack_samples(samples)
+                )
+            except Exception as err:  # pylint: disable=broad-except
+                for result in results:
+                    if not result.cancelled():
+                        result.set_exception(err)
+                continue
+
+            end_time = time.time()
+            for result, output in zip(results, outputs):
+                if not result.cancelled():
+                    result.set_result(output)
+
+            self._latencies.extend(end_time - start_time for start_time in start_times)
+            self._batch_sizes.append(len(batch))
+            self._num_done += len(batch)
+
+    def stats(self):
+        """Latency percentiles (in seconds), throughput (samples/sec) and mean
+        batch size over recent predictions"""
+
+        if not self._latencies:
+            return {}
+
+        latencies = np.array(self._latencies)
+        return {
+            'p50_latency': float(np.percentile(latencies, 50)),
+            'p99_latency': float(np.percentile(latencies, 99)),
+            'throughput': self._num_done / (time.time() - self._start_time),
+            'mean_batch_size': float(np.mean(self._batch_sizes)),
+        }
+
+
+def load_test(predict_func, input_x, concurrency=64, **kwargs):
+    """Send every row of input_x through a `MicroBatcher` as a separate
+    request, with at most `concurrency` requests in flight, and return the
+    batcher's stats. Extra kwargs go to `MicroBatcher`"""
+
+    async def _run():
+        batcher = MicroBatcher(predict_func, **kwargs)
+        await batcher.start()
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _request(sample):
+            async with semaphore:
+                return await batcher.predict(sample)
+
+        await asyncio.gather(*[_request(sample) for sample in input_x])
+        await batcher.stop()
+        return batcher.stats()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        stats = loop.run_until_complete(_run())
+    finally:
+        loop.close()
+
+    LOGGER.info(
+        'p50 latency %0.2f ms, p99 latency %0.2f ms, %0.1f samples/sec, mean batch %0.1f',
+        1000 * stats['p50_latency'],
+        1000 * stats['p99_latency'],
+        stats['throughput'],
+        stats['mean_batch_size']
+    )
+    return stats
@@ -0,0 +1,198 @@
+"""Module implements a pool for serving lots of saved models from one process"""
+
+import sys
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+
+from .tf_ops import set_session_params, set_thread_params
+
+LOGGER = logging.getLogger(__name__)
+h = logging.StreamHandler(sys.stdout)
+h.setFormatter(
+    logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+)
+LOGGER.addHandler(h)
+LOGGER.setLevel(logging.DEBUG)
+
+
+def shared_session_params(num_threads=None, intra_op_threads=1, pool_name='modelwrangler_pool'):
+    """Session config for models that share one bounded inter-op thread pool.
+
+    Every session made with this config schedules its ops on the same global
+    pool of `num_threads` threads (default: all available cores) instead of
+    each starting its own, and runs each op on at most `intra_op_threads`
+    threads
+    """
+
+    return set_thread_params(
+        set_session_params(),
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=num_threads,
+        thread_pool=pool_name
+    )
+
+
+def model_bytes(model):
+    """Rough memory footprint of a loaded model: its variables plus its graph"""
+
+    variables = model.tf_mod.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+    var_bytes = sum(
+        int(np.prod(var.get_shape().as_list())) * var.dtype.base_dtype.size
+        for var in variables
+    )
+    return var_bytes + model.tf_mod.graph.as_graph_def().ByteSize()
+
+
+class ModelPool(object):
+    """
+    Registry of saved models that are loaded when they're first used and
+    share a bounded thread pool.
+
+    Models are registered by name with the path to their parameter JSON file,
+    loaded on the first `predict` call, and kept around until the pool goes
+    over its memory budget (in bytes), at which point the least recently used
+    models are evicted. An evicted model that's still running predictions in
+    other threads is only closed once they finish.
+    """
+
+    def __init__(self, memory_budget=None, num_threads=None, intra_op_threads=1):
+
+        self.memory_budget = memory_budget
+        self.session_params = shared_session_params(
+            num_threads=num_threads,
+            intra_op_threads=intra_op_threads
+        )
+
+        self.registry = {}
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+        # number of calls running on each model (by id), and evicted models
+        # that can't be closed until their calls finish
+        self._in_use = {}
+        self._retired = {}
+
+        # models being loaded (by name), set once the load is done or failed
+        self._loading = {}
+
+    def register(self, model_name, param_file, model_class):
+        """Add a saved model to the pool (it isn't loaded until it's used).
+        `model_class` is the model's ModelWrangler subclass, e.g.,
+        `DenseFeedforward`, which is needed to rebuild it"""
+
+        self.registry[model_name] = (param_file, model_class)
+
+    def memory_usage(self):
+        """Estimated bytes used by the models that are currently loaded"""
+
+        return sum(self._sizes.values())
+
+    def loaded_models(self):
+        """Names of loaded models, from least to most recently used"""
+
+        return list(self._models.keys())
+
+    def evict(self, model_name):
+        """Close a loaded model and free its memory (once it's not in use)"""
+
+        with self._lock:
+            model = self._models.pop(model_name)
+            self._sizes.pop(model_name)
+            if id(model) in self._in_use:
+                self._retired[id(model)] = model
+            else:
+                model.sess.close()
+        LOGGER.info('Evicted model %s', model_name)
+
+    def _get_model(self, model_name, claim=False):
+        """Get a loaded model (optionally marking it as in use), loading it
+        outside the pool lock so other models can keep serving meanwhile"""
+
+        while True:
+            with self._lock:
+                if model_name in self._models:
+                    model = self._models.pop(model_name)
+                    self._models[model_name] = model
+                    if claim:
+                        self._in_use[id(model)] = self._in_use.get(id(model), 0) + 1
+                    return model
+
+                if model_name not in self.registry:
+                    raise ValueError(
+                        'Model {} is not registered.'.format(model_name),
+                        'Registered models are: {}'.format(sorted(self.registry))
+                    )
+
+                loading = self._loading.get(model_name)
+                if loading is None:
+                    loading = self._loading[model_name] = threading.Event()
+                    break
+
+            # another thread is loading this model, so wait for it and retry
+            loading.wait()
+
+        try:
+            param_file, model_class = self.registry[model_name]
+            LOGGER.info('Loading model %s', model_name)
+            model = model_class.load(param_file, session_params=self.session_params)
+            model_size = model_bytes(model)
+
+            with self._lock:
+                self._models[model_name] = model
+                self._sizes[model_name] = model_size
+                if claim:
+                    self._in_use[id(model)] = self._in_use.get(id(model), 0) + 1
+
+                if self.memory_budget is not None:
+                    while len(self._models) > 1 and self.memory_usage() > self.memory_budget:
+                        self.evict(next(iter(self._models)))
+        finally:
+            with self._lock:
+                del self._loading[model_name]
+            loading.set()
+
+        return model
+
+    def get_model(self, model_name):
+        """Get a loaded model, loading it (and evicting others) if needed.
+        The model can be evicted by other threads while it's used, so use
+        `use` (or `predict`) instead when the pool is shared between threads"""
+
+        return self._get_model(model_name)
+
+    @contextmanager
+    def use(self, model_name):
+        """Context manager that gets a loaded model and keeps it from being
+        closed until the block is done"""
+
+        model = self._get_model(model_name, claim=True)
+
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self._in_use[id(model)] -= 1
+                if not self._in_use[id(model)]:
+                    del self._in_use[id(model)]
+                    retired = self._retired.pop(id(model), None)
+                    if retired is not None:
+                        retired.sess.close()
+
+    def predict(self, model_name, input_x, batch_size=None):
+        """Get activations from a model in the pool for an input matrix, input_x"""
+
+        with self.use(model_name) as model:
+            return model.predict(input_x, batch_size=batch_size)
+
+    def close(self):
+        """Close every loaded model"""
+
+        with self._lock:
+            for model_name in list(self._models):
+                self.evict(model_name)
@@ -4,12 +4,23 @@ import sys
 import os
 import logging
 import json
+import time
+import shutil
+import tempfile
+import multiprocessing
 
 import numpy as np
 import tensorflow as tf
 
-from .tf_ops import set_max_threads, set_session_params, make_data_dict
+from .tf_ops import (
+    set_thread_params, set_session_params, make_data_dict, available_cpus,
+    is_chunk_iterable, iter_slices, num_samples, optimize_inference_graph
+)
 from .tf_models import BaseNetwork
+from .dataset_managers import DatasetManager
+from .checkpointing import AsyncCheckpointer
+from .callbacks import CallbackList
+from .data_parallel import DataParallelTrainer
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
 
@@ -35,6 +46,12 @@ class ModelWrangler(object):
     """
 
     def __del__(self):
+        try:
+            if self._checkpointer is not None:
+                self._checkpointer.close()
+        except AttributeError:
+            pass
+
         try:
             self.sess.close()
         except AttributeError:
@@ -55,21 +72,68 @@ class ModelWrangler(object):
         initializer = tf.variables_initializer(
             self.tf_mod.graph.get_collection(
                 tf.GraphKeys.GLOBAL_VARIABLES
+                ) +
+            self.tf_mod.graph.get_collection(
+                tf.GraphKeys.LOCAL_VARIABLES
                 )
             )
         self.sess.run(initializer)
 
-    def __init__(self, model_class=BaseNetwork, **kwargs):
-        """Initialize a tensorflow model"""
+    def restore(self, checkpoint):
+        """Restore model weights from a checkpoint (skips the initializer)"""
+
+        self.tf_mod.saver.restore(self.sess, checkpoint)
+
+        local_vars = self.tf_mod.graph.get_collection(tf.GraphKeys.LOCAL_VARIABLES)
+        if local_vars:
+            self.sess.run(tf.variables_initializer(local_vars))
+
+    def __init__(self, model_class=BaseNetwork, restore_path=None, session_params=None,
+                 **kwargs):
+        """Initialize a tensorflow model
+
+        If `restore_path` points to a checkpoint, the weights are restored from it
+        instead of being randomly initialized. `session_params` is a
+        `tf.ConfigProto` for the model's session (default: built from the
+        `intra_op_threads`, `inter_op_threads` and `thread_pool` params)
+        """
 
-        self.session_params = set_max_threads(set_session_params())
         self.params = model_class.PARAM_CLASS(**kwargs)
+
+        if session_params is None:
+            session_params = set_thread_params(
+                set_session_params(),
+                intra_op_threads=self.params.intra_op_threads,
+                inter_op_threads=self.params.inter_op_threads,
+                thread_pool=self.params.thread_pool
+            )
+        self.session_params = session_params
         self.tf_mod = model_class(self.params)
         self.sess = self.new_session()
-        self.initialize()
+
+        if restore_path is None:
+            self.initialize()
+        else:
+            self.restore(restore_path)
+
+        self._metric_ops = {}
+        self._gradient_ops = {}
+        self._checkpointer = None
+
+        self.stop_training = False
 
     def save(self, iteration):
-        """Save model parameters in a JSON and model weights in TF format"""
+        """Save model parameters in a JSON and model weights in TF format
+
+        If the `async_save` param is set, the weights are snapshotted and written
+        out on a background thread. Use `wait_for_save` to block until it's done
+        """
+
+        if self.params.async_save:
+            if self._checkpointer is None:
+                self._checkpointer = AsyncCheckpointer(self)
+            self._checkpointer.save(iteration)
+            return
 
         path_parts = [
             os.path.join(self.params.path, self.params.name),
@@ -86,25 +150,110 @@ class ModelWrangler(object):
         self.params.meta_filename = '{}-{}'.format(*path_parts)
         self.params.save()
 
+    def set_learning_rate(self, learning_rate):
+        """Change the learning rate used by training steps"""
+
+        self.tf_mod.learning_rate.load(learning_rate, self.sess)
+        self.params.learning_rate = learning_rate
+
+    def wait_for_save(self):
+        """Block until any checkpoint being written in the background is done"""
+
+        if self._checkpointer is not None:
+            self._checkpointer.wait()
+
 
     @classmethod
-    def load(cls, param_file):
+    def load(cls, param_file, session_params=None):
         """restore a saved model given the path to a paramter JSON file"""
         # load model params
         with open(param_file, 'rt') as pfile:
             params = json.load(pfile)
 
-        # initialize a new model, restore its weights
-        new_model = cls(**params)
+        last_checkpoint = tf.train.latest_checkpoint(params['path'])
+        if last_checkpoint is None:
+            raise ValueError(
+                'No checkpoint found in {}'.format(params['path'])
+            )
 
-        last_checkpoint = tf.train.latest_checkpoint(new_model.params.path)
-        new_model.tf_mod.saver = tf.train.import_meta_graph(last_checkpoint + '.meta')
-        new_model.tf_mod.saver.restore(new_model.sess, last_checkpoint)
+        # build the model graph once and restore its weights directly
+        new_model = cls(
+            restore_path=last_checkpoint,
+            session_params=session_params,
+            **params
+        )
 
         return new_model
 
-    def predict(self, input_x):
-        """Get activations for every layer given an input matrix, input_x"""
+    def export_inference(self, export_path=None):
+        """
+        Export a frozen graph for serving. The graph is rebuilt with dropout and
+        batch normalization in inference mode, the trained weights are frozen
+        into constants, and everything that's only used for training (optimizer
+        slots, summaries, the saver, the `is_training` switch) is left out. Load
+        it with `modelwrangler.inference.InferenceModel`.
+
+        Writes a GraphDef file (default: `<path>/<name>-inference.pb`) with a
+        JSON file next to it listing the input/output tensor names, and returns
+        the GraphDef path
+        """
+
+        if export_path is None:
+            export_path = os.path.join(
+                self.params.path,
+                '{}-inference.pb'.format(self.params.name)
+            )
+
+        inference_mod = self.tf_mod.__class__(self.params, inference=True)
+
+        if isinstance(inference_mod.input, list):
+            in_layers = inference_mod.input
+        else:
+            in_layers = [inference_mod.input]
+
+        # copy the trained weights over to the inference graph by name
+        train_vars = {
+            var.op.name: var
+            for var in self.tf_mod.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        }
+        inference_vars = inference_mod.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        values = self.sess.run([train_vars[var.op.name] for var in inference_vars])
+
+        output_node = inference_mod.output.op.name
+        with tf.Session(graph=inference_mod.graph) as inference_sess:
+            for var, value in zip(inference_vars, values):
+                var.load(value, inference_sess)
+
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                inference_sess,
+                inference_mod.graph.as_graph_def(),
+                [output_node]
+            )
+
+        graph_def = optimize_inference_graph(
+            graph_def,
+            [layer.op.name for layer in in_layers],
+            [output_node]
+        )
+
+        LOGGER.info('Saving inference graph %s', export_path)
+        with open(export_path, 'wb') as graph_file:
+            graph_file.write(graph_def.SerializeToString())
+
+        with open(os.path.splitext(export_path)[0] + '.json', 'wt') as json_file:
+            json.dump(
+                {
+                    'inputs': [layer.name for layer in in_layers],
+                    'output': inference_mod.output.name,
+                },
+                json_file,
+                indent=4
+            )
+
+        return export_path
+
+    def _predict_batch(self, input_x):
+        """Run a single batch of inputs through the graph"""
 
         data_dict = make_data_dict(
             self.tf_mod,
@@ -117,121 +266,605 @@ class ModelWrangler(object):
 
         return vals
 
-    def score(self, input_x, target_y, score_func=None):
+    def tune_threads(self, input_x, batch_size=None, candidates=None, num_runs=10):
+        """
+        Find the fastest thread settings for predicting on batches of
+        `batch_size` samples from input_x.
+
+        `candidates` is a list of (intra_op_threads, inter_op_threads) pairs
+        (default: powers of 2 up to the number of available CPUs, with 1 or 2
+        inter-op threads). TensorFlow shares its thread pools across the whole
+        process, so each candidate is timed in a fresh process using a copy of
+        the current weights. The fastest setting is stored in the model params,
+        so it's saved with the model and used whenever the model is loaded, and
+        the model's session is rebuilt with it.
+
+        Returns a dict mapping each candidate to its median seconds per batch
+        """
+
+        if candidates is None:
+            num_cpus = available_cpus()
+            intra_counts = sorted(set(
+                [2 ** power for power in range(num_cpus.bit_length())] + [num_cpus]
+            ))
+            candidates = [
+                (intra, inter)
+                for intra in intra_counts
+                for inter in sorted(set([1, min(2, num_cpus)]))
+            ]
+
+        input_batch = next(iter_slices(input_x, batch_size))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            checkpoint = self.tf_mod.saver.save(self.sess, os.path.join(tmp_dir, 'tune'))
+            params_json = self.params.to_json()
+
+            ctx = multiprocessing.get_context('spawn')
+            timings = {}
+            for intra, inter in candidates:
+                proc_pool = ctx.Pool(1)
+                try:
+                    timings[(intra, inter)] = proc_pool.apply(
+                        _time_predict,
+                        (self.__class__, params_json, checkpoint, intra, inter,
+                         input_batch, num_runs)
+                    )
+                finally:
+                    proc_pool.close()
+                    proc_pool.join()
+
+                LOGGER.info(
+                    '%d intra-op / %d inter-op threads: %0.5f sec per batch',
+                    intra, inter, timings[(intra, inter)]
+                )
+
+            best_intra, best_inter = min(timings, key=timings.get)
+            LOGGER.info(
+                'Fastest setting: %d intra-op / %d inter-op threads',
+                best_intra, best_inter
+            )
+
+            self.params.intra_op_threads = best_intra
+            self.params.inter_op_threads = best_inter
+            self.session_params = set_thread_params(
+                set_session_params(),
+                intra_op_threads=best_intra,
+                inter_op_threads=best_inter,
+                thread_pool=self.params.thread_pool
+            )
+
+            # swap in a session that uses the new settings, with the same weights
+            old_sess = self.sess
+            self.sess = self.new_session()
+            self.restore(checkpoint)
+            old_sess.close()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return timings
+
+    def iter_predict(self, input_chunks, batch_size=None):
+        """Yield model activations for each chunk in an iterable of input chunks,
+        pushing at most `batch_size` samples through the graph at a time
+        """
+
+        for chunk in input_chunks:
+            yield self.predict(chunk, batch_size=batch_size)
+
+    def predict(self, input_x, batch_size=None, out=None):
+        """Get model activations given an input matrix, input_x
+
+        `input_x` can also be an iterable of input chunks (e.g., a generator
+        reading from disk). Set `batch_size` to push at most that many samples
+        through the graph per `sess.run`. Activations are written into `out`,
+        which can be a preallocated array (or `np.memmap`) or a filename for a
+        new .npy memmap
+        """
+
+        chunked = is_chunk_iterable(input_x)
+
+        if batch_size is None and out is None and not chunked:
+            return self._predict_batch(input_x)
+
+        if chunked:
+            if out is None:
+                chunk_preds = list(self.iter_predict(input_x, batch_size))
+                if not chunk_preds:
+                    raise ValueError(
+                        'Chunked input had no chunks, so the shape of',
+                        'the output is unknown'
+                    )
+                return np.concatenate(chunk_preds)
+
+            if isinstance(out, str):
+                raise ValueError(
+                    'Chunked inputs have an unknown number of samples, so `out`',
+                    'should be a preallocated array rather than a filename'
+                )
+
+            batches = (
+                batch
+                for chunk in input_x
+                for batch in iter_slices(chunk, batch_size)
+            )
+            nsamp = out.shape[0]
+        else:
+            batches = iter_slices(input_x, batch_size)
+            nsamp = num_samples(input_x)
+
+        offset = 0
+        for batch in batches:
+            vals = self._predict_batch(batch)
+
+            if out is None or isinstance(out, str):
+                out = self._make_output_buffer(out, nsamp, vals)
+
+            out[offset:offset + vals.shape[0]] = vals
+            offset += vals.shape[0]
+
+        # no batches (zero samples), so get the output shape from the graph
+        if out is None or isinstance(out, str):
+            out = self._make_output_buffer(out, 0, self._predict_batch(input_x))
+
+        if isinstance(out, np.memmap):
+            out.flush()
+
+        return out[:offset]
+
+    @staticmethod
+    def _make_output_buffer(filename, nsamp, first_vals):
+        """Preallocate an output array shaped like `nsamp` rows of `first_vals`,
+        backed by a .npy memmap if `filename` is given
+        """
+
+        shape = (nsamp,) + first_vals.shape[1:]
+
+        if filename is None:
+            return np.empty(shape, dtype=first_vals.dtype)
+
+        LOGGER.info('Writing predictions to %s', filename)
+        return np.lib.format.open_memmap(
+            filename,
+            mode='w+',
+            dtype=first_vals.dtype,
+            shape=shape
+        )
+
+    def _get_metric_op(self, score_func=None):
+        """Get the graph op for a scoring function, only adding it to the graph
+        the first time it's used
+        """
+
+        if score_func is None:
+            return self.tf_mod.loss
+
+        if score_func not in self._metric_ops:
+            with self.tf_mod.graph.as_default():
+                self._metric_ops[score_func] = score_func(
+                    self.tf_mod.output,
+                    self.tf_mod.target
+                )
+
+        return self._metric_ops[score_func]
+
+    def score(self, input_x, target_y, score_func=None, batch_size=None):
         """Measure model's current performance
         for a set of input_x and target_y using some scoring function
         `score_func` (defults to model loss function)
+
+        Set `batch_size` to score large datasets in batches, or pass an iterable
+        of (input_x, target_y) chunks as `input_x` to stream them. Batch scores
+        are averaged, weighted by batch size, which matches scoring everything at
+        once for scores that are means over samples (like the losses and
+        `accuracy` in tf_ops)
         """
 
-        data_dict = make_data_dict(
-            self.tf_mod,
-            input_x,
-            target_y,
-            is_training=False
-        )
+        score_op = self._get_metric_op(score_func)
 
-        if score_func is None:
-            score_func = self.tf_mod.loss
+        if batch_size is None and not is_chunk_iterable(input_x):
+            data_dict = make_data_dict(
+                self.tf_mod,
+                input_x,
+                target_y,
+                is_training=False
+            )
+            return self.sess.run(score_op, feed_dict=data_dict)
+
+        if is_chunk_iterable(input_x):
+            chunks = input_x
+        else:
+            chunks = [(input_x, target_y)]
+
+        total_score = 0.0
+        total_samples = 0
+        for x_chunk, y_chunk in chunks:
+            for x_batch, y_batch in zip(iter_slices(x_chunk, batch_size),
+                                        iter_slices(y_chunk, batch_size)):
+                data_dict = make_data_dict(
+                    self.tf_mod,
+                    x_batch,
+                    y_batch,
+                    is_training=False
+                )
+
+                batch_samples = num_samples(y_batch)
+                total_score += batch_samples * self.sess.run(score_op, feed_dict=data_dict)
+                total_samples += batch_samples
+
+        return total_score / max(total_samples, 1)
+
+    def _get_gradient_op(self, score_func=None):
+        """Get the ops for the gradient of a score with respect to each model
+        input, only adding them to the graph the first time they're used
+        """
+
+        if isinstance(self.tf_mod.input, list):
+            in_layers = self.tf_mod.input
         else:
+            in_layers = [self.tf_mod.input]
+
+        grad_key = (score_func, tuple(layer.name for layer in in_layers))
+
+        if grad_key not in self._gradient_ops:
+            score_op = self._get_metric_op(score_func)
             with self.tf_mod.graph.as_default():
-                score_func = score_func(self.tf_mod.output, self.tf_mod.target)
+                self._gradient_ops[grad_key] = tf.gradients(score_op, in_layers)
 
-        val = score_func.eval(feed_dict=data_dict, session=self.sess)
+        return self._gradient_ops[grad_key]
 
-        return val
+    def feature_importance(self, input_x, target_y, score_func=None, batch_size=None):
+        """Calculate feature importances as the mean squared gradient of a score
+        `score_func` (defaults to model loss function) with respect to the inputs
 
-    def feature_importance(self, input_x, target_y, score_func=None):
-        """Calculate feature importances"""
+        Set `batch_size`, or pass an iterable of (input_x, target_y) chunks as
+        `input_x`, to accumulate the gradients batch by batch with bounded memory.
+        Batch gradients are rescaled to match a single pass over all of the data
+        for scores that are means over samples
+        """
 
         # which layer has the features you care about?
         feature_layer_idx = 0
 
-        data_dict = make_data_dict(
-            self.tf_mod,
-            input_x,
-            target_y,
-            is_training=False
-        )
-
-        if score_func is None:
-            score_func = self.tf_mod.loss
+        grad_op = self._get_gradient_op(score_func)[feature_layer_idx]
 
-        grad_wrt_input = tf.gradients(
-            score_func,
-            self.tf_mod.input
-        )
+        if is_chunk_iterable(input_x):
+            chunks = input_x
+        else:
+            chunks = [(input_x, target_y)]
+
+        # The gradient of a mean score over a batch of b samples is b/N times
+        # the gradient over all N samples, so sum (b * grad)^2 and divide by N^3
+        sum_sq_grad = 0.0
+        total_samples = 0
+        for x_chunk, y_chunk in chunks:
+            for x_batch, y_batch in zip(iter_slices(x_chunk, batch_size),
+                                        iter_slices(y_chunk, batch_size)):
+                data_dict = make_data_dict(
+                    self.tf_mod,
+                    x_batch,
+                    y_batch,
+                    is_training=False
+                )
 
-        grad_wrt_input_vals = self.sess.run(
-            grad_wrt_input,
-            feed_dict=data_dict
-        )[feature_layer_idx]
+                batch_samples = num_samples(y_batch)
+                grad_vals = self.sess.run(grad_op, feed_dict=data_dict)
+                sum_sq_grad += np.sum(
+                    np.square(grad_vals.astype(np.float64) * batch_samples),
+                    axis=0,
+                    keepdims=True
+                )
+                total_samples += batch_samples
 
-        importance = np.mean(grad_wrt_input_vals**2, axis=0, keepdims=True)
+        importance = sum_sq_grad / float(max(total_samples, 1))**3
 
         return importance
 
 
-    def _run_epoch(self, sess, dataset, pos_classes):
-        """Run an epoch of training"""
+    def _run_epoch(self, sess, dataset, pos_classes, callbacks):
+        """Run an epoch of training, return the number of samples trained on"""
+
+        if self.params.data_workers:
+            batch_iterator = dataset.prefetch_batches(
+                pos_classes=pos_classes,
+                batch_size=self.params.batch_size,
+                num_workers=self.params.data_workers,
+                max_batches=self.params.prefetch_batches
+            )
+        else:
+            batch_iterator = dataset.get_batches(
+                pos_classes=pos_classes,
+                batch_size=self.params.batch_size
+            )
+
+        try:
+            return self._train_on_batches(sess, dataset, batch_iterator, callbacks)
+        finally:
+            batch_iterator.close()
+
+    def _time_to_evaluate(self, batch_counter, last_eval_time):
+        """Check whether it's time to log training/holdout scores, either every
+        `eval_every_seconds` or every `eval_every_batches` batches
+        """
+
+        if self.params.eval_every_seconds:
+            return time.time() - last_eval_time >= self.params.eval_every_seconds
+
+        return (batch_counter % self.params.eval_every_batches) == 0
+
+    def _log_scores(self, batch_counter, train_error, X_holdout, y_holdout):
+        """Log training and holdout scores, return how long it took"""
+
+        start_time = time.time()
+
+        LOGGER.info("Batch %d: Training score = %0.6f", batch_counter, train_error)
+
+        if num_samples(y_holdout):
+            holdout_error = self.score(
+                X_holdout, y_holdout,
+                batch_size=self.params.batch_size
+            )
+            LOGGER.info("Batch %d: Holdout score = %0.6f", batch_counter, holdout_error)
+
+        return time.time() - start_time
+
+    def _train_on_batches(self, sess, dataset, batch_iterator, callbacks):
+        """Run training steps over every batch in an iterator"""
 
-        batch_iterator = dataset.get_batches(
-            pos_classes=pos_classes,
-            batch_size=self.params.batch_size
+        X_holdout, y_holdout = dataset.get_holdout_samples(
+            num_samples=self.params.holdout_eval_size
         )
 
-        X_holdout, y_holdout = dataset.get_holdout_samples()
+        start_time = time.time()
+        last_eval_time = float('-inf')
+        eval_seconds = 0.0
 
         batch_counter = 0
-        for X_batch, y_batch in batch_iterator:
-
+        samp_counter = 0
+        while True:
+            callbacks.on_batch_begin(batch_counter)
+            step_time = time.time()
+
+            try:
+                X_batch, y_batch = next(batch_iterator)
+            except StopIteration:
+                break
+            logs = {'fetch_sec': time.time() - step_time}
+
+            step_time = time.time()
             data_dict = make_data_dict(
                 self.tf_mod,
                 X_batch,
                 y_batch,
                 is_training=True
             )
+            logs['feed_sec'] = time.time() - step_time
+
+            run_kwargs = callbacks.run_kwargs(batch_counter)
+            if self._time_to_evaluate(batch_counter, last_eval_time):
+                step_time = time.time()
+                _, tb_stats = sess.run(
+                    [self.tf_mod.train_step, self.tf_mod.tb_stats],
+                    feed_dict=data_dict,
+                    **run_kwargs
+                )
+                logs['run_sec'] = time.time() - step_time
 
-            sess.run(
-                self.tf_mod.train_step,
-                feed_dict=data_dict
-            )
-
-            if (batch_counter % 100) == 0:
+                step_time = time.time()
 
                 # Write training stats to tensorboard
-                self.tf_mod.tb_writer.add_summary(
-                    sess.run(self.tf_mod.tb_stats, feed_dict=data_dict),
-                    batch_counter
-                )
+                self.tf_mod.tb_writer.add_summary(tb_stats, batch_counter)
 
                 # logging elsewhere
                 train_error = self.score(X_batch, y_batch)
-                holdout_error = self.score(X_holdout, y_holdout)
-                LOGGER.info("Batch %d: Training score = %0.6f", batch_counter, train_error)
-                LOGGER.info("Batch %d: Holdout score = %0.6f", batch_counter, holdout_error)
+                eval_seconds += self._log_scores(
+                    batch_counter, train_error, X_holdout, y_holdout)
+                last_eval_time = time.time()
+
+                logs['log_sec'] = time.time() - step_time
+
+            else:
+                step_time = time.time()
+                sess.run(
+                    self.tf_mod.train_step,
+                    feed_dict=data_dict,
+                    **run_kwargs
+                )
+                logs['run_sec'] = time.time() - step_time
+
+            logs['batch_size'] = num_samples(X_batch)
+            logs['run_metadata'] = run_kwargs.get('run_metadata')
+            callbacks.on_batch_end(batch_counter, logs)
+
+            batch_counter += 1
+            samp_counter += logs['batch_size']
+
+        LOGGER.info(
+            'Spent %0.1f%% of the epoch scoring holdout data',
+            100.0 * eval_seconds / max(time.time() - start_time, 1e-9)
+        )
+
+        return samp_counter
+
+    def _make_data_init(self, dataset, pos_classes):
+        """Build the op that points the model's tf.data iterator at a dataset"""
+
+        with self.tf_mod.graph.as_default():
+            tf_dataset = dataset.as_tf_dataset(
+                self.tf_mod.data_iterator.output_types,
+                pos_classes=pos_classes,
+                batch_size=self.params.batch_size,
+                num_parallel_calls=self.params.data_workers or None,
+                prefetch=self.params.prefetch_batches
+            )
+            data_init = self.tf_mod.data_iterator.make_initializer(tf_dataset)
+
+        return data_init
+
+    def _run_epoch_tf_data(self, sess, dataset, data_init, callbacks):
+        """Run an epoch of training with batches pulled from the model's tf.data
+        iterator, return the number of samples trained on
+        """
+
+        X_holdout, y_holdout = dataset.get_holdout_samples(
+            num_samples=self.params.holdout_eval_size
+        )
+
+        sess.run(data_init)
+        train_dict = {self.tf_mod.is_training: True}
+
+        start_time = time.time()
+        last_eval_time = float('-inf')
+        eval_seconds = 0.0
+
+        batch_counter = 0
+        samp_counter = 0
+        while True:
+            callbacks.on_batch_begin(batch_counter)
+            run_kwargs = callbacks.run_kwargs(batch_counter)
+            logs = {}
+
+            try:
+                if self._time_to_evaluate(batch_counter, last_eval_time):
+                    step_time = time.time()
+                    _, batch_size, tb_stats, train_error = sess.run(
+                        [
+                            self.tf_mod.train_step,
+                            self.tf_mod.batch_size,
+                            self.tf_mod.tb_stats,
+                            self.tf_mod.loss
+                        ],
+                        feed_dict=train_dict,
+                        **run_kwargs
+                    )
+                    logs['run_sec'] = time.time() - step_time
+
+                    step_time = time.time()
+
+                    # Write training stats to tensorboard
+                    self.tf_mod.tb_writer.add_summary(tb_stats, batch_counter)
+
+                    # logging elsewhere
+                    eval_seconds += self._log_scores(
+                        batch_counter, train_error, X_holdout, y_holdout)
+                    last_eval_time = time.time()
+
+                    logs['log_sec'] = time.time() - step_time
+
+                else:
+                    step_time = time.time()
+                    _, batch_size = sess.run(
+                        [self.tf_mod.train_step, self.tf_mod.batch_size],
+                        feed_dict=train_dict,
+                        **run_kwargs
+                    )
+                    logs['run_sec'] = time.time() - step_time
+
+            except tf.errors.OutOfRangeError:
+                break
+
+            logs['batch_size'] = batch_size
+            logs['run_metadata'] = run_kwargs.get('run_metadata')
+            callbacks.on_batch_end(batch_counter, logs)
 
             batch_counter += 1
+            samp_counter += batch_size
+
+        LOGGER.info(
+            'Spent %0.1f%% of the epoch scoring holdout data',
+            100.0 * eval_seconds / max(time.time() - start_time, 1e-9)
+        )
+
+        return samp_counter
 
-    def train(self, input_x, target_y, pos_classes=None):
+    def train(self, input_x, target_y=None, pos_classes=None, callbacks=None):
         """
         Run a a bunch of training batches
         on the model using a bunch of input_x, target_y
+
+        `input_x` can also be a dataset manager that's already set up (e.g.,
+        one made with `DatasetManager.from_npy` for data on disk), in which
+        case `target_y` is ignored
+
+        `callbacks` is a list of `modelwrangler.callbacks.Callback` objects
+        whose hooks are called during training. A callback can end training
+        early by setting `stop_training` on the model, and callbacks that
+        save their own checkpoints (e.g., `BestCheckpoint`) turn off the
+        checkpoint at the end of every epoch
+
+        If the `train_workers` param is more than 1, training is spread over
+        that many processes that average their weights every `sync_every`
+        batches (see `modelwrangler.data_parallel.DataParallelTrainer`)
         """
 
-        dataset = self.tf_mod.DATA_CLASS(
-            input_x, target_y,
-            holdout_prop=self.params.holdout_prop
-        )
+        if isinstance(input_x, DatasetManager):
+            dataset = input_x
+        else:
+            dataset = self.tf_mod.DATA_CLASS(
+                input_x, target_y,
+                **{
+                    attr: getattr(self.params, attr)
+                    for attr in self.params.DATASET_MANAGER_PARAMS
+                }
+            )
+
+        callbacks = CallbackList(callbacks, model=self)
+
+        trainer = None
+        data_init = None
+        if self.params.train_workers > 1:
+            trainer = DataParallelTrainer(self, dataset, pos_classes)
+        elif self.tf_mod.data_iterator is not None:
+            data_init = self._make_data_init(dataset, pos_classes)
 
+        self.stop_training = False
+        callbacks.on_train_begin()
         try:
             for epoch in range(self.params.num_epochs):
                 LOGGER.info('Starting Epoch %d', epoch)
-                self._run_epoch(self.sess, dataset, pos_classes)
-                self.save(epoch)
+                callbacks.on_epoch_begin(epoch)
+                start_time = time.time()
+
+                if trainer is not None:
+                    nsamp = trainer.run_epoch()
+                elif data_init is None:
+                    nsamp = self._run_epoch(self.sess, dataset, pos_classes, callbacks)
+                else:
+                    nsamp = self._run_epoch_tf_data(self.sess, dataset, data_init, callbacks)
+
+                samples_per_sec = nsamp / (time.time() - start_time)
+                LOGGER.info(
+                    'Epoch %d: %0.1f samples/sec (%s)',
+                    epoch, samples_per_sec, self.params.data_pipeline
+                )
+                if not callbacks.handles_checkpoints:
+                    self.save(epoch)
+
+                epoch_logs = {'samples_per_sec': samples_per_sec}
+                if callbacks.callbacks:
+                    X_holdout, y_holdout = dataset.get_holdout_samples(
+                        num_samples=self.params.holdout_eval_size
+                    )
+                    if num_samples(y_holdout):
+                        epoch_logs['holdout_score'] = self.score(
+                            X_holdout, y_holdout,
+                            batch_size=self.params.batch_size
+                        )
+
+                callbacks.on_epoch_end(epoch, epoch_logs)
+                if self.stop_training:
+                    LOGGER.info('Stopping training after epoch %d', epoch)
+                    break
 
         except KeyboardInterrupt:
             print('Force exiting training.')
 
+        finally:
+            if trainer is not None:
+                trainer.close()
+            self.wait_for_save()
+            callbacks.on_train_end()
+
     def get_from_model(self, name_to_find):
         """Return a piece of the model by it's name"""
 
@@ -247,3 +880,25 @@ class ModelWrangler(object):
         value_item = self.sess.run(tensor_item)
         return value_item
 
+
+def _time_predict(wrangler_class, params_json, checkpoint, intra_op_threads,
+                  inter_op_threads, input_batch, num_runs):
+    """Time predictions with the given thread settings (run in a fresh process
+    by `ModelWrangler.tune_threads`). Returns median seconds per batch"""
+
+    params = json.loads(params_json)
+    params['intra_op_threads'] = intra_op_threads
+    params['inter_op_threads'] = inter_op_threads
+
+    model = wrangler_class(restore_path=checkpoint, **params)
+
+    # the first run sets up thread pools and buffers, so it isn't timed
+    model.predict(input_batch)
+
+    timings = []
+    for _ in range(num_runs):
+        start_time = time.time()
+        model.predict(input_batch)
+        timings.append(time.time() - start_time)
+
+    return float(np.median(timings))
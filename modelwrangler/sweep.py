@@ -0,0 +1,245 @@
+"""Module implements parallel hyperparameter sweeps with successive halving"""
+
+import sys
+import os
+import csv
+import time
+import random
+import logging
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from .tf_ops import available_cpus
+from .dataset_managers import array_path
+
+LOGGER = logging.getLogger(__name__)
+h = logging.StreamHandler(sys.stdout)
+h.setFormatter(
+    logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+)
+LOGGER.addHandler(h)
+LOGGER.setLevel(logging.DEBUG)
+
+
+def _save_data(arr, data_dir, name):
+    """Save an array (or list of arrays) as `.npy` files, return the paths"""
+
+    if isinstance(arr, (list, tuple)):
+        return [
+            array_path(part, data_dir, '{}_{}'.format(name, idx))
+            for idx, part in enumerate(arr)
+        ]
+    return array_path(arr, data_dir, name)
+
+
+def _run_trial(wrangler_class, trial_name, trial_path, params, data_paths,
+               num_epochs, param_file, score_func, seed):
+    """Train a trial for `num_epochs` more epochs (run in a worker process by
+    `HyperparameterSweep`), resuming it from `param_file` if that's given.
+    Returns its holdout score, training time and params file"""
+
+    start_time = time.time()
+
+    # same seed for every trial, so they all get the same holdout split
+    np.random.seed(seed)
+    random.seed(seed)
+
+    if param_file is not None:
+        model = wrangler_class.load(param_file)
+        model.params.num_epochs = num_epochs
+    else:
+        model = wrangler_class(
+            name=trial_name,
+            path=trial_path,
+            num_epochs=num_epochs,
+            **params
+        )
+
+    X_path, y_path = data_paths
+    dataset = model.tf_mod.DATA_CLASS.from_npy(
+        X_path, y_path,
+        holdout_prop=model.params.holdout_prop
+    )
+    model.train(dataset)
+
+    X_holdout, y_holdout = dataset.get_holdout_samples()
+    if not y_holdout.shape[0]:
+        X_holdout, y_holdout = next(dataset.get_batches(batch_size=model.params.batch_size))
+
+    score = model.score(
+        X_holdout, y_holdout,
+        score_func=score_func,
+        batch_size=model.params.batch_size
+    )
+    return float(score), time.time() - start_time, model.params.params_filename()
+
+
+class HyperparameterSweep(object):
+    """
+    Search over model params by training trials in parallel processes.
+
+    `search_space` maps param names (any of the model's params, e.g.,
+    `hidden_nodes` or `learning_rate`) to lists of values to try. Every
+    combination is a trial, or a random subset of `num_trials` of them.
+    `base_params` are passed to every trial.
+
+    Trials run `num_procs` at a time, each in a fresh process limited to
+    `threads_per_trial` threads. The dataset is saved once to `.npy` files in
+    `sweep_dir` and memory-mapped read-only by every trial.
+
+    Successive halving: every trial is trained for `min_epochs` epochs, then
+    the best 1/`eta` of them (by holdout score) are resumed from their
+    checkpoints and trained until they've had `eta` times as many epochs, and
+    so on until one trial is left or `max_epochs` is reached. Scores are the
+    model's loss, or `score_func` (e.g., `tf_ops.accuracy`) if it's given, and
+    lower is better unless `mode` is 'max'.
+
+    Every trial's score at every round goes into `<sweep_dir>/results.csv`.
+    """
+
+    def __init__(self, wrangler_class, search_space, base_params=None, num_trials=None,
+                 num_procs=None, threads_per_trial=None, min_epochs=1, max_epochs=None,
+                 eta=3, mode='min', score_func=None, sweep_dir='./sweep', seed=0):
+
+        if mode not in ['min', 'max']:
+            raise ValueError(
+                'mode should be `min` or `max`,',
+                'but you have {}'.format(mode)
+            )
+
+        if eta < 2:
+            raise ValueError(
+                'eta should be at least 2,',
+                'but you have {}'.format(eta)
+            )
+
+        self.wrangler_class = wrangler_class
+        self.search_space = search_space
+        self.base_params = base_params or {}
+
+        if num_procs is None:
+            num_procs = max(1, available_cpus() // (threads_per_trial or 1))
+        if threads_per_trial is None:
+            threads_per_trial = max(1, available_cpus() // num_procs)
+        self.num_procs = num_procs
+        self.threads_per_trial = threads_per_trial
+
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.eta = eta
+        self.mode = mode
+        self.score_func = score_func
+        self.sweep_dir = sweep_dir
+        self.seed = seed
+
+        self.trials = self._make_trials(num_trials)
+        self.results = []
+
+    def _make_trials(self, num_trials):
+        """List of (trial name, params) for each trial"""
+
+        names = sorted(self.search_space)
+        combos = list(itertools.product(*[self.search_space[name] for name in names]))
+
+        if num_trials is not None and num_trials < len(combos):
+            combos = random.Random(self.seed).sample(combos, num_trials)
+
+        return [
+            ('trial_{:03d}'.format(idx), dict(zip(names, combo)))
+            for idx, combo in enumerate(combos)
+        ]
+
+    def _trial_params(self, params):
+        trial_params = dict(self.base_params)
+        trial_params.update(params)
+        trial_params['intra_op_threads'] = self.threads_per_trial
+        trial_params['inter_op_threads'] = 1
+        return trial_params
+
+    def _write_results(self):
+
+        param_names = sorted(self.search_space)
+        with open(os.path.join(self.sweep_dir, 'results.csv'), 'wt') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['trial', 'round', 'epochs', 'score', 'train_sec'] + param_names)
+            for row in self.results:
+                writer.writerow(
+                    [row['trial'], row['round'], row['epochs'], row['score'], row['train_sec']] +
+                    [row['params'][name] for name in param_names]
+                )
+
+    def run(self, input_x, target_y):
+        """Run the sweep, return (name, params, score) of the best trial"""
+
+        data_dir = os.path.join(self.sweep_dir, 'data')
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+
+        data_paths = (
+            _save_data(input_x, data_dir, 'X'),
+            _save_data(target_y, data_dir, 'y')
+        )
+
+        trial_params = dict(self.trials)
+        param_files = dict((name, None) for name, _ in self.trials)
+        survivors = [name for name, _ in self.trials]
+        epochs_done = 0
+        epochs_total = self.min_epochs
+        round_num = 0
+
+        ctx = multiprocessing.get_context('spawn')
+        while True:
+            LOGGER.info(
+                'Round %d: training %d trials up to %d epochs',
+                round_num, len(survivors), epochs_total
+            )
+
+            # a fresh process per trial so each one gets its own thread pools
+            proc_pool = ctx.Pool(self.num_procs, maxtasksperchild=1)
+            try:
+                jobs = {
+                    name: proc_pool.apply_async(
+                        _run_trial,
+                        (
+                            self.wrangler_class, name,
+                            os.path.join(self.sweep_dir, name),
+                            self._trial_params(trial_params[name]),
+                            data_paths, epochs_total - epochs_done,
+                            param_files[name], self.score_func, self.seed
+                        )
+                    )
+                    for name in survivors
+                }
+                scores = {}
+                for name in survivors:
+                    scores[name], train_sec, param_files[name] = jobs[name].get()
+                    self.results.append({
+                        'trial': name,
+                        'round': round_num,
+                        'epochs': epochs_total,
+                        'score': scores[name],
+                        'train_sec': train_sec,
+                        'params': trial_params[name],
+                    })
+                    LOGGER.info('%s: score %0.6f after %d epochs', name, scores[name], epochs_total)
+            finally:
+                proc_pool.close()
+                proc_pool.join()
+
+            self._write_results()
+
+            survivors = sorted(survivors, key=scores.get, reverse=(self.mode == 'max'))
+            num_keep = len(survivors) // self.eta
+            next_epochs = epochs_total * self.eta
+            if num_keep < 1 or (self.max_epochs is not None and next_epochs > self.max_epochs):
+                break
+
+            survivors = survivors[:num_keep]
+            epochs_done, epochs_total = epochs_total, next_epochs
+            round_num += 1
+
+        best = survivors[0]
+        LOGGER.info('Best trial %s: %s (score %0.6f)', best, trial_params[best], scores[best])
+        return best, trial_params[best], scores[best]
@@ -7,7 +7,7 @@ import json
 
 import tensorflow as tf
 
-from .tf_ops import loss_sigmoid_ce
+from .tf_ops import loss_sigmoid_ce, reroute_with_default
 
 
 from .dataset_managers import (
@@ -71,7 +71,20 @@ class BaseNetworkParams(dict):
         "tb_log_path": "",
         "batch_size": 256,
         "num_epochs": 3,
-        "learning_rate": 0.0001
+        "learning_rate": 0.0001,
+        "data_pipeline": "feed_dict",
+        "prefetch_batches": 2,
+        "data_workers": 0,
+        "async_save": False,
+        "eval_every_batches": 100,
+        "eval_every_seconds": None,
+        "holdout_eval_size": None,
+        "intra_op_threads": None,
+        "inter_op_threads": None,
+        "thread_pool": None,
+        "train_workers": 0,
+        "sync_every": 1,
+        "sync_timeout": 600,
     }
 
     # default values for model-specific attributes
@@ -105,27 +118,40 @@ class BaseNetworkParams(dict):
         self.tb_log_path = os.path.join(self.path, 'tb_log')
 
         make_dir(self.path)
-        make_dir(self.tb_log_path)
 
         for attr in self.LAYER_PARAM_TYPES:
             new_attr = self.LAYER_PARAM_TYPES[attr](**getattr(self, attr))
             setattr(self, attr, new_attr)
 
-    def save(self):
-        """save model params to JSON"""
+    def params_filename(self):
+        """Path of the JSON file that model params are saved to"""
 
-        make_dir(self.path)
+        return os.path.join(self.path, '-'.join([self.name, 'params.json']))
 
-        params_fname = os.path.join(self.path, '-'.join([self.name, 'params.json']))
-        LOGGER.info('Saving parameter file %s', params_fname)
+    def to_json(self):
+        """Serialize model params to a JSON string"""
 
-        dict_to_dump = vars(self)
+        dict_to_dump = dict(vars(self))
         for key in dict_to_dump:
             if issubclass(dict_to_dump[key].__class__, LayerConfig):
                 dict_to_dump[key] = dict_to_dump[key].__dict__
 
+        return json.dumps(dict_to_dump, indent=4)
+
+    def save(self, params_json=None):
+        """save model params to JSON (`params_json` can be an earlier snapshot
+        from `to_json`)"""
+
+        make_dir(self.path)
+
+        params_fname = self.params_filename()
+        LOGGER.info('Saving parameter file %s', params_fname)
+
+        if params_json is None:
+            params_json = self.to_json()
+
         with open(params_fname, 'wt') as json_file:
-            json.dump(dict_to_dump, json_file, indent=4)
+            json_file.write(params_json)
 
 
 class BaseNetwork(object):
@@ -190,12 +216,56 @@ class BaseNetwork(object):
 
         return train_step
 
+    def setup_data_iterator(self):
+        """Set up a `tf.data` iterator that feeds the input and target layers
+        directly, so training steps don't need a feed_dict. The input and target
+        can still be fed as usual when scoring or predicting.
+        """
+
+        if isinstance(self.input, list):
+            in_layers = list(self.input)
+        else:
+            in_layers = [self.input]
+
+        placeholders = in_layers + [self.target]
+
+        iterator = tf.data.Iterator.from_structure(
+            tuple(layer.dtype for layer in placeholders),
+            tuple(layer.get_shape() for layer in placeholders)
+        )
+
+        feedable = [
+            reroute_with_default(layer, next_layer)
+            for layer, next_layer in zip(placeholders, iterator.get_next())
+        ]
+
+        if isinstance(self.input, list):
+            self.input = feedable[:-1]
+        else:
+            self.input = feedable[0]
+        self.target = feedable[-1]
+
+        self.batch_size = tf.shape(self.target)[0]
+
+        return iterator
+
     def setup_tensorboard_tracking(self, tb_log_path):
         """Set up summary stats to track in tensorboard"""
 
         tf.summary.scalar('training_loss', self.loss)
-        tb_writer = tf.summary.FileWriter(tb_log_path, self.graph)
-        return tb_writer
+        self._tb_log_path = tb_log_path
+        self._tb_writer = None
+
+    @property
+    def tb_writer(self):
+        """Tensorboard summary writer. It's created the first time it's used, so
+        models that are only loaded to make predictions don't write event files
+        """
+
+        if self._tb_writer is None:
+            make_dir(self._tb_log_path)
+            self._tb_writer = tf.summary.FileWriter(self._tb_log_path, self.graph)
+        return self._tb_writer
 
     def _make_batchnorm(self, input_layer, name):
         """Wrap batchnormalization around a layer"""
@@ -377,6 +447,12 @@ class BaseNetwork(object):
                 input_layer, num_units, '_'.join(name_stack), layer_config)
         ]
 
+        return self._finish_conv_layer(layer_stack, name_stack, layer_config)
+
+    def _finish_conv_layer(self, layer_stack, name_stack, layer_config):
+        """Add the (optional) batch normalization, pooling and dropout that
+        follow a convolution"""
+
         # adding batch normalization
         if layer_config.batchnorm:
             name_stack.append('batchnorm')
@@ -403,6 +479,75 @@ class BaseNetwork(object):
 
         return layer_stack[-1]
 
+    def make_gather_conv_layer(self, int_layer, depth, num_units, label, layer_config):
+        """ Make a 1-D convolutional layer on integer inputs that gives the
+        same result as one-hot encoding them (to `depth`) and then running
+        `make_conv_layer`, without making the one-hot tensor.
+
+        A convolution over one-hot vectors just picks one row of each kernel
+        tap for every position, so the rows are gathered for each position
+        and the taps are shifted and added up. The kernel and bias are the
+        same variables `make_conv_layer` makes, so checkpoints work with
+        either layer. The input length can be dynamic
+        """
+
+        if isinstance(layer_config, dict):
+            layer_config = ConvLayerConfig(**layer_config)
+
+        assert isinstance(layer_config, ConvLayerConfig)
+
+        if layer_config.dim != 1:
+            raise ValueError(
+                'Gather convolutions only work in 1-D,',
+                'but you have {}-D conv params'.format(layer_config.dim)
+            )
+
+        kernel_size = layer_config.kernel
+        if isinstance(kernel_size, (list, tuple)):
+            kernel_size = kernel_size[0]
+
+        strides = layer_config.strides
+        if isinstance(strides, (list, tuple)):
+            strides = strides[0]
+
+        with tf.variable_scope(label):
+            kernel = tf.get_variable(
+                'kernel',
+                shape=[kernel_size, depth, num_units],
+                initializer=tf.glorot_uniform_initializer()
+            )
+            bias = tf.get_variable(
+                'bias',
+                shape=[num_units],
+                initializer=tf.zeros_initializer()
+            )
+
+            # taps[:, t, j, :] is kernel tap j applied to the character at t
+            taps = tf.gather(
+                tf.transpose(kernel, [1, 0, 2]),
+                tf.to_int32(int_layer)
+            )
+
+            # 'same' padding, like tf.layers.conv1d
+            in_len = int_layer.get_shape()[1].value
+            if in_len is None:
+                in_len = tf.shape(int_layer)[1]
+                out_len = (in_len + strides - 1) // strides
+                pad_total = tf.maximum((out_len - 1) * strides + kernel_size - in_len, 0)
+            else:
+                out_len = (in_len + strides - 1) // strides
+                pad_total = max((out_len - 1) * strides + kernel_size - in_len, 0)
+            pad_left = pad_total // 2
+
+            taps = tf.pad(taps, [[0, 0], [pad_left, pad_total - pad_left], [0, 0], [0, 0]])
+            conv_layer = tf.add_n([
+                taps[:, tap:tap + (out_len - 1) * strides + 1:strides, tap, :]
+                for tap in range(kernel_size)
+            ]) + bias
+
+        name_stack = [label]
+        return self._finish_conv_layer([conv_layer], name_stack, layer_config)
+
     def make_deconv_layer(self, input_layer, num_units, label, layer_config):
         """ Make a convolutional network layer
 
@@ -477,6 +622,35 @@ class BaseNetwork(object):
 
         return onehot_layer
 
+    @staticmethod
+    def make_embedding_layer(in_layer, max_int, embed_size, name):
+        """Return a layer that looks up a trainable embedding for each
+        integer in an int layer
+
+        Args:
+            in_layer: A layer consisting of integer values
+            max_int: The number of distinct integers
+            embed_size: The size of each embedding vector
+            name: Name of the embedding variable's scope
+
+        Returns:
+            a new layer with an embedding vector in place of each integer
+        """
+
+        with tf.variable_scope(name):
+            embeddings = tf.get_variable(
+                'embeddings',
+                shape=[max_int, embed_size],
+                initializer=tf.glorot_uniform_initializer()
+            )
+
+        embed_layer = tf.nn.embedding_lookup(
+            embeddings,
+            tf.to_int32(in_layer)
+        )
+
+        return embed_layer
+
     @staticmethod
     def make_onehot_decode_layer(in_layer):
         """Return a layer takes one-hot encoded layer to int
@@ -490,17 +664,41 @@ class BaseNetwork(object):
         out_layer = tf.argmax(in_layer, axis=-1)
         return out_layer
 
-    def __init__(self, params):
-        """Initialize a tensorflow model"""
+    def __init__(self, params, inference=False):
+        """Initialize a tensorflow model
+
+        With `inference` set, only the layers are built, with dropout and batch
+        normalization fixed in their inference behavior (no `is_training`
+        switch, training step, tensorboard summaries or saver)
+        """
 
         self.graph = tf.Graph()
 
         with self.graph.as_default():
+            if inference:
+                self.is_training = False
+                self.input, self.output, self.target, self.loss = self.setup_layers(params)
+                return
+
             self.is_training = tf.placeholder("bool", name="is_training")
             self.input, self.output, self.target, self.loss = self.setup_layers(params)
-            self.train_step = self.setup_training(params.learning_rate)
 
-            self.tb_writer = self.setup_tensorboard_tracking(params.tb_log_path)
+            self.data_iterator = None
+            if params.data_pipeline == 'tf_data':
+                self.data_iterator = self.setup_data_iterator()
+
+            # learning rate is a local variable (not saved in checkpoints) so it
+            # can be changed during training, e.g., by `ReduceLROnPlateau`
+            self.learning_rate = tf.Variable(
+                params.learning_rate,
+                trainable=False,
+                name='learning_rate',
+                dtype=tf.float32,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES]
+            )
+            self.train_step = self.setup_training(self.learning_rate)
+
+            self.setup_tensorboard_tracking(params.tb_log_path)
             self.tb_stats = tf.summary.merge_all()
 
             self.saver = tf.train.Saver(
@@ -1,10 +1,22 @@
 """Module contains common tensorflow operations"""
 
+import sys
+import os
+import math
 import string
+from collections import OrderedDict
 from multiprocessing import cpu_count
 
+if sys.version_info.major == 2:
+    from collections import Iterator
+elif sys.version_info.major == 3:
+    from collections.abc import Iterator
+else:
+    raise ValueError('wtf?!?')
+
 from unidecode import unidecode
 
+import numpy as np
 import tensorflow as tf
 
 #
@@ -20,15 +32,77 @@ def set_session_params(cfg_params=None):
     return tf.ConfigProto(**cfg_params)
 
 
-def set_max_threads(sess_cfg, max_threads=None):
-    """Set max threads used in session"""
+def _cgroup_cpu_quota():
+    """CPU quota (in CPUs) from the cgroup the process runs in, or None"""
+
+    # cgroup v2
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'rt') as quota_file:
+            quota, period = quota_file.read().split()[:2]
+        if quota == 'max':
+            return None
+        return float(quota) / float(period)
+    except (IOError, OSError, ValueError):
+        pass
+
+    # cgroup v1
+    for cgroup_dir in ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct']:
+        try:
+            with open(os.path.join(cgroup_dir, 'cpu.cfs_quota_us'), 'rt') as quota_file:
+                quota = int(quota_file.read())
+            with open(os.path.join(cgroup_dir, 'cpu.cfs_period_us'), 'rt') as period_file:
+                period = int(period_file.read())
+        except (IOError, OSError, ValueError):
+            continue
+        if quota > 0 and period > 0:
+            return float(quota) / float(period)
+        return None
+
+    return None
+
+
+def available_cpus():
+    """Number of CPUs the process can actually use, taking CPU affinity and
+    cgroup CPU quotas (e.g., in containers) into account"""
+
+    try:
+        num_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        num_cpus = cpu_count()
+
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        num_cpus = min(num_cpus, max(1, int(math.ceil(quota))))
+
+    return num_cpus
 
-    if max_threads is None:
-        max_threads = cpu_count()
 
-    sess_cfg.intra_op_parallelism_threads = max_threads
-    sess_cfg.inter_op_parallelism_threads = max_threads
+def set_thread_params(sess_cfg, intra_op_threads=None, inter_op_threads=None, thread_pool=None):
+    """Set the threads used in session
+
+    `intra_op_threads` is how many threads a single op (e.g., a matmul) can use
+    and `inter_op_threads` is how many ops can run at once. Both default to the
+    number of available CPUs. If `thread_pool` is a name, ops are run on a
+    global inter-op pool of that name, which is shared by every session in the
+    process that uses the same name
+    """
+
+    if intra_op_threads is None:
+        intra_op_threads = available_cpus()
+
+    if inter_op_threads is None:
+        inter_op_threads = available_cpus()
+
+    sess_cfg.intra_op_parallelism_threads = intra_op_threads
+    sess_cfg.inter_op_parallelism_threads = inter_op_threads
     sess_cfg.allow_soft_placement = True
+
+    if thread_pool is not None:
+        sess_cfg.session_inter_op_thread_pool.add(
+            num_threads=inter_op_threads,
+            global_name=thread_pool
+        )
+
     return sess_cfg
 
 
@@ -51,6 +125,92 @@ def make_data_dict(tf_model, x_data, y_data, is_training=False):
 
     return data_dict
 
+
+def reroute_with_default(placeholder, default):
+    """Swap a placeholder for a `tf.placeholder_with_default` that reads from
+    `default` (e.g., a `tf.data` iterator) unless a value is fed. Every op that
+    consumed the old placeholder is rewired to the new tensor, which is returned
+    """
+
+    consumers = placeholder.consumers()
+
+    feedable = tf.placeholder_with_default(
+        default,
+        shape=placeholder.get_shape(),
+        name='{}_or_iterator'.format(placeholder.op.name)
+    )
+
+    tf.contrib.graph_editor.reroute_ts(
+        [feedable],
+        [placeholder],
+        can_modify=consumers
+    )
+
+    return feedable
+
+
+def optimize_inference_graph(graph_def, input_names, output_names):
+    """
+    Clean up a frozen inference graph: drop identity/debugging nodes and fold
+    every constant subexpression. That collapses each batch normalization into
+    a constant scale and offset, which gets folded into the weights of the
+    conv/matmul feeding it when there's nothing in between
+    """
+
+    # pylint: disable=no-name-in-module
+    from tensorflow.tools.graph_transforms import TransformGraph
+
+    return TransformGraph(
+        graph_def,
+        input_names,
+        output_names,
+        [
+            'remove_nodes(op=Identity, op=CheckNumerics)',
+            'fold_constants(ignore_errors=true)',
+            'fold_batch_norms',
+            'fold_old_batch_norms',
+            'sort_by_execution_order',
+        ]
+    )
+
+#
+# Batching utils
+#
+
+def is_chunk_iterable(x_data):
+    """True if `x_data` is an iterator of input chunks (e.g., a generator)
+    rather than a single input (an array, a list of arrays, or anything else
+    that can go in a feed_dict, like a DataFrame)"""
+
+    return isinstance(x_data, Iterator)
+
+
+def num_samples(x_data):
+    """Number of samples in an input array or a list of input arrays"""
+
+    if isinstance(x_data, (list, tuple)):
+        return x_data[0].shape[0]
+    return x_data.shape[0]
+
+
+def slice_data(x_data, start, stop):
+    """Slice samples out of an input array or a list of input arrays"""
+
+    if isinstance(x_data, (list, tuple)):
+        return [x_part[start:stop] for x_part in x_data]
+    return x_data[start:stop]
+
+
+def iter_slices(x_data, batch_size=None):
+    """Split an input into consecutive batches of at most `batch_size` samples"""
+
+    nsamp = num_samples(x_data)
+    if not batch_size:
+        batch_size = max(nsamp, 1)
+
+    for start in range(0, nsamp, batch_size):
+        yield slice_data(x_data, start, start + batch_size)
+
 #
 # Loss functions
 #
@@ -151,6 +311,31 @@ def fit_to_shape(in_layer, target_shape):
 # Text vectorizing tools
 #
 
+class _TransliterationTable(dict):
+    """`str.translate` table from code points to their `unidecode` ASCII
+    version, filled in the first time each code point is seen. It holds one
+    entry per distinct character, not per string"""
+
+    def __missing__(self, code_point):
+        ascii_chars = unidecode(chr(code_point))
+        self[code_point] = ascii_chars
+        return ascii_chars
+
+
+_TRANSLITERATIONS = _TransliterationTable()
+
+
+def transliterate(in_string):
+    """ASCII version of a string, same as `unidecode`. Strings that are
+    already ASCII are passed through"""
+
+    try:
+        in_string.encode('ascii')
+        return in_string
+    except UnicodeError:
+        return in_string.translate(_TRANSLITERATIONS)
+
+
 class TextProcessor(object):
     """Object that handles mapping characters to onehot embeddings
     and back and forth. Generally uses unicode
@@ -166,7 +351,9 @@ class TextProcessor(object):
             self.good_chars = self.DEFAULT_CHARS
         else:
             self.good_chars = good_chars
-        self.good_chars = unidecode(self.good_chars)
+        # characters that transliterate to the same ASCII character (e.g.,
+        # accented versions of a letter) only get one int
+        self.good_chars = ''.join(OrderedDict.fromkeys(unidecode(self.good_chars)))
 
         self.char_to_int = {val: key for key, val in enumerate(self.good_chars)}
         self.int_to_char = {key: val for key, val in enumerate(self.good_chars)}
@@ -182,6 +369,17 @@ class TextProcessor(object):
         self.int_to_char[self.missing_char_idx] = unidecode(self.MISSING_CHAR)
         self.int_to_char[self.pad_char_idx] = unidecode(self.PAD_CHAR)
 
+        # lookup tables for bulk encoding/decoding, indexed by ASCII code and
+        # by int respectively
+        self.encode_table = np.full(256, self.missing_char_idx, dtype=np.int32)
+        for char, idx in self.char_to_int.items():
+            self.encode_table[ord(char)] = idx
+
+        self.decode_table = np.zeros(self.num_chars + 2, dtype=np.uint8)
+        for idx, char in self.int_to_char.items():
+            self.decode_table[idx] = ord(char)
+        self.decode_table[self.pad_char_idx] = 0
+
     def string_to_ints(self, in_string, pad_len=None):
         """Take a sting, and turn it into a list of integers"""
 
@@ -205,3 +403,44 @@ class TextProcessor(object):
         char_list = [self.int_to_char[c] for c in in_ints if c is not self.pad_char_idx]
         out_string = ''.join(char_list)
         return out_string
+
+    def strings_to_ints(self, strings, pad_len, out=None):
+        """
+        Turn a list of strings into an (num strings, pad_len) int32 matrix in
+        one vectorized pass, with the same encoding as `string_to_ints`. Pass
+        `out` to fill a preallocated matrix (e.g., a memmap) instead
+        """
+
+        num_strings = len(strings)
+        if out is None:
+            out = np.empty((num_strings, pad_len), dtype=np.int32)
+        out.fill(self.pad_char_idx)
+
+        ascii_strings = [transliterate(in_string)[:pad_len] for in_string in strings]
+        lengths = np.array([len(in_string) for in_string in ascii_strings], dtype=np.int64)
+        if not lengths.sum():
+            return out
+
+        codes = np.frombuffer(
+            ''.join(ascii_strings).encode('ascii', 'replace'),
+            dtype=np.uint8
+        )
+
+        rows = np.repeat(np.arange(num_strings), lengths)
+        cols = np.arange(codes.shape[0]) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        out[rows, cols] = self.encode_table[codes]
+
+        return out
+
+    def ints_to_strings(self, int_matrix):
+        """Turn a matrix of ints (one row per string) back into a list of
+        strings, dropping padding like `ints_to_string`"""
+
+        int_matrix = np.asarray(int_matrix)
+        if not int_matrix.size:
+            return [''] * int_matrix.shape[0]
+
+        codes = np.ascontiguousarray(self.decode_table[int_matrix])
+        rows = codes.view('S{}'.format(codes.shape[1])).ravel()
+
+        return [row.replace(b'\0', b'').decode('ascii') for row in rows]
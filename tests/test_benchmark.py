@@ -0,0 +1,128 @@
+"""Smoke tests on the benchmarks, with tiny models and datasets
+"""
+
+# pylint: disable=C0103
+# pylint: disable=C0325
+
+
+import os
+import json
+import shutil
+import tempfile
+
+from modelwrangler.benchmark import (
+    run_benchmarks, scaling_benchmark, alphabet_benchmark, bucketing_benchmark,
+    compare_benchmarks
+)
+from modelwrangler.corral.linear_regression import LinearRegression
+
+
+def test_run_benchmarks():
+    """Test that model benchmarks run, and that comparing two runs finds
+    regressions and skips metrics it doesn't know
+    """
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        results = run_benchmarks(
+            os.path.join(out_dir, 'benchmarks.json'),
+            model_classes=[LinearRegression],
+            num_samples=64,
+            num_train_batches=2,
+            predict_batch_sizes=(1, 8),
+            num_predict_runs=2,
+            in_size=5,
+            path=out_dir
+        )
+        metrics = results['models']['LinearRegression']
+        assert sorted(metrics['predict_latency_sec']) == ['1', '8']
+        assert metrics['train_samples_per_sec'] > 0
+
+        for filename, models in [
+                ('old.json', {'m': {'train_samples_per_sec': 100.0, 'new_metric': 5.0}}),
+                ('new.json', {'m': {'train_samples_per_sec': 50.0, 'new_metric': 50.0}})]:
+            with open(os.path.join(out_dir, filename), 'wt') as json_file:
+                json.dump({'models': models}, json_file)
+
+        regressions = compare_benchmarks(
+            os.path.join(out_dir, 'old.json'),
+            os.path.join(out_dir, 'new.json')
+        )
+        assert regressions == [('m', 'train_samples_per_sec', 100.0, 50.0)]
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def test_scaling_benchmark():
+    """Test the data-parallel scaling benchmark"""
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        results = scaling_benchmark(
+            LinearRegression,
+            worker_counts=(1, 2),
+            num_samples=256,
+            num_epochs=1,
+            out_file=os.path.join(out_dir, 'scaling.json'),
+            in_size=5,
+            path=out_dir
+        )
+        assert sorted(results) == ['1', '2']
+        assert all(value > 0 for value in results.values())
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def test_alphabet_benchmark():
+    """Test the text model input encoding benchmark"""
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        results = alphabet_benchmark(
+            alphabet_sizes=(8,),
+            num_samples=64,
+            num_train_batches=2,
+            out_file=os.path.join(out_dir, 'alphabet.json'),
+            in_size=16,
+            conv_nodes=[4],
+            dense_nodes=[2],
+            path=out_dir
+        )
+        assert sorted(results) == ['embedding_8', 'gather_8', 'onehot_8']
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def test_bucketing_benchmark():
+    """Test the text model length bucketing benchmark"""
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        results = bucketing_benchmark(
+            bucket_bounds=(16, 32),
+            num_samples=256,
+            mean_length=8,
+            num_epochs=1,
+            out_file=os.path.join(out_dir, 'bucketing.json'),
+            conv_nodes=[4],
+            dense_nodes=[2],
+            path=out_dir
+        )
+        assert sorted(results) == ['bucketed', 'padded']
+    finally:
+        shutil.rmtree(out_dir)
+
+
+if __name__ == "__main__":
+
+    print("\n\ntesting model benchmarks")
+    test_run_benchmarks()
+
+    print("\n\ntesting scaling benchmark")
+    test_scaling_benchmark()
+
+    print("\n\ntesting alphabet benchmark")
+    test_alphabet_benchmark()
+
+    print("\n\ntesting bucketing benchmark")
+    test_bucketing_benchmark()
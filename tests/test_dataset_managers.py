@@ -0,0 +1,262 @@
+"""Testing on dataset managers
+"""
+
+# pylint: disable=C0103
+# pylint: disable=C0325
+
+
+import os
+import tempfile
+
+import numpy as np
+
+from modelwrangler.dataset_managers import (
+    DatasetManager,
+    CategoricalDataManager,
+    TextDataManager,
+    ShardedDatasetManager,
+    write_shards,
+    StreamingTextDataManager,
+    TextCorpus,
+    BatchPrefetcher,
+    encode_strings,
+    open_array,
+    is_memmap,
+    concat_idx
+)
+
+
+def make_testdata(in_dim=3, out_dim=2, n_samp=1000):
+    """Make sample data with a couple of categorical outputs
+    """
+    X = np.random.randn(n_samp, in_dim)
+    y = (np.random.rand(n_samp, out_dim) > 0.5).astype(float)
+    return X, y
+
+
+def test_groups_and_holdout():
+    """Test that groups and holdout split cover every sample exactly once
+    """
+    X, y = make_testdata()
+    dm = CategoricalDataManager(X, y, holdout_prop=0.1)
+
+    for grp, idx in dm.groups.items():
+        assert (y[idx] == np.array(grp)).all()
+
+    train_idx = concat_idx(dm.groups.values())
+    holdout_idx = concat_idx(dm.groups_holdout.values())
+    all_idx = np.sort(np.concatenate([train_idx, holdout_idx]))
+    assert np.array_equal(all_idx, np.arange(X.shape[0]))
+
+
+def test_batches_cover_training_set(batch_size=64):
+    """Test that an epoch of batches uses every training sample once
+    """
+    X, y = make_testdata()
+
+    for dm in [DatasetManager(X, y, holdout_prop=0.1),
+               CategoricalDataManager(X, y, holdout_prop=0.1)]:
+
+        batch_idx = concat_idx(dm.get_batch_idx(batch_size=batch_size))
+        assert batch_idx.shape[0] == dm.nsamp_train
+        assert np.unique(batch_idx).shape[0] == dm.nsamp_train
+
+        X_batch, y_batch = next(dm.get_batches(batch_size=batch_size))
+        assert X_batch.shape[0] == y_batch.shape[0]
+
+
+def test_memmapped_data(batch_size=64):
+    """Test that datasets memory-mapped from `.npy` and raw binary files give
+    the same splits and batches as the same data in memory
+    """
+    X, y = make_testdata()
+    data_dir = tempfile.mkdtemp()
+    np.save(os.path.join(data_dir, 'X.npy'), X)
+    np.save(os.path.join(data_dir, 'y.npy'), y)
+    X.tofile(os.path.join(data_dir, 'X.bin'))
+
+    np.random.seed(0)
+    dm = CategoricalDataManager(X, y, holdout_prop=0.1)
+
+    for X_path in [os.path.join(data_dir, 'X.npy'),
+                   open_array(os.path.join(data_dir, 'X.bin'), dtype=X.dtype, shape=(None, X.shape[1]))]:
+
+        np.random.seed(0)
+        dm_disk = CategoricalDataManager.from_npy(
+            X_path, os.path.join(data_dir, 'y.npy'), holdout_prop=0.1)
+        assert is_memmap(dm_disk.X) and is_memmap(dm_disk.y)
+
+        for grp in dm.groups:
+            assert np.array_equal(dm.groups[grp], dm_disk.groups[grp])
+
+        for batch_idx in dm_disk.get_batch_idx(batch_size=batch_size):
+            X_batch, y_batch = dm_disk._return_idx(batch_idx)  # pylint: disable=protected-access
+            assert np.array_equal(X_batch, X[np.sort(batch_idx)])
+            assert np.array_equal(y_batch, y[np.sort(batch_idx)])
+
+        holdout_idx = np.sort(concat_idx(dm.groups_holdout.values()))
+        assert np.array_equal(dm_disk.get_holdout_samples()[0], X[holdout_idx])
+
+
+def test_sharded_data(batch_size=64):
+    """Test that sharded datasets stream every training sample once per epoch
+    and hold out whole shards
+    """
+    X, y = make_testdata()
+    X[:, 0] = np.arange(X.shape[0])
+    shard_dir = tempfile.mkdtemp()
+    assert write_shards(X, y, shard_dir, shard_size=300) == 4
+
+    dm = ShardedDatasetManager(shard_dir, holdout_prop=0.1, shuffle_buffer=100)
+    assert dm.shards.shape[0] == 3 and dm.shards_holdout.shape[0] == 1
+
+    train_ids = np.sort(np.concatenate([
+        dm._load_shard(shard)[0][:, 0] for shard in dm.shards  # pylint: disable=protected-access
+    ]))
+    assert train_ids.shape[0] == dm.nsamp_train
+
+    for batches in [dm.get_batches(batch_size=batch_size),
+                    dm.prefetch_batches(batch_size=batch_size)]:
+        batches = list(batches)
+        assert max(X_batch.shape[0] for X_batch, _ in batches) <= batch_size
+        seen = np.sort(np.concatenate([X_batch[:, 0] for X_batch, _ in batches]))
+        assert np.array_equal(seen, train_ids)
+        assert all(np.array_equal(y_batch, y[X_batch[:, 0].astype(int)])
+                   for X_batch, y_batch in batches)
+
+    X_holdout, y_holdout = dm.get_holdout_samples()
+    assert X_holdout.shape[0] == 100
+    assert not np.intersect1d(X_holdout[:, 0], train_ids).shape[0]
+    assert np.array_equal(y_holdout, y[X_holdout[:, 0].astype(int)])
+
+    try:
+        dm.get_batch_idx()
+        assert False, 'sharded datasets have no batch indices'
+    except ValueError:
+        pass
+
+
+def test_prefetch_batches(batch_size=64):
+    """Test that prefetched batches cover the training set once
+    """
+    X, y = make_testdata()
+    X[:, 0] = np.arange(X.shape[0])
+    dm = CategoricalDataManager(X, y, holdout_prop=0.1)
+
+    batches = dm.prefetch_batches(batch_size=batch_size, num_workers=3, max_batches=2)
+    seen = np.concatenate([X_batch[:, 0] for X_batch, _ in batches]).astype(int)
+
+    assert seen.shape[0] == dm.nsamp_train
+    assert np.array_equal(np.sort(seen), np.sort(concat_idx(dm.groups.values())))
+
+
+def test_prefetcher_errors_and_close():
+    """Test that errors in the worker threads come out of the prefetcher and
+    that closing it stops the threads
+    """
+
+    def _gather(idx):
+        if idx == 5:
+            raise RuntimeError('bad batch')
+        return idx
+
+    prefetcher = BatchPrefetcher(range(10), gather_func=_gather, num_workers=3)
+    try:
+        list(prefetcher)
+        assert False, 'the gather error should have been raised'
+    except RuntimeError as err:
+        assert str(err) == 'bad batch'
+    assert list(prefetcher) == []
+
+    def _forever():
+        while True:
+            yield 0
+
+    prefetcher = BatchPrefetcher(_forever(), gather_func=lambda idx: idx, num_workers=2)
+    next(prefetcher)
+    prefetcher.close()
+    assert not any(thread.is_alive() for thread in prefetcher._threads)  # pylint: disable=protected-access
+    assert list(prefetcher) == []
+
+
+def test_encode_strings():
+    """Test that parallel and cached text encoding match serial encoding
+    """
+    strings = [u'caf\xe9 {}'.format('a' * n) for n in np.random.randint(0, 100, size=2500)]
+    X_serial = encode_strings(strings, 64)
+
+    assert np.array_equal(X_serial, encode_strings(strings, 64, num_workers=2, chunk_size=300))
+
+    cache_dir = tempfile.mkdtemp()
+    X_written = encode_strings(strings, 64, num_workers=2, cache_dir=cache_dir, chunk_size=300)
+    assert np.array_equal(X_serial, X_written)
+
+    cache_files = os.listdir(cache_dir)
+    assert len(cache_files) == 1 and not cache_files[0].endswith('-partial.npy')
+
+    X_cached = encode_strings(strings, 64, cache_dir=cache_dir)
+    assert isinstance(X_cached, np.memmap)
+    assert np.array_equal(X_serial, X_cached)
+
+
+def test_length_buckets(batch_size=64):
+    """Test that bucketed text batches come from one bucket and are cut to
+    its bound
+    """
+    strings = ['a' * n for n in np.random.randint(0, 100, size=1000)]
+    y = [np.array([float(idx % 2)]) for idx in range(len(strings))]
+    dm = TextDataManager(strings, y, pad_len=128, holdout_prop=0.1, bucket_bounds=[16, 32, 64])
+
+    batches = list(dm.get_batch_idx(batch_size=batch_size))
+    assert np.unique(concat_idx(batches)).shape[0] == dm.nsamp_train
+
+    for batch_idx in batches:
+        assert np.unique(dm.buckets[batch_idx]).shape[0] == 1
+
+        X_batch, _ = dm._return_idx(batch_idx)  # pylint: disable=protected-access
+        assert X_batch.shape[1] == dm.bucket_bounds[dm.buckets[batch_idx[0]]]
+        assert (dm.X[batch_idx, X_batch.shape[1]:] == dm.tp.pad_char_idx).all()
+
+    # buckets with no training samples are skipped
+    strings = ['hi', 'hello', 'hey there'] * 20
+    y = [np.array([float(idx % 2)]) for idx in range(len(strings))]
+    dm = TextDataManager(strings, y, pad_len=128, bucket_bounds=[8, 16, 64])
+    assert concat_idx(dm.get_batch_idx(batch_size=batch_size)).shape[0] == dm.nsamp_train
+
+
+def test_streaming_text():
+    """Test that a streamed corpus gives the same samples as strings in memory
+    """
+    strings = ['a' * n + u' caf\xe9' for n in np.random.randint(0, 100, size=1000)]
+    y = np.array([[float(idx % 2)] for idx in range(len(strings))])
+
+    corpus_path = os.path.join(tempfile.mkdtemp(), 'corpus.txt')
+    with open(corpus_path, 'wb') as corpus_file:
+        corpus_file.write('\n'.join(strings).encode('utf-8'))
+
+    corpus = TextCorpus(corpus_path)
+    assert len(corpus) == len(strings)
+    assert corpus.get_lines([0, 999]) == [strings[0], strings[999]]
+
+    dm = StreamingTextDataManager(corpus, y, pad_len=128, holdout_prop=0.1)
+    dm_strings = TextDataManager(strings, list(y), pad_len=128)
+
+    idx = np.arange(0, 1000, 7)
+    assert np.array_equal(dm._return_idx(idx)[0], dm_strings._return_idx(idx)[0])  # pylint: disable=protected-access
+
+    batch_idx = concat_idx(dm.get_batch_idx(batch_size=64))
+    assert np.unique(batch_idx).shape[0] == dm.nsamp_train
+
+
+if __name__ == "__main__":
+
+    print("\n\ntesting dataset managers")
+    test_groups_and_holdout()
+    test_batches_cover_training_set()
+    test_memmapped_data()
+    test_sharded_data()
+    test_prefetch_batches()
+    test_prefetcher_errors_and_close()
+    test_encode_strings()
+    test_length_buckets()
+    test_streaming_text()
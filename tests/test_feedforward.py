@@ -6,6 +6,10 @@
 # pylint: disable=E1101
 
 
+import os
+import tempfile
+import multiprocessing
+
 import numpy as np
 from scipy.stats import zscore
 
@@ -13,6 +17,12 @@ import modelwrangler.tf_ops as tops
 from modelwrangler.tester import ModelTester
 
 from modelwrangler.tf_models import ConvLayerConfig, LayerConfig
+from modelwrangler.inference import InferenceModel
+from modelwrangler.data_parallel import DataParallelTrainer, _worker
+from modelwrangler.dataset_managers import DatasetManager, open_array
+from modelwrangler.callbacks import (
+    StepTimer, TraceCallback, EarlyStopping, ReduceLROnPlateau, BestCheckpoint
+)
 
 from modelwrangler.corral.dense_feedforward import DenseFeedforward
 from modelwrangler.corral.convolutional_feedforward import ConvolutionalFeedforward
@@ -67,6 +77,283 @@ def test_conv_ff(in_dim=15, out_dim=3):
     print("Acc'y: {}".format(ff_model.score(X, y, score_func=tops.accuracy)))
 
 
+def test_batched_predict(in_dim=15, out_dim=3):
+    """Test that batched/chunked prediction matches one-shot prediction
+    """
+
+    X, _ = make_testdata(in_dim=in_dim, out_dim=out_dim, n_samp=500)
+    ff_model = DenseFeedforward(
+        in_size=in_dim,
+        hidden_nodes=[2, 2],
+        out_size=out_dim)
+
+    full_pred = ff_model.predict(X)
+
+    batch_pred = ff_model.predict(X, batch_size=64)
+    assert np.allclose(full_pred, batch_pred)
+
+    chunks = (X[i:i + 128] for i in range(0, X.shape[0], 128))
+    chunk_pred = ff_model.predict(chunks, batch_size=50)
+    assert np.allclose(full_pred, chunk_pred)
+
+    assert ff_model.predict(X[:0], batch_size=64).shape == (0, out_dim)
+
+
+def test_train_from_disk(in_dim=15, out_dim=3):
+    """Test training on data memory-mapped from `.npy` and raw binary files
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim)
+    y = y.astype(float)
+    data_dir = tempfile.mkdtemp()
+    np.save(os.path.join(data_dir, 'X.npy'), X)
+    np.save(os.path.join(data_dir, 'y.npy'), y)
+    X.tofile(os.path.join(data_dir, 'X.bin'))
+
+    X_raw = open_array(os.path.join(data_dir, 'X.bin'), dtype=X.dtype, shape=(None, in_dim))
+    for X_path in [os.path.join(data_dir, 'X.npy'), X_raw]:
+        ff_model = DenseFeedforward(
+            in_size=in_dim,
+            hidden_nodes=[2, 2],
+            out_size=out_dim)
+
+        dataset = DatasetManager.from_npy(X_path, os.path.join(data_dir, 'y.npy'), holdout_prop=0.1)
+        before_pred = ff_model.predict(X)
+        ff_model.train(dataset)
+
+        assert not np.allclose(before_pred, ff_model.predict(X))
+        assert np.isfinite(ff_model.score(X, y))
+
+
+def test_tf_data_pipeline(in_dim=15, out_dim=3):
+    """Test training with batches fed from a tf.data iterator
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim)
+    ff_model = DenseFeedforward(
+        in_size=in_dim,
+        hidden_nodes=[2, 2],
+        out_size=out_dim,
+        data_pipeline='tf_data',
+        data_workers=2)
+
+    print("Loss: {}".format(ff_model.score(X, y)))
+    ff_model.train(X, y)
+    print("Loss: {}".format(ff_model.score(X, y)))
+    assert ff_model.predict(X).shape == (X.shape[0], out_dim)
+
+
+def test_cached_batched_score(in_dim=15, out_dim=3):
+    """Test that repeated scoring doesn't grow the graph and that batched
+    scores match one-shot scores
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim, n_samp=500)
+    ff_model = DenseFeedforward(
+        in_size=in_dim,
+        hidden_nodes=[2, 2],
+        out_size=out_dim)
+
+    full_acc = ff_model.score(X, y, score_func=tops.accuracy)
+    num_ops = len(ff_model.tf_mod.graph.get_operations())
+
+    batch_acc = ff_model.score(X, y, score_func=tops.accuracy, batch_size=64)
+    assert len(ff_model.tf_mod.graph.get_operations()) == num_ops
+    assert np.isclose(full_acc, batch_acc)
+
+    assert np.isclose(ff_model.score(X, y), ff_model.score(X, y, batch_size=64))
+
+
+def test_batched_feature_importance(in_dim=15, out_dim=3):
+    """Test that feature importances accumulated in batches match the
+    one-shot importances
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim, n_samp=500)
+    ff_model = DenseFeedforward(
+        in_size=in_dim,
+        hidden_nodes=[2, 2],
+        out_size=out_dim)
+
+    full_imp = ff_model.feature_importance(X, y)
+    num_ops = len(ff_model.tf_mod.graph.get_operations())
+
+    batch_imp = ff_model.feature_importance(X, y, batch_size=64)
+    assert len(ff_model.tf_mod.graph.get_operations()) == num_ops
+    assert full_imp.shape == (1, in_dim)
+    assert np.allclose(full_imp, batch_imp, rtol=1e-3)
+
+    chunks = ((X[i:i + 128], y[i:i + 128]) for i in range(0, X.shape[0], 128))
+    assert np.allclose(full_imp, ff_model.feature_importance(chunks, None, batch_size=50), rtol=1e-3)
+
+
+def test_save_and_load(in_dim=15, out_dim=3):
+    """Test that a restored model builds one copy of the graph and makes the
+    same predictions as the model that was saved
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim, n_samp=500)
+    ff_model = DenseFeedforward(
+        name='ff_save_load',
+        in_size=in_dim,
+        hidden_nodes=[2, 2],
+        out_size=out_dim)
+    ff_model.train(X, y)
+
+    restored_model = DenseFeedforward.load(ff_model.params.params_filename())
+
+    assert (
+        len(restored_model.tf_mod.graph.get_operations()) ==
+        len(ff_model.tf_mod.graph.get_operations())
+    )
+    assert np.allclose(ff_model.predict(X), restored_model.predict(X))
+
+
+def test_async_save_and_load(in_dim=15, out_dim=3):
+    """Test that a model saved in the background restores to the same
+    predictions, and that its checkpointer's session is closed with it
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim, n_samp=500)
+    ff_model = DenseFeedforward(
+        name='ff_async_save',
+        in_size=in_dim,
+        hidden_nodes=[2, 2],
+        out_size=out_dim,
+        async_save=True)
+    ff_model.train(X, y)
+
+    restored_model = DenseFeedforward.load(ff_model.params.params_filename())
+    assert np.allclose(ff_model.predict(X), restored_model.predict(X))
+
+    checkpointer = ff_model._checkpointer  # pylint: disable=protected-access
+    ff_model.__del__()
+    assert checkpointer._sess._closed  # pylint: disable=protected-access
+
+
+def test_export_inference(in_dim=15, out_dim=3):
+    """Test that an exported inference graph makes the same predictions as
+    the model, including batch normalization layers (conv layers have it by
+    default)
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim, n_samp=500)
+
+    dense_model = DenseFeedforward(
+        name='ff_export',
+        in_size=in_dim,
+        hidden_nodes=[2, 2],
+        out_size=out_dim)
+
+    conv_model = ConvolutionalFeedforward(
+        name='conv_ff_export',
+        in_size=in_dim,
+        out_size=out_dim,
+        conv_params={'batchnorm': True, 'kernel': 3, 'strides': 1, 'pool_size': 2})
+
+    for model, X_model in [(dense_model, X), (conv_model, X[:, :, np.newaxis])]:
+        model.train(X_model, y)
+
+        inference_model = InferenceModel(model.export_inference())
+        assert np.allclose(
+            model.predict(X_model),
+            inference_model.predict(X_model, batch_size=64),
+            atol=1e-5
+        )
+        assert inference_model.predict(X_model[:0], batch_size=64).shape == (0, out_dim)
+
+
+def test_training_callbacks(in_dim=15, out_dim=3):
+    """Test that step timing and tracing callbacks see every training step
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim, n_samp=500)
+    ff_model = DenseFeedforward(
+        in_size=in_dim,
+        hidden_nodes=[2, 2],
+        out_size=out_dim,
+        batch_size=50,
+        num_epochs=1)
+
+    timer = StepTimer()
+    tracer = TraceCallback(batches=[1])
+    ff_model.train(X, y, callbacks=[timer, tracer])
+
+    assert timer.num_batches > 1
+    assert timer.totals['run_sec'] > 0
+    assert len(tracer.trace_files) == 1
+
+
+def test_early_stopping(in_dim=15, out_dim=3):
+    """Test that early stopping, learning rate decay and best-only checkpoints
+    kick in when the holdout score doesn't improve
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim, n_samp=500)
+    ff_model = DenseFeedforward(
+        in_size=in_dim,
+        hidden_nodes=[2, 2],
+        out_size=out_dim,
+        num_epochs=5)
+
+    # no epoch can improve by this much, so everything triggers after epoch 1
+    huge_delta = 1.0e9
+    start_lr = ff_model.params.learning_rate
+    ff_model.train(X, y, callbacks=[
+        EarlyStopping(patience=1, min_delta=huge_delta),
+        ReduceLROnPlateau(patience=1, factor=0.5, min_delta=huge_delta),
+        BestCheckpoint(min_delta=huge_delta),
+    ])
+
+    assert ff_model.stop_training
+    assert np.isclose(ff_model.params.learning_rate, 0.5 * start_lr)
+    assert np.isclose(ff_model.sess.run(ff_model.tf_mod.learning_rate), 0.5 * start_lr)
+
+
+def test_data_parallel_training(in_dim=15, out_dim=3):
+    """Test that training with worker processes updates the master model's
+    weights
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim, n_samp=1000)
+    ff_model = DenseFeedforward(
+        in_size=in_dim,
+        hidden_nodes=[2, 2],
+        out_size=out_dim,
+        batch_size=50,
+        num_epochs=2,
+        train_workers=2,
+        sync_every=2)
+
+    before_pred = ff_model.predict(X)
+    ff_model.train(X, y)
+
+    assert not np.allclose(before_pred, ff_model.predict(X))
+    assert np.isfinite(ff_model.score(X, y))
+
+    trainer = DataParallelTrainer(ff_model, ff_model.tf_mod.DATA_CLASS(X, y))
+
+    # a worker whose master went away exits on its own
+    orphan = multiprocessing.get_context('spawn').Process(
+        target=_worker,
+        args=trainer._workers[0]._args[:-1] + (-1,)  # pylint: disable=protected-access
+    )
+    orphan.start()
+    orphan.join(timeout=120)
+    assert orphan.exitcode == 0
+
+    # a dead worker fails the epoch instead of hanging it
+    trainer._workers[0].terminate()  # pylint: disable=protected-access
+    trainer._workers[0].join()  # pylint: disable=protected-access
+    try:
+        trainer.run_epoch()
+        assert False, 'the dead worker should have failed the epoch'
+    except RuntimeError as err:
+        assert 'Worker 0 died' in str(err)
+    finally:
+        trainer.close()
+
+
 if __name__ == "__main__":
 
     print("\n\nunit testing dense feedforward")
@@ -74,6 +361,17 @@ if __name__ == "__main__":
 
     print("\n\ne2e testing dense feedforward")
     test_dense_ff()
+    test_batched_predict()
+    test_train_from_disk()
+    test_tf_data_pipeline()
+    test_cached_batched_score()
+    test_batched_feature_importance()
+    test_save_and_load()
+    test_async_save_and_load()
+    test_export_inference()
+    test_training_callbacks()
+    test_early_stopping()
+    test_data_parallel_training()
 
     print("\n\nunit testing conv feedforward")
     ModelTester(ConvolutionalFeedforward)
@@ -0,0 +1,79 @@
+"""Testing on the micro-batcher
+"""
+
+# pylint: disable=C0103
+# pylint: disable=C0325
+
+
+import asyncio
+
+import numpy as np
+
+from modelwrangler.micro_batcher import MicroBatcher, load_test
+from modelwrangler.corral.dense_feedforward import DenseFeedforward
+
+
+def test_micro_batcher(in_dim=10, out_dim=2, n_samp=500):
+    """Test that concurrent single-sample requests get coalesced into batches
+    """
+
+    X = np.random.randn(n_samp, in_dim)
+    ff_model = DenseFeedforward(in_size=in_dim, out_size=out_dim)
+
+    batch_sizes = []
+
+    def predict_func(input_x):
+        batch_sizes.append(input_x.shape[0])
+        return ff_model.predict(input_x)
+
+    stats = load_test(predict_func, X, concurrency=64, max_batch_size=32)
+
+    assert sum(batch_sizes) == n_samp
+    assert max(batch_sizes) <= 32
+    assert len(batch_sizes) < n_samp
+    assert stats['p99_latency'] >= stats['p50_latency']
+
+
+def test_stop_resolves_requests(in_dim=10, n_samp=20):
+    """Test that stopping the batcher finishes or fails every request, so no
+    caller is left waiting
+    """
+
+    X = np.random.randn(n_samp, in_dim)
+
+    async def _run():
+        batcher = MicroBatcher(lambda input_x: 2 * input_x, max_batch_size=8)
+        await batcher.start()
+
+        requests = [asyncio.ensure_future(batcher.predict(sample)) for sample in X[:-1]]
+        await asyncio.sleep(0)
+        await batcher.stop()
+
+        # a request that was queued behind the stop
+        late_request = asyncio.get_event_loop().create_future()
+        await batcher._queue.put((X[-1], late_request, 0.0))  # pylint: disable=protected-access
+        await batcher.stop()
+
+        results = await asyncio.wait_for(asyncio.gather(*requests), 5)
+        assert np.allclose(np.stack(results), 2 * X[:-1])
+        assert isinstance(late_request.exception(), RuntimeError)
+
+        try:
+            await batcher.predict(X[0])
+            assert False, 'a stopped batcher should refuse requests'
+        except ValueError:
+            pass
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_run())
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+
+    print("\n\ntesting micro-batcher")
+    test_micro_batcher()
+    test_stop_resolves_requests()
@@ -0,0 +1,119 @@
+"""Testing on the model pool
+"""
+
+# pylint: disable=C0103
+# pylint: disable=C0325
+
+
+import threading
+
+import numpy as np
+
+from modelwrangler.model_pool import ModelPool
+from modelwrangler.corral.logistic_regression import LogisticRegression
+
+
+def make_testdata(in_dim=10, out_dim=2, n_samp=200):
+    """Make sample data for logistic regression
+    """
+    X = np.random.randn(n_samp, in_dim)
+    y = (np.random.rand(n_samp, out_dim) > 0.5).astype(float)
+    return X, y
+
+
+def test_model_pool(num_models=3, in_dim=10, out_dim=2):
+    """Test that pooled models make the same predictions as the originals,
+    and that the pool evicts models to stay under its memory budget
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim)
+
+    pool = ModelPool(num_threads=2)
+    models = {}
+    for idx in range(num_models):
+        name = 'pool_lr_{}'.format(idx)
+        models[name] = LogisticRegression(name=name, in_size=in_dim, out_size=out_dim)
+        models[name].train(X, y)
+        pool.register(name, models[name].params.params_filename(), LogisticRegression)
+
+    for name, model in models.items():
+        assert np.allclose(pool.predict(name, X), model.predict(X))
+    assert len(pool.loaded_models()) == num_models
+
+    # budget only fits one model, so the least recently used one is evicted
+    pool.memory_budget = int(1.5 * pool.memory_usage() / num_models)
+    pool.close()
+    pool.predict('pool_lr_0', X)
+    pool.predict('pool_lr_1', X)
+    assert pool.loaded_models() == ['pool_lr_1']
+
+    # a model evicted while it's in use isn't closed until it's done
+    with pool.use('pool_lr_1') as model:
+        pool.predict('pool_lr_2', X)
+        assert pool.loaded_models() == ['pool_lr_2']
+        assert np.allclose(model.predict(X), models['pool_lr_1'].predict(X))
+    assert model.sess._closed  # pylint: disable=protected-access
+
+    pool.close()
+
+
+class GatedLogisticRegression(LogisticRegression):
+    """Logistic regression whose loads block until `release` is set"""
+
+    release = threading.Event()
+    num_loads = 0
+
+    @classmethod
+    def load(cls, param_file, session_params=None):
+        cls.num_loads += 1
+        cls.release.wait()
+        return super(GatedLogisticRegression, cls).load(
+            param_file, session_params=session_params)
+
+
+def test_load_outside_lock(in_dim=10, out_dim=2):
+    """Test that a slow load doesn't block other models in the pool, and that
+    threads asking for the same model share one load
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim)
+
+    pool = ModelPool(num_threads=2)
+    models = {}
+    for name in ['pool_fast', 'pool_slow']:
+        models[name] = LogisticRegression(name=name, in_size=in_dim, out_size=out_dim)
+        models[name].train(X, y)
+        pool.register(name, models[name].params.params_filename(), LogisticRegression)
+    pool.registry['pool_slow'] = (pool.registry['pool_slow'][0], GatedLogisticRegression)
+    pool.predict('pool_fast', X)
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(pool.predict('pool_slow', X)))
+        for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # the other threads are stuck loading, but the loaded model still serves
+    assert np.allclose(pool.predict('pool_fast', X), models['pool_fast'].predict(X))
+    assert pool.loaded_models() == ['pool_fast']
+
+    GatedLogisticRegression.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert GatedLogisticRegression.num_loads == 1
+    assert len(results) == 3
+    assert all(np.allclose(result, models['pool_slow'].predict(X)) for result in results)
+
+    pool.close()
+
+
+if __name__ == "__main__":
+
+    print("\n\ntesting model pool")
+    test_model_pool()
+
+    print("\n\ntesting model pool loads outside its lock")
+    test_load_outside_lock()
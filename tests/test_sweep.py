@@ -0,0 +1,76 @@
+"""Testing on hyperparameter sweeps
+"""
+
+# pylint: disable=C0103
+# pylint: disable=C0325
+
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import modelwrangler.tf_ops as tops
+from modelwrangler.sweep import HyperparameterSweep
+from modelwrangler.corral.dense_feedforward import DenseFeedforward
+
+
+def make_testdata(in_dim=10, out_dim=2, n_samp=500):
+    """Make sample data with a couple of categorical outputs
+    """
+    X = np.random.randn(n_samp, in_dim)
+    y = (np.random.rand(n_samp, out_dim) > 0.5).astype(float)
+    return X, y
+
+
+def test_sweep(in_dim=10, out_dim=2):
+    """Test that successive halving trains the best trial the longest and
+    writes a results table, and that a score function can be maximized
+    """
+
+    X, y = make_testdata(in_dim=in_dim, out_dim=out_dim)
+
+    sweep_dir = tempfile.mkdtemp()
+    try:
+        sweep = HyperparameterSweep(
+            DenseFeedforward,
+            {
+                'hidden_nodes': [[2], [5, 5]],
+                'learning_rate': [0.001, 0.01],
+            },
+            base_params={'in_size': in_dim, 'out_size': out_dim},
+            num_procs=2,
+            eta=2,
+            sweep_dir=sweep_dir
+        )
+        best_name, best_params, _ = sweep.run(X, y)
+
+        assert best_params == dict(sweep.trials)[best_name]
+        assert max(row['epochs'] for row in sweep.results) == 4
+        assert os.path.isfile(os.path.join(sweep_dir, 'results.csv'))
+
+        sweep = HyperparameterSweep(
+            DenseFeedforward,
+            {'learning_rate': [0.001, 0.01]},
+            base_params={'in_size': in_dim, 'out_size': out_dim},
+            num_procs=2,
+            eta=2,
+            mode='max',
+            score_func=tops.accuracy,
+            sweep_dir=os.path.join(sweep_dir, 'accuracy')
+        )
+        best_name, _, best_score = sweep.run(X, y)
+
+        # the trial with the highest first-round accuracy is the one kept
+        first_round = [row for row in sweep.results if row['round'] == 0]
+        assert best_name == max(first_round, key=lambda row: row['score'])['trial']
+        assert 0.0 <= best_score <= 1.0
+    finally:
+        shutil.rmtree(sweep_dir)
+
+
+if __name__ == "__main__":
+
+    print("\n\ntesting hyperparameter sweep")
+    test_sweep()
@@ -7,7 +7,9 @@
 
 
 import numpy as np
+import tensorflow as tf
 from nltk.corpus import brown
+from unidecode import unidecode
 
 import modelwrangler.tf_ops as tops
 from modelwrangler.tester import ModelTester
@@ -61,6 +63,131 @@ def test_text_ff(out_dim=3):
     print("Acc'y: {}".format(text_model.score(X, y, score_func=tops.accuracy)))
 
 
+def test_bulk_encoding(pad_len=20):
+    """Test that bulk encoding matches encoding one string at a time"""
+
+    tp = tops.TextProcessor()
+    strings = [' '.join(para[0]) for para in brown.paras()[:200]] + [u'caf\xe9 na\xefve', '']
+
+    X_bulk = tp.strings_to_ints(strings, pad_len=pad_len)
+    X_loop = np.vstack([tp.string_to_ints(s, pad_len=pad_len) for s in strings])
+    assert np.array_equal(X_bulk, X_loop)
+
+    assert tp.ints_to_strings(X_bulk) == [tp.ints_to_string(list(row)) for row in X_loop.tolist()]
+
+    # good_chars that transliterate to the same character
+    tp = tops.TextProcessor(good_chars=u'\xe9\xe8\xea\xebab')
+    strings = [u'b\xe9b\xe9 caf\xe9', 'abc', u'\u5317\u4eac']
+    X_bulk = tp.strings_to_ints(strings, pad_len=pad_len)
+    X_loop = np.vstack([tp.string_to_ints(s, pad_len=pad_len) for s in strings])
+    assert np.array_equal(X_bulk, X_loop)
+    assert tp.ints_to_strings(X_bulk) == [tp.ints_to_string(list(row)) for row in X_loop.tolist()]
+    assert tops.transliterate(strings[2]) == unidecode(strings[2])
+
+
+def test_gather_encoding(out_dim=3):
+    """Test that the gather input encoding matches one-hot encoding"""
+
+    kwargs = {
+        'name': 'text_encoding',
+        'path': './text_encoding',
+        'conv_nodes': [4, 4],
+        'dense_nodes': [2],
+        'out_size': out_dim,
+    }
+
+    onehot_model = ConvolutionalText(input_encoding='onehot', **kwargs)
+    onehot_model.save(0)
+
+    gather_model = ConvolutionalText(
+        input_encoding='gather',
+        restore_path=tf.train.latest_checkpoint(kwargs['path']),
+        **kwargs
+    )
+
+    X, _ = make_testdata(in_dim=onehot_model.params.in_size, out_dim=out_dim)
+    assert np.allclose(onehot_model.predict(X), gather_model.predict(X), atol=1e-5)
+
+
+def test_non_ascii_alphabet(out_dim=3):
+    """Test that a text model sizes its input for non-ASCII good_chars, which
+    transliterate to a different number of characters"""
+
+    good_chars = u'ab\xe6\u5317'
+    tp = tops.TextProcessor(good_chars=good_chars)
+    assert tp.num_chars != len(good_chars)
+
+    kwargs = {
+        'name': 'text_alphabet',
+        'path': './text_alphabet',
+        'in_size': 16,
+        'good_chars': good_chars,
+        'conv_nodes': [4],
+        'dense_nodes': [2],
+        'out_size': out_dim,
+    }
+
+    onehot_model = ConvolutionalText(input_encoding='onehot', **kwargs)
+    onehot_model.save(0)
+
+    gather_model = ConvolutionalText(
+        input_encoding='gather',
+        restore_path=tf.train.latest_checkpoint(kwargs['path']),
+        **kwargs
+    )
+
+    X = tp.strings_to_ints(
+        [u'ab\xe6 \u5317 ba', u'Bei bei', u'\xe6\xe6\xe6xyz'],
+        pad_len=kwargs['in_size']
+    )
+    assert X.max() == tp.pad_char_idx
+    assert np.allclose(onehot_model.predict(X), gather_model.predict(X), atol=1e-5)
+
+
+def test_bucketed_text(out_dim=3):
+    """Test training a variable-length text model on length-bucketed batches"""
+
+    text_model = ConvolutionalText(
+        in_size=None,
+        seq_pooling='max',
+        bucket_bounds=[16, 64],
+        conv_nodes=[10, 10],
+        dense_nodes=[2],
+        out_size=out_dim)
+
+    X, y = make_testdata(
+        in_dim=text_model.params.pad_len,
+        out_dim=out_dim,
+        num_samples=100*out_dim
+    )
+
+    text_model.train(X, y)
+
+    # samples predict the same at their bucket's width as at full length
+    X_short = tops.TextProcessor().strings_to_ints(
+        ['the cat sat', 'sixteen chars ok', 'hi', ''],
+        pad_len=text_model.params.pad_len
+    )
+    assert np.allclose(
+        text_model.predict(X_short[:, :16]),
+        text_model.predict(X_short),
+        atol=1e-5
+    )
+
+    # buckets shorter than the conv layers can handle are rejected
+    try:
+        ConvolutionalText(
+            in_size=None,
+            seq_pooling='max',
+            bucket_bounds=[2, 64],
+            conv_nodes=[10, 10],
+            dense_nodes=[2],
+            out_size=out_dim)
+        assert False, 'bucket_bounds of 2 are too short for two pooled conv layers'
+    except ValueError:
+        pass
+
+
 if __name__ == "__main__":
 
     print("\n\nunit testing text convolutional model")
@@ -68,3 +195,7 @@ if __name__ == "__main__":
 
     print("\n\ne2e testing text convolutional model")
     test_text_ff(out_dim=3)
+    test_bulk_encoding()
+    test_gather_encoding(out_dim=3)
+    test_non_ascii_alphabet(out_dim=3)
+    test_bucketed_text(out_dim=3)
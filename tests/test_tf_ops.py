@@ -0,0 +1,121 @@
+"""Testing on session thread settings
+"""
+
+# pylint: disable=C0103
+# pylint: disable=C0325
+
+
+import io
+
+import modelwrangler.tf_ops as tops
+
+
+def fake_open(files):
+    """Make an `open` that reads `files` (a dict of path: contents), and fails
+    like a missing file for any other path"""
+
+    def _open(path, mode='rt'):  # pylint: disable=unused-argument
+        if path not in files:
+            raise IOError('No such file: {}'.format(path))
+        return io.StringIO(files[path])
+
+    return _open
+
+
+def cgroup_quota(files):
+    """Parse the cgroup CPU quota as if `files` were the only files on disk"""
+
+    tops.open = fake_open(files)
+    try:
+        return tops._cgroup_cpu_quota()  # pylint: disable=protected-access
+    finally:
+        del tops.open
+
+
+def test_cgroup_cpu_quota():
+    """Test that cgroup v1 and v2 CPU quotas are parsed, and that a missing or
+    unlimited quota means there's no quota
+    """
+
+    assert cgroup_quota({}) is None
+
+    # cgroup v2
+    assert cgroup_quota({'/sys/fs/cgroup/cpu.max': u'150000 100000\n'}) == 1.5
+    assert cgroup_quota({'/sys/fs/cgroup/cpu.max': u'max 100000\n'}) is None
+
+    # cgroup v1, in either of its usual mount points
+    for cgroup_dir in ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct']:
+        assert cgroup_quota({
+            cgroup_dir + '/cpu.cfs_quota_us': u'200000\n',
+            cgroup_dir + '/cpu.cfs_period_us': u'100000\n',
+        }) == 2.0
+        assert cgroup_quota({
+            cgroup_dir + '/cpu.cfs_quota_us': u'-1\n',
+            cgroup_dir + '/cpu.cfs_period_us': u'100000\n',
+        }) is None
+
+    # garbage in the v2 file falls back to v1
+    assert cgroup_quota({
+        '/sys/fs/cgroup/cpu.max': u'garbage\n',
+        '/sys/fs/cgroup/cpu/cpu.cfs_quota_us': u'50000\n',
+        '/sys/fs/cgroup/cpu/cpu.cfs_period_us': u'100000\n',
+    }) == 0.5
+
+
+def test_available_cpus():
+    """Test that a CPU quota caps the available CPUs, rounding up to at
+    least one CPU
+    """
+
+    quota_func = tops._cgroup_cpu_quota  # pylint: disable=protected-access
+    try:
+        tops._cgroup_cpu_quota = lambda: None
+        num_cpus = tops.available_cpus()
+        assert num_cpus >= 1
+
+        tops._cgroup_cpu_quota = lambda: 0.25
+        assert tops.available_cpus() == 1
+
+        tops._cgroup_cpu_quota = lambda: num_cpus + 0.5
+        assert tops.available_cpus() == num_cpus
+
+        if num_cpus > 1:
+            tops._cgroup_cpu_quota = lambda: num_cpus - 1.5
+            assert tops.available_cpus() == num_cpus - 1
+    finally:
+        tops._cgroup_cpu_quota = quota_func
+
+
+def test_set_thread_params():
+    """Test the thread settings written into a session config"""
+
+    sess_cfg = tops.set_thread_params(
+        tops.set_session_params(),
+        intra_op_threads=3,
+        inter_op_threads=2,
+        thread_pool='test_pool'
+    )
+    assert sess_cfg.intra_op_parallelism_threads == 3
+    assert sess_cfg.inter_op_parallelism_threads == 2
+    assert sess_cfg.allow_soft_placement
+    assert len(sess_cfg.session_inter_op_thread_pool) == 1
+    assert sess_cfg.session_inter_op_thread_pool[0].num_threads == 2
+    assert sess_cfg.session_inter_op_thread_pool[0].global_name == 'test_pool'
+
+    # thread counts default to the available CPUs, with no shared pool
+    sess_cfg = tops.set_thread_params(tops.set_session_params())
+    assert sess_cfg.intra_op_parallelism_threads == tops.available_cpus()
+    assert sess_cfg.inter_op_parallelism_threads == tops.available_cpus()
+    assert not sess_cfg.session_inter_op_thread_pool
+
+
+if __name__ == "__main__":
+
+    print("\n\ntesting cgroup CPU quotas")
+    test_cgroup_cpu_quota()
+
+    print("\n\ntesting available CPUs")
+    test_available_cpus()
+
+    print("\n\ntesting session thread settings")
+    test_set_thread_params()